@@ -1,62 +1,149 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-# --------- AUTO-INSTALL (Ubuntu 24.04 friendly) ----------
-import sys, subprocess
-REQUIRED = [
-    "fastapi", "uvicorn", "openai", "python-multipart",
-    "duckduckgo-search", "requests",
-    "pypdf", "pdfminer.six", "pdf2image", "pillow", "pytesseract", "reportlab"
-]
-for pkg in REQUIRED:
-    try:
-        __import__(pkg.replace("-", "_"))
-    except ImportError:
-        subprocess.check_call([sys.executable, "-m", "pip", "install", "--break-system-packages", pkg])
-
 # ------------------- IMPORTY -------------------
-import os, sqlite3, uuid, base64, pathlib, json, tempfile, asyncio
+import os, re, sqlite3, uuid, base64, pathlib, json, asyncio, time, functools, threading, contextlib, hashlib, gzip, zlib, random, contextvars
+from collections import OrderedDict, deque
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime, timezone
-from typing import List, Optional
+from email.utils import parsedate_to_datetime
+from typing import Iterator, List, Optional
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse, Response
+from fastapi import APIRouter, FastAPI, UploadFile, File, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
+import anyio
 from pydantic import BaseModel
-from openai import OpenAI
-from duckduckgo_search import DDGS
-import requests
-
-# PDF / OCR
-from pdfminer.high_level import extract_text as pdf_extract_text
-import pytesseract
-from pdf2image import convert_from_path
-from docx import Document
-from odf.opendocument import load as odf_load
-from odf import text as odf_text
-from PIL import Image
-from reportlab.pdfgen import canvas
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import httpx
+try:
+    from python_multipart import MultipartParser
+    from python_multipart.multipart import parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart import MultipartParser
+    from multipart.multipart import parse_options_header
+# Ciężkie biblioteki (pdfminer, pdf2image, pytesseract, PIL, docx, odf, reportlab,
+# duckduckgo_search) importujemy dopiero przy pierwszym użyciu, żeby start był szybki.
 
 # ----------------- KONFIG ----------------------
-API_KEY = None  # loaded dynamically
 MODEL_TEXT  = "gpt-5-mini"
 MODEL_STT   = "gpt-4o-mini-transcribe"
 MODEL_TTS   = "gpt-4o-mini-tts"
 MODEL_IMAGE = "gpt-image-1"
 MODEL_CHOICES = ["gpt-4o-mini", "gpt-4o", "gpt-5-mini", "gpt-5", "gpt-5-large"]
+MODEL_SUMMARY = "gpt-4o-mini"  # zwijanie starszej historii wątku
+# model: "auto" — klasa zapytania wyznacza wystarczające modele, z nich wybierany jest najszybszy
+MODEL_AUTO = "auto"
+ROUTE_TIERS = {
+    "light": ["gpt-4o-mini", "gpt-5-mini"],        # krótka wymiana zdań
+    "standard": ["gpt-5-mini", "gpt-4o"],
+    "heavy": ["gpt-5", "gpt-4o", "gpt-5-large"],   # pliki, długie prompty
+}
+ROUTE_LIGHT_TOKENS = 60       # light: wiadomość do tylu tokenów ...
+ROUTE_LIGHT_HISTORY = 12      # ... w wątku do tylu wiadomości, bez plików i wyszukiwania
+ROUTE_HEAVY_TOKENS = 800      # heavy: dłuższy prompt albo załączone pliki
+ROUTE_EWMA = 0.2              # waga nowego pomiaru w średnich opóźnienia i błędów
+ROUTE_MIN_SAMPLES = 3         # poniżej tylu pomiarów model dostaje próby
+ROUTE_STALE = 300             # s; starsze statystyki wymagają odświeżenia próbą
+ROUTE_MAX_ERRORS = 0.3        # model z większym (średnim) odsetkiem błędów jest pomijany
+ROUTE_PROBE_INTERVAL = 300    # s; najwyżej jedna próba na model w tym czasie
+
+# Budżet tokenów wejściowych na jedno zapytanie (świadomie mniejszy niż okno modelu)
+CONTEXT_BUDGET = {"gpt-4o-mini": 16000, "gpt-4o": 24000, "gpt-5-mini": 24000, "gpt-5": 32000, "gpt-5-large": 32000}
+CONTEXT_BUDGET_DEFAULT = 16000
+CONTEXT_FILES_SHARE = 0.5     # maks. część budżetu na bloki plików
+CONTEXT_KEEP_SHARE = 0.6      # po przepełnieniu zostawiamy tyle historii, resztę zwijamy do podsumowania
+SUMMARY_BATCH_TOKENS = 6000   # ile starych wiadomości dokładamy do podsumowania w jednym wywołaniu
+# Indeks dokumentów: pliki dzielone na fragmenty, do promptu trafia top-k pasujących
+DOC_CHUNK_TOKENS = 350
+DOC_TOP_K = 6
+DOC_SMALL_TOKENS = 2000       # mniejsze dokumenty wstawiamy w całości
+# Cache wyciągniętego tekstu / OCR (klucz: SHA-256 pliku + parametry)
+EXTRACT_CACHE_MAX_BYTES = int(os.environ.get("CHEAPCHAT_EXTRACT_CACHE_MB", 512)) * 1024 * 1024
+EXTRACT_CACHE_VERSION = 1     # podbić po zmianie parserów, żeby unieważnić stare wpisy
+# OCR: strony rasteryzowane pojedynczo i rozpraszane na pulę procesów
+OCR_WORKERS = int(os.environ.get("CHEAPCHAT_OCR_WORKERS", os.cpu_count() or 2))
+# Kolejka zadań ciężkich (OCR, ekstrakcja, obrazy) w SQLite
+JOB_WORKERS = int(os.environ.get("CHEAPCHAT_JOB_WORKERS", 2))   # limit równoległych ciężkich zadań na proces
+# Osobny pas dla krótkich zadań, na które czeka czat (tekst załącznika), żeby nie stały za długim OCR
+JOB_FAST_KINDS = ("text",)
+JOB_FAST_WORKERS = int(os.environ.get("CHEAPCHAT_JOB_FAST_WORKERS", 2))
+JOB_LEASE = 60               # s; zadanie bez odnowionej dzierżawy wraca do kolejki
+JOB_MAX_ATTEMPTS = 3
+JOB_RETENTION = 24 * 3600    # s; tyle trzymamy wyniki zakończonych zadań
+# Dyktowanie w segmentach
+STT_SESSION_TTL = 15 * 60     # s; porzucone sesje dyktowania
+STT_SEGMENT_MAX_BYTES = 25 * 1024 * 1024
+STT_SEGMENT_WAIT = 120        # s; finish nie czeka dłużej na segment (np. z procesu, który padł)
+TTS_CACHE_MAX_BYTES = int(os.environ.get("CHEAPCHAT_TTS_CACHE_MB", 256)) * 1024 * 1024
+TTS_CHUNK_CHARS = 400         # docelowa długość fragmentu przy /api/tts/stream
+TTS_PARALLEL = 3              # ile fragmentów syntezujemy naraz
+# Wyszukiwanie w sieci
+SEARCH_CACHE_TTL = 15 * 60    # s; wyniki wyszukiwania dla tego samego zapytania
+PAGE_CACHE_TTL = 60 * 60      # s; pobrane i oczyszczone strony
+WEB_FETCH_TOP = 3             # ile pierwszych wyników pobieramy równolegle
+WEB_FETCH_DEADLINE = 4.0      # s; łączny limit czasu na pobranie stron
+WEB_PREVIEW_CHARS = 1200
+WEB_MAX_PAGE_BYTES = 1024 * 1024
+# Zastępczy backend wyszukiwania (np. lokalny serwer testowy): GET {url}?q=... -> [{title,url,snippet}]
+SEARCH_BACKEND_URL = os.environ.get("CHEAPCHAT_SEARCH_URL")
 
 TTS_DEFAULT = "alloy"
 TTS_VOICES  = ["alloy","verse","coral","amber","breeze","cobalt","sol"]  # + 'sol'
 PORT = int(os.environ.get("PORT", 8000))
+# Współdzielona pula połączeń do OpenAI i osobna pula wątków dla SQLite
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("CHEAPCHAT_UPSTREAM_CONNECTIONS", 500))
+# Bramka do OpenAI (limity na cały serwer; przy --workers N dzielone po równo między procesy).
+# Format "nazwa=liczba,...", "*" = domyślna wartość dla pozostałych.
+UPSTREAM_CONCURRENCY = os.environ.get("CHEAPCHAT_UPSTREAM_CONCURRENCY",
+                                      "responses=256,speech=16,transcriptions=16,images=4")
+UPSTREAM_MODEL_CONCURRENCY = os.environ.get("CHEAPCHAT_UPSTREAM_MODEL_CONCURRENCY", "*=256")
+UPSTREAM_RPM = os.environ.get("CHEAPCHAT_UPSTREAM_RPM", "*=3000")  # limity konta: zapytania/min per model
+UPSTREAM_BURST = 1            # s; pojemność kubełka = tyle sekund limitu RPM (OpenAI egzekwuje RPM też w krótszych oknach)
+UPSTREAM_RETRIES = 4          # ponowienia po 429 / 5xx / błędzie połączenia
+UPSTREAM_BACKOFF_BASE = 0.5   # s; backoff = losowo z [0, base * 2^próba], max UPSTREAM_BACKOFF_MAX
+UPSTREAM_BACKOFF_MAX = 20.0
+UPSTREAM_RETRY_AFTER_MAX = 60.0  # s; dłuższe Retry-After = nie czekamy, tylko zmieniamy model / zwracamy 503
+BREAKER_FAILURES = 5          # min. liczba błędów modelu w oknie, żeby otworzyć bezpiecznik ...
+BREAKER_RATIO = 0.5           # ... o ile stanowią co najmniej taką część prób
+BREAKER_WINDOW = 10.0         # s
+BREAKER_COOLDOWN = 30.0       # s; po tym czasie jedno próbne wywołanie (half-open)
+UPSTREAM_FAILOVER = 2         # ilu zastępczych modeli z MODEL_CHOICES próbujemy
+DB_THREADS = int(os.environ.get("CHEAPCHAT_DB_THREADS", 8))
+# Strojenie SQLite (per połączenie)
+SQLITE_CACHE_KB = int(os.environ.get("CHEAPCHAT_SQLITE_CACHE_KB", 32768))
+SQLITE_MMAP_BYTES = int(os.environ.get("CHEAPCHAT_SQLITE_MMAP_MB", 256)) * 1024 * 1024
+SQLITE_STMT_CACHE = 256
 
 BASE_DIR = pathlib.Path(__file__).parent.resolve()
 DATA_DIR = pathlib.Path(os.getenv("CHEAPCHAT_DATA_DIR", pathlib.Path.home() / ".config" / "cheapchat"))
-print(f"[data] dir: {DATA_DIR}")
 DB_PATH = DATA_DIR / "memory.sqlite"
-print(f"[db] using {DB_PATH}")
+EXPORT_DIR = DATA_DIR / "exports"
 PUBLIC_DIR = BASE_DIR / "public"
-TEMP_FILES = {}
-TEMP_TTL = 300  # seconds
+FILES_DIR = DATA_DIR / "files"
+FILE_TTL = int(os.environ.get("CHEAPCHAT_FILE_TTL", 300))   # s; czas życia wgranych i generowanych plików
+FILES_MAX_BYTES = int(os.environ.get("CHEAPCHAT_FILES_MB", 2048)) * 1024 * 1024
+FILE_SWEEP_INTERVAL = 60     # s
+INCOMING_TTL = 24 * 3600     # s; porzucone pliki tymczasowe uploadu (np. po awarii procesu)
+EMPTY_THREAD_TTL = 3600      # s; wątki bez wiadomości starsze niż tyle są usuwane
+PAGE_THREADS = 50            # domyślny rozmiar strony listy wątków
+PAGE_MESSAGES = 40           # ... i historii wątku
+MEM_PROFILE_CHARS = 800      # budżet profilu pamięci w prompcie systemowym
+SEND_KEY_TTL = 24 * 3600     # s; jak długo pamiętamy odpowiedź dla klucza idempotencji
+SEND_KEY_PENDING = 300       # s; klucz 'pending' starszy niż tyle uznajemy za porzucony (padł proces)
+SEND_KEY_POLL = 0.25         # s; sprawdzanie klucza obsługiwanego przez inny proces
+# Cache odpowiedzi dla identycznego kontekstu (model + pełna lista messages); 0 = wyłączony
+REPLY_CACHE_TTL = int(os.environ.get("CHEAPCHAT_REPLY_CACHE_TTL", 0))
+PDF_EXPORT_VERSION = 2       # podbić po zmianie układu PDF, żeby unieważnić cache eksportów
+PDF_BATCH = 200              # wiadomości czytane z bazy na raz przy eksporcie
+DUMP_FORMAT = "cheapchat-dump"
+DUMP_VERSION = 1
+DUMP_BATCH = 1000            # wierszy na executemany / zapytanie przy eksporcie i imporcie
+UPLOAD_MAX_FILE_BYTES = int(os.environ.get("CHEAPCHAT_UPLOAD_FILE_MB", 512)) * 1024 * 1024
+UPLOAD_MAX_REQUEST_BYTES = int(os.environ.get("CHEAPCHAT_UPLOAD_REQUEST_MB", 1024)) * 1024 * 1024
 
 # ---- API key loader ----
 def _read_first_nonempty(path):
@@ -111,24 +198,616 @@ def load_api_key():
             return content.strip()
     return None
 
-API_KEY = load_api_key()
-if not API_KEY:
-    raise RuntimeError("Brak klucza OpenAI. Ustaw OPENAI_API_KEY lub zapisz klucz w ./chat-api.env, ./openai.key, .env, config.json, ~/.openai/api_key, ~/.config/private-chat/openai.key")
+client: Optional[AsyncOpenAI] = None  # tworzony przy starcie aplikacji (lifespan)
+
+def make_client() -> AsyncOpenAI:
+    api_key = load_api_key()
+    if not api_key:
+        raise RuntimeError("Brak klucza OpenAI. Ustaw OPENAI_API_KEY lub zapisz klucz w ./chat-api.env, ./openai.key, .env, config.json, ~/.openai/api_key, ~/.config/private-chat/openai.key")
+    return AsyncOpenAI(
+        api_key=api_key,
+        max_retries=0,  # ponowienia robi upstream()
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=UPSTREAM_MAX_CONNECTIONS,
+                                max_keepalive_connections=UPSTREAM_MAX_CONNECTIONS // 5),
+        ),
+    )
 
-client = OpenAI(api_key=API_KEY)
+# -------------- METRYKI -------------------------
+# Czasy etapów (span) są zbierane per żądanie w kontekście (contextvars) i trafiają do histogramów
+# wystawianych w formacie Prometheusa na /-/metrics. Metryki są per proces (przy --workers N każdy
+# proces ma własne). CHEAPCHAT_SLOW_MS > 0 loguje wolne żądania z rozbiciem na etapy.
+SLOW_REQUEST_MS = int(os.environ.get("CHEAPCHAT_SLOW_MS", 0))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self.series, self.lock = {}, threading.Lock()
+
+    def _labels(self, values: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{str(v)}"' for k, v in zip(self.labels, values)] + ([extra] if extra else [])
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, n: float = 1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + n
+
+    def render(self) -> List[str]:
+        with self.lock:
+            items = sorted(self.series.items())
+        return super().render() + [f"{self.name}{self._labels(k)} {v:g}" for k, v in items]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [0] * (len(self.buckets) + 1) + [0, 0.0]  # kubełki, +Inf, count, sum
+            i = 0
+            while i < len(self.buckets) and value > self.buckets[i]:
+                i += 1
+            s[i] += 1
+            s[-2] += 1
+            s[-1] += value
+
+    def render(self) -> List[str]:
+        out = super().render()
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.series.items())
+        for k, s in items:
+            acc = 0
+            for b, n in zip(self.buckets + ("+Inf",), s):
+                acc += n
+                le = b if isinstance(b, str) else f"{b:g}"
+                out.append(f"{self.name}_bucket{self._labels(k, 'le=' + json.dumps(le))} {acc}")
+            out.append(f"{self.name}_count{self._labels(k)} {s[-2]}")
+            out.append(f"{self.name}_sum{self._labels(k)} {s[-1]:.6f}")
+        return out
+
+HTTP_SECONDS = Histogram("cheapchat_http_request_seconds", "Czas obsługi żądania HTTP (do końca odpowiedzi).",
+                         ("method", "route", "status"))
+STAGE_SECONDS = Histogram("cheapchat_stage_seconds", "Czas etapów obsługi żądań.", ("stage",))
+UPSTREAM_SECONDS = Histogram("cheapchat_upstream_seconds", "Czas pojedynczej próby wywołania OpenAI.",
+                             ("endpoint", "model", "outcome"))
+UPSTREAM_WAIT_SECONDS = Histogram("cheapchat_upstream_wait_seconds",
+                                  "Czas oczekiwania w bramce (limit RPM + semafory).", ("endpoint", "model"))
+UPSTREAM_TOKENS = Counter("cheapchat_upstream_tokens_total", "Tokeny zużyte przez model.", ("model", "type"))
+METRICS = [HTTP_SECONDS, STAGE_SECONDS, UPSTREAM_SECONDS, UPSTREAM_WAIT_SECONDS, UPSTREAM_TOKENS]
+
+_SPANS = contextvars.ContextVar("cheapchat_spans", default=None)
+
+def span_add(stage: str, seconds: float):
+    # Tylko w kontekście żądania albo zadania z kolejki: odpytywanie kolejki i sweeper
+    # co sekundę zalewałyby histogram etapu "db" pracą w tle.
+    spans = _SPANS.get()
+    if spans is not None:
+        STAGE_SECONDS.observe(seconds, stage)
+        spans[stage] = spans.get(stage, 0.0) + seconds
+
+@contextlib.contextmanager
+def span(stage: str):
+    """``with span("web_search"): ...`` — czas etapu (powtórzenia w jednym żądaniu się sumują)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        span_add(stage, time.perf_counter() - t0)
 
-# ----------------- APP -------------------------
-app = FastAPI(title="Prywatny czat z pamięcią")
-app.mount("/public", StaticFiles(directory=str(PUBLIC_DIR)), name="public")
+def record_usage(model: str, resp):
+    usage = getattr(resp, "usage", None)
+    if usage is None:
+        return
+    UPSTREAM_TOKENS.inc(model, "input", n=getattr(usage, "input_tokens", 0) or 0)
+    UPSTREAM_TOKENS.inc(model, "output", n=getattr(usage, "output_tokens", 0) or 0)
+
+class MetricsMiddleware:
+    """Czas całego żądania (także strumieni), nagłówek Server-Timing i log wolnych żądań."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        spans, status = {}, [500]
+        token = _SPANS.set(spans)
+        t0 = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if spans:
+                    timing = ", ".join(f"{k};dur={v * 1000:.1f}" for k, v in spans.items())
+                    message.setdefault("headers", []).append((b"server-timing", timing.encode()))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _SPANS.reset(token)
+            total = time.perf_counter() - t0
+            route = getattr(scope.get("route"), "path", None) or "static"
+            HTTP_SECONDS.observe(total, scope["method"], route, status[0])
+            if SLOW_REQUEST_MS and total * 1000 >= SLOW_REQUEST_MS:
+                print("[slow] " + json.dumps({
+                    "method": scope["method"], "path": scope["path"], "route": route, "status": status[0],
+                    "ms": round(total * 1000), "stages": {k: round(v * 1000, 1) for k, v in spans.items()}},
+                    ensure_ascii=False))
+
+# -------------- UPSTREAM: bramka do OpenAI ------
+# Każde wywołanie OpenAI idzie przez upstream(): kubełek żetonów per model (limit RPM konta),
+# semafory per endpoint i per model, ponowienia z backoffem z jitterem (Retry-After ma
+# pierwszeństwo) i bezpiecznik per model, który przy awarii przełącza na sąsiedni model
+# z MODEL_CHOICES. SDK ma max_retries=0 — ponowieniami zarządza wyłącznie bramka.
+def _parse_limits(spec: str) -> dict:
+    """'responses=128,images=4' -> {'responses': 128, 'images': 4}; limity dzielone między procesy."""
+    workers = max(1, int(os.environ.get("CHEAPCHAT_WORKERS", 1)))
+    out = {}
+    for part in spec.split(","):
+        k, _, v = part.partition("=")
+        if k.strip() and v.strip():
+            out[k.strip()] = max(1, int(v) // workers) if int(v) > 0 else 0
+    return out
+
+class _Gate:
+    """Semafor z licznikami: ile wywołań czeka w kolejce, ile trwa."""
+    def __init__(self, limit: int):
+        self.limit, self.queued, self.inflight = limit, 0, 0
+        self.sem = asyncio.Semaphore(limit) if limit else None
+
+    @contextlib.asynccontextmanager
+    async def hold(self):
+        if self.sem is not None:
+            self.queued += 1
+            try:
+                await self.sem.acquire()
+            finally:
+                self.queued -= 1
+        self.inflight += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            if self.sem is not None:
+                self.sem.release()
+
+class TokenBucket:
+    """rate żetonów/s, pojemność burst. Żeton jest rezerwowany od razu (także na kredyt),
+    więc czekający ustawiają się w kolejce zamiast budzić się naraz."""
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, max(1.0, burst)
+        self.tokens, self.stamp, self.waiting = self.burst, time.monotonic(), 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    async def take(self):
+        self._refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return
+        self.waiting += 1
+        try:
+            await asyncio.sleep(-self.tokens / self.rate)
+        except asyncio.CancelledError:
+            self.tokens += 1
+            raise
+        finally:
+            self.waiting -= 1
+
+    def pause(self, seconds: float):
+        """Po 429: nowe wywołania czekają co najmniej `seconds` (kolejne 429 się nie sumują)."""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+class CircuitBreaker:
+    """closed -> open, gdy w ostatnich BREAKER_WINDOW s jest >= BREAKER_FAILURES błędów i stanowią
+    >= BREAKER_RATIO prób (pojedyncze 5xx w dużym ruchu go nie otwierają) -> po BREAKER_COOLDOWN
+    half-open: jedno próbne wywołanie; sukces zamyka, błąd otwiera ponownie."""
+    def __init__(self):
+        self.attempts, self.failures = deque(), deque()
+        self.opened_at, self.probing = None, False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= BREAKER_COOLDOWN else "open"
+
+    def retry_in(self) -> int:
+        return max(1, round(BREAKER_COOLDOWN - (time.monotonic() - (self.opened_at or 0))))
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def attempt(self):
+        self._window(self.attempts).append(time.monotonic())
+
+    def success(self):
+        if self.opened_at is not None:
+            self.attempts.clear()
+            self.failures.clear()
+        self.opened_at, self.probing = None, False
+
+    def failure(self):
+        self._window(self.failures).append(time.monotonic())
+        n = len(self.failures)
+        if self.probing or (n >= BREAKER_FAILURES and n >= BREAKER_RATIO * len(self._window(self.attempts))):
+            self.opened_at, self.probing = time.monotonic(), False
+
+    @staticmethod
+    def _window(q: deque) -> deque:
+        while q and time.monotonic() - q[0] > BREAKER_WINDOW:
+            q.popleft()
+        return q
+
+_UP_ENDPOINTS = _parse_limits(UPSTREAM_CONCURRENCY)
+_UP_MODELS = _parse_limits(UPSTREAM_MODEL_CONCURRENCY)
+_UP_RPM = _parse_limits(UPSTREAM_RPM)
+_UP_GATES = {}      # ("endpoint"|"model", nazwa) -> _Gate
+_UP_BUCKETS = {}    # model -> TokenBucket
+_UP_BREAKERS = {}   # model -> CircuitBreaker
+_UP_COUNTERS = {}   # model -> liczniki wywołań
+
+def _up_gate(kind: str, name: str) -> _Gate:
+    gate = _UP_GATES.get((kind, name))
+    if gate is None:
+        limits = _UP_ENDPOINTS if kind == "endpoint" else _UP_MODELS
+        gate = _UP_GATES[(kind, name)] = _Gate(limits.get(name, limits.get("*", 0)))
+    return gate
+
+def _up_bucket(model: str) -> Optional[TokenBucket]:
+    if model not in _UP_BUCKETS:
+        rpm = _UP_RPM.get(model, _UP_RPM.get("*", 0))
+        _UP_BUCKETS[model] = TokenBucket(rpm / 60, rpm / 60 * UPSTREAM_BURST) if rpm else None
+    return _UP_BUCKETS[model]
+
+def _up_breaker(model: str) -> CircuitBreaker:
+    return _UP_BREAKERS.setdefault(model, CircuitBreaker())
+
+def _up_count(model: str, key: str):
+    c = _UP_COUNTERS.setdefault(model, dict.fromkeys(
+        ("calls", "ok", "retries", "rate_limited", "errors", "failovers"), 0))
+    c[key] += 1
+
+@contextlib.asynccontextmanager
+async def _up_slot(endpoint: str, model: str):
+    bucket = _up_bucket(model)
+    if bucket is not None:
+        await bucket.take()
+    async with _up_gate("endpoint", endpoint).hold(), _up_gate("model", model).hold():
+        yield
+
+def _retry_after(e: Exception) -> Optional[float]:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def _classify(e: Exception) -> Optional[str]:
+    """'rate' (429), 'fault' (5xx/połączenie — liczy się do bezpiecznika) albo None (nie ponawiamy)."""
+    if isinstance(e, openai.RateLimitError):
+        return None if getattr(e, "code", None) == "insufficient_quota" else "rate"
+    if isinstance(e, openai.APIStatusError):
+        return "fault" if e.status_code >= 500 or e.status_code == 408 else None
+    if isinstance(e, openai.APIConnectionError):  # obejmuje APITimeoutError
+        return "fault"
+    return None
+
+def _failover_chain(model: str) -> List[str]:
+    if model not in MODEL_CHOICES:
+        return [model]
+    i = MODEL_CHOICES.index(model)
+    # Najbliżsi sąsiedzi na liście (przy remisie tańszy, bo lista idzie od najtańszego).
+    others = sorted((m for m in MODEL_CHOICES if m != model), key=lambda m: abs(MODEL_CHOICES.index(m) - i))
+    return [model] + others[:UPSTREAM_FAILOVER]
+
+async def upstream(endpoint: str, model: str, call, failover: bool = False, hold: bool = False):
+    """Wywołuje ``await call(model)`` przez bramkę; zwraca (wynik, użyty model).
+
+    Przy ``hold=True`` zwraca (wynik, model, release) — miejsce w semaforach jest trzymane
+    do wywołania ``await release()`` (strumienie). Błędy nieponawialne (400, 401, ...)
+    przechodzą bez zmian; wyczerpane 429 i otwarty bezpiecznik dają 503 z Retry-After.
+    """
+    last_exc, wait_hint = None, 1
+    for m in (_failover_chain(model) if failover else [model]):
+        breaker = _up_breaker(m)
+        if not breaker.allow():
+            wait_hint = max(wait_hint, breaker.retry_in())
+            continue
+        if m != model:
+            _up_count(m, "failovers")
+        # Próba w stanie half-open, która nie skończyła się ani sukcesem, ani awarią (429 do wyczerpania
+        # ponowień, za długi Retry-After, błąd nieponawialny, anulowanie), zwalnia miejsce na kolejną próbę.
+        probe = breaker.probing
+        try:
+            for attempt in range(UPSTREAM_RETRIES + 1):
+                _up_count(m, "calls")
+                breaker.attempt()
+                slot = contextlib.AsyncExitStack()
+                t0, t1 = time.perf_counter(), None
+                try:
+                    await slot.enter_async_context(_up_slot(endpoint, m))
+                    t1 = time.perf_counter()
+                    UPSTREAM_WAIT_SECONDS.observe(t1 - t0, endpoint, m)
+                    span_add("upstream_wait", t1 - t0)
+                    result = await call(m)
+                except BaseException as e:
+                    await slot.aclose()
+                    kind = _classify(e) if isinstance(e, Exception) else None
+                    if t1 is not None:
+                        UPSTREAM_SECONDS.observe(time.perf_counter() - t1, endpoint, m, kind or "error")
+                        span_add("upstream", time.perf_counter() - t1)
+                    if kind is None:
+                        raise
+                    last_exc = e
+                    if endpoint == "responses":
+                        route_error(m, True)
+                    after = _retry_after(e)
+                    if kind == "rate":
+                        _up_count(m, "rate_limited")
+                        if _up_bucket(m) is not None:
+                            _up_bucket(m).pause(after if after is not None else UPSTREAM_BACKOFF_BASE)
+                    else:
+                        _up_count(m, "errors")
+                        breaker.failure()
+                        if breaker.state != "closed":
+                            print(f"[upstream] bezpiecznik {m} otwarty: {e}")
+                            break
+                    if attempt == UPSTREAM_RETRIES or (after or 0) > UPSTREAM_RETRY_AFTER_MAX:
+                        wait_hint = max(wait_hint, round(after or 0))
+                        break
+                    delay = random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+                    if after is not None:
+                        delay = after + random.uniform(0, UPSTREAM_BACKOFF_BASE)
+                    _up_count(m, "retries")
+                    with span("upstream_backoff"):
+                        await asyncio.sleep(delay)
+                    continue
+                UPSTREAM_SECONDS.observe(time.perf_counter() - t1, endpoint, m, "ok")
+                if endpoint == "responses":
+                    route_error(m, False)
+                span_add("upstream", time.perf_counter() - t1)
+                breaker.success()
+                _up_count(m, "ok")
+                if hold:
+                    return result, m, slot.aclose
+                await slot.aclose()
+                return result, m
+        finally:
+            if probe and breaker.probing:
+                breaker.probing = False
+    if last_exc is None or _classify(last_exc) == "rate":
+        detail = "Upstream przeciążony (limit zapytań)." if last_exc else f"Upstream niedostępny: {model}."
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": str(wait_hint)})
+    raise last_exc
+
+def upstream_stats() -> dict:
+    return {
+        "endpoints": {name: {"limit": g.limit, "inflight": g.inflight, "queued": g.queued}
+                      for (kind, name), g in _UP_GATES.items() if kind == "endpoint"},
+        "models": {m: {**_UP_COUNTERS.get(m, {}),
+                       "limit": _up_gate("model", m).limit, "inflight": _up_gate("model", m).inflight,
+                       "queued": _up_gate("model", m).queued,
+                       "rate_waiting": b.waiting if (b := _UP_BUCKETS.get(m)) else 0,
+                       "breaker": _up_breaker(m).state}
+                   for m in sorted(set(_UP_COUNTERS) | set(_UP_BREAKERS))},
+    }
 
+# ----------------- APP -------------------------
+# Endpointy rejestrujemy na routerze; aplikację składa create_app() na końcu pliku.
+router = APIRouter()
 
-@app.get("/settings")
+@router.get("/settings")
 def get_settings_page():
     return FileResponse(PUBLIC_DIR / "settings.html")
 
+async def close_upstream():
+    """Zamyka klientów i pule; zerowane globale tworzą się leniwie od nowa przy kolejnym lifespan."""
+    global client, _HTTP, _DB_EXECUTOR, _OCR_POOL, _JOB_WAKE
+    if client is not None:
+        await client.close()
+    if _HTTP is not None:
+        await _HTTP.aclose()
+    if _DB_EXECUTOR is not None:
+        _DB_EXECUTOR.shutdown(wait=False)
+    if _OCR_POOL is not None:
+        _OCR_POOL.shutdown(wait=False, cancel_futures=True)
+    client = _HTTP = _DB_EXECUTOR = _OCR_POOL = _JOB_WAKE = None
+    # Semafory bramki wiążą się z pętlą zdarzeń przy pierwszym czekaniu.
+    _UP_GATES.clear()
+
 # -------------- DB + MIGRACJE ------------------
+# Migracje wersjonowane przez PRAGMA user_version; każdy krok wykonuje się raz.
+MIGRATIONS = [
+    (1, [
+        "CREATE INDEX IF NOT EXISTS idx_messages_thread ON messages(thread_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_threads_created ON threads(created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_memory_active ON global_memory(is_active, id)",
+        "CREATE INDEX IF NOT EXISTS idx_documents_created ON documents(created_at)",
+    ]),
+    (2, [
+        "ALTER TABLE messages ADD COLUMN tokens INTEGER",
+        "UPDATE messages SET tokens = (length(COALESCE(content,'')) + 3) / 4 + 4",
+        """CREATE TABLE IF NOT EXISTS thread_summaries(
+            thread_id TEXT PRIMARY KEY, upto_id INTEGER, summary TEXT, tokens INTEGER, updated_at TEXT
+        )""",
+    ]),
+    (3, [
+        "ALTER TABLE documents ADD COLUMN chunks INTEGER",
+        """CREATE TABLE IF NOT EXISTS doc_chunks(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            doc_id TEXT, seq INTEGER, content TEXT, tokens INTEGER
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_doc_chunks_doc ON doc_chunks(doc_id, seq)",
+        """CREATE VIRTUAL TABLE IF NOT EXISTS doc_chunks_fts USING fts5(
+            content, content='doc_chunks', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS doc_chunks_ai AFTER INSERT ON doc_chunks BEGIN
+            INSERT INTO doc_chunks_fts(rowid, content) VALUES (new.id, new.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS doc_chunks_ad AFTER DELETE ON doc_chunks BEGIN
+            INSERT INTO doc_chunks_fts(doc_chunks_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END""",
+    ]),
+    (4, [
+        "ALTER TABLE documents ADD COLUMN sha256 TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_documents_sha ON documents(sha256)",
+        """CREATE TABLE IF NOT EXISTS extract_cache(
+            key TEXT PRIMARY KEY, text TEXT, size INTEGER, created_at TEXT, last_used REAL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_extract_cache_used ON extract_cache(last_used)",
+    ]),
+    (5, [
+        """CREATE TABLE IF NOT EXISTS jobs(
+            id TEXT PRIMARY KEY, kind TEXT, params TEXT, dedupe_key TEXT,
+            status TEXT, done INTEGER, total INTEGER, result TEXT, error TEXT,
+            attempts INTEGER DEFAULT 0, worker TEXT, lease_until REAL,
+            created_at REAL, started_at REAL, finished_at REAL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs(dedupe_key)",
+    ]),
+    (6, [
+        # Pliki trzymane są w DATA_DIR/files; wpisy sprzed tej wersji wskazują na
+        # dawno usunięte pliki tymczasowe, więc je sprzątamy.
+        "ALTER TABLE documents ADD COLUMN path TEXT",
+        "ALTER TABLE documents ADD COLUMN kind TEXT DEFAULT 'doc'",
+        "ALTER TABLE documents ADD COLUMN expires_at REAL",
+        "DELETE FROM doc_chunks WHERE doc_id IN (SELECT id FROM documents WHERE path IS NULL)",
+        "DELETE FROM documents WHERE path IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_documents_expires ON documents(expires_at)",
+        "CREATE INDEX IF NOT EXISTS idx_documents_path ON documents(path)",
+    ]),
+    (7, [
+        # Licznik zmian pamięci globalnej: procesy porównują go z wersją swojego
+        # cache profilu. Podbijają go triggery, więc łapie też import i ręczne zmiany.
+        "CREATE TABLE IF NOT EXISTS versions(name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)",
+        "INSERT OR IGNORE INTO versions(name, version) VALUES('memory', 0)",
+        """CREATE TRIGGER IF NOT EXISTS global_memory_ver_ai AFTER INSERT ON global_memory BEGIN
+            UPDATE versions SET version = version + 1 WHERE name = 'memory';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS global_memory_ver_au AFTER UPDATE ON global_memory BEGIN
+            UPDATE versions SET version = version + 1 WHERE name = 'memory';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS global_memory_ver_ad AFTER DELETE ON global_memory BEGIN
+            UPDATE versions SET version = version + 1 WHERE name = 'memory';
+        END""",
+    ]),
+    (8, [
+        # Indeksy pełnotekstowe pamięci i wiadomości (tylko kind='text'), synchronizowane triggerami.
+        """CREATE VIRTUAL TABLE IF NOT EXISTS memory_fts USING fts5(
+            key, value, content='global_memory', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )""",
+        "INSERT INTO memory_fts(memory_fts) VALUES('rebuild')",
+        """CREATE TRIGGER IF NOT EXISTS memory_fts_ai AFTER INSERT ON global_memory BEGIN
+            INSERT INTO memory_fts(rowid, key, value) VALUES (new.id, new.key, new.value);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS memory_fts_ad AFTER DELETE ON global_memory BEGIN
+            INSERT INTO memory_fts(memory_fts, rowid, key, value) VALUES ('delete', old.id, old.key, old.value);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS memory_fts_au AFTER UPDATE OF key, value ON global_memory BEGIN
+            INSERT INTO memory_fts(memory_fts, rowid, key, value) VALUES ('delete', old.id, old.key, old.value);
+            INSERT INTO memory_fts(rowid, key, value) VALUES (new.id, new.key, new.value);
+        END""",
+        """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )""",
+        "INSERT INTO messages_fts(rowid, content) SELECT id, content FROM messages WHERE COALESCE(kind, 'text') = 'text'",
+        """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages
+           WHEN COALESCE(new.kind, 'text') = 'text' BEGIN
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages
+           WHEN COALESCE(old.kind, 'text') = 'text' BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END""",
+    ]),
+    (9, [
+        # Klucze idempotencji /api/send: powtórzenie z tym samym kluczem dostaje zapisaną odpowiedź.
+        """CREATE TABLE IF NOT EXISTS send_keys(
+            key TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            response TEXT,
+            created_at REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_send_keys_created ON send_keys(created_at)",
+    ]),
+    (10, [
+        # Decyzja trybu model=auto przy odpowiedzi asystenta: {"model", "routed", "class", "reason"}.
+        "ALTER TABLE messages ADD COLUMN route TEXT",
+    ]),
+    (11, [
+        # Sesje dyktowania w bazie: segmenty i finish mogą trafić do różnych workerów.
+        """CREATE TABLE IF NOT EXISTS stt_sessions(
+            id TEXT PRIMARY KEY,
+            touched REAL NOT NULL
+        )""",
+        # text IS NULL = segment jeszcze w transkrypcji
+        """CREATE TABLE IF NOT EXISTS stt_segments(
+            session_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            text TEXT,
+            started_at REAL NOT NULL,
+            PRIMARY KEY(session_id, seq)
+        )""",
+    ]),
+    (12, [
+        # Deduplikacja importu pamięci (key, value, scope, created_at): bez indeksu każdy wiersz skanował tabelę.
+        "CREATE INDEX IF NOT EXISTS idx_memory_key_created ON global_memory(key, created_at)",
+    ]),
+]
+
+def migrate(conn):
+    ver = conn.execute("PRAGMA user_version").fetchone()[0]
+    for v, steps in MIGRATIONS:
+        if v <= ver:
+            continue
+        for step in steps:
+            if callable(step):
+                step(conn)
+            else:
+                conn.execute(step)
+        conn.execute(f"PRAGMA user_version={v}")
+        print(f"[db] migrated to v{v}")
+
 def ensure_schema():
-    with sqlite3.connect(DB_PATH) as conn:
+    # BEGIN IMMEDIATE: przy kilku workerach migruje jeden, reszta czeka i widzi gotowy schemat.
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
         conn.execute("""CREATE TABLE IF NOT EXISTS threads(
             id TEXT PRIMARY KEY, created_at TEXT, title TEXT, use_memory INTEGER DEFAULT 1
         )""")
@@ -162,31 +841,81 @@ def ensure_schema():
             conn.execute('ALTER TABLE documents ADD COLUMN mime TEXT')
         if "size" not in cols:
             conn.execute('ALTER TABLE documents ADD COLUMN size INTEGER')
-ensure_schema()
-
-def db():
-    return sqlite3.connect(DB_PATH)
-
-async def remove_temp_file(file_id: str, delay: int = TEMP_TTL):
-    await asyncio.sleep(delay)
-    info = TEMP_FILES.pop(file_id, None)
-    if not info:
-        return
+        migrate(conn)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+# Jedno połączenie na wątek, utrzymywane przez cały czas życia wątku (pula DB
+# z run_db ma stałą liczbę wątków, więc to jest de facto pula połączeń).
+_DB_LOCAL = threading.local()
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, cached_statements=SQLITE_STMT_CACHE)
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_BYTES}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+@contextlib.contextmanager
+def db(immediate: bool = False):
+    """Transakcja na połączeniu bieżącego wątku.
+
+    Najbardziej zewnętrzne ``with db()`` otwiera i zatwierdza transakcję;
+    zagnieżdżone wywołania działają jako SAVEPOINT w tej samej transakcji.
+    Domyślnie BEGIN DEFERRED, więc odczyty w WAL nie czekają na piszących.
+    ``immediate=True`` dla transakcji, które czytają, a potem piszą: odczyt
+    zamieniany w zapis w DEFERRED dostaje SQLITE_BUSY bez czekania, gdy w
+    międzyczasie pisał ktoś inny (inny wątek albo worker). Flaga działa tylko
+    na zewnętrzną transakcję. Wewnątrz ``with db()`` nie wolno robić ``yield``:
+    generator w StreamingResponse może wznowić się w innym wątku puli.
+    """
+    st = _DB_LOCAL
+    conn = getattr(st, "conn", None)
+    if conn is None:
+        conn = st.conn = _connect()
+        st.depth = 0
+    sp = f"sp{st.depth}"
+    conn.execute("SAVEPOINT " + sp if st.depth else ("BEGIN IMMEDIATE" if immediate else "BEGIN"))
+    st.depth += 1
     try:
-        info["path"].unlink(missing_ok=True)
-    except Exception:
-        pass
-    if info.get("doc"):
-        with db() as conn:
-            conn.execute("DELETE FROM documents WHERE id=?", (file_id,))
-
-
-async def remove_path(path, delay: int = TEMP_TTL):
-    await asyncio.sleep(delay)
+        yield conn
+    except BaseException:
+        st.depth -= 1
+        if st.depth:
+            conn.execute("ROLLBACK TO " + sp)
+            conn.execute("RELEASE " + sp)
+        else:
+            conn.execute("ROLLBACK")
+        raise
+    else:
+        st.depth -= 1
+        conn.execute("RELEASE " + sp if st.depth else "COMMIT")
+
+# Wszystkie wywołania SQLite z kodu async idą przez osobną pulę wątków, więc
+# nie blokują pętli zdarzeń ani puli wątków Starlette.
+_DB_EXECUTOR = None
+
+def db_executor() -> ThreadPoolExecutor:
+    global _DB_EXECUTOR
+    if _DB_EXECUTOR is None:
+        _DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+    return _DB_EXECUTOR
+
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    t0 = time.perf_counter()
     try:
-        pathlib.Path(path).unlink(missing_ok=True)
-    except Exception:
-        pass
+        # Kopia kontekstu, żeby etapy mierzone w wątku bazy trafiały do spanów żądania.
+        return await loop.run_in_executor(db_executor(), contextvars.copy_context().run,
+                                          functools.partial(fn, *args, **kwargs))
+    finally:
+        span_add("db", time.perf_counter() - t0)
 
 # -------------- MODELE -------------------------
 class SendReq(BaseModel):
@@ -196,11 +925,15 @@ class SendReq(BaseModel):
     use_memory: Optional[bool] = True
     model: Optional[str] = None
     files: List[str] = []
+    idempotency_key: Optional[str] = None  # albo nagłówek Idempotency-Key
 
 class SendResp(BaseModel):
     thread_id: str
     reply: str
     tokens: int
+    model: Optional[str] = None  # faktycznie użyty model (inny niż żądany po przełączeniu)
+    cached: bool = False
+    route: Optional[dict] = None  # decyzja trybu model=auto
 
 class RenameReq(BaseModel):
     thread_id: str
@@ -218,6 +951,7 @@ class ImageReq(BaseModel):
     thread_id: Optional[str] = None
     prompt: str
     size: Optional[str] = "1024x1024"
+    mode: Optional[str] = None  # "job" -> zwraca job_id zamiast czekać
 
 class AnchorReq(BaseModel):
     thread_id: str
@@ -260,36 +994,238 @@ def set_thread_use_memory(thread_id: str, use_memory: bool):
     with db() as conn:
         conn.execute("UPDATE threads SET use_memory=? WHERE id=?", (1 if use_memory else 0, thread_id))
 
-def delete_thread(thread_id: str):
+def delete_thread(thread_id: str) -> bool:
     with db() as conn:
         conn.execute("DELETE FROM messages WHERE thread_id=?", (thread_id,))
-        conn.execute("DELETE FROM threads WHERE id=?", (thread_id,))
+        conn.execute("DELETE FROM thread_summaries WHERE thread_id=?", (thread_id,))
+        found = conn.execute("DELETE FROM threads WHERE id=?", (thread_id,)).rowcount == 1
         conn.execute("DELETE FROM anchors WHERE thread_id=?", (thread_id,))
-
-def add_msg(thread_id: str, role: str, content: str, kind: str = "text"):
+    if not found:
+        return False
+    for f in _pdf_exports(thread_id):
+        f.unlink(missing_ok=True)
+    return True
+
+def _pdf_exports(thread_id: str) -> List[pathlib.Path]:
+    """Zapisane eksporty PDF wątku; id porównywane dokładnie (bez globa na danych z URL-a)."""
+    if not EXPORT_DIR.is_dir():
+        return []
+    return [f for f in EXPORT_DIR.iterdir()
+            if f.suffix == ".pdf" and f.name[:-4].rsplit("-", 2)[0] == thread_id]
+
+def count_tokens(text: str) -> int:
+    """Przybliżona liczba tokenów (~4 znaki/token + narzut wiadomości).
+
+    Ten sam wzór liczy migracja v2 w SQL, więc wartości w kolumnie są spójne.
+    """
+    return (len(text or "") + 3) // 4 + 4
+
+def add_msg(thread_id: str, role: str, content: str, kind: str = "text") -> int:
     with db() as conn:
-        conn.execute("INSERT INTO messages(thread_id,role,content,kind,created_at) VALUES(?,?,?,?,?)",
-            (thread_id, role, content, kind, datetime.now(timezone.utc).isoformat()))
-
-def get_thread_messages(thread_id: str):
+        cur = conn.execute("INSERT INTO messages(thread_id,role,content,kind,created_at,tokens) VALUES(?,?,?,?,?,?)",
+            (thread_id, role, content, kind, datetime.now(timezone.utc).isoformat(), count_tokens(content)))
+        return cur.lastrowid
+
+def _msg_row(row) -> dict:
+    (i, r, c, k, t, route) = row
+    d = {"id": i, "role": r, "content": c, "kind": k, "at": t}
+    if route:
+        d["route"] = json.loads(route)
+    return d
+
+def get_messages_page(thread_id: str, before_id: Optional[int] = None, limit: int = PAGE_MESSAGES) -> Optional[dict]:
+    """Strona historii (rosnąco po id) kończąca się przed ``before_id``; ``next`` to kursor starszej strony.
+
+    ``turn_offset`` = liczba tur użytkownika przed pierwszą wiadomością strony (numeracja #n w UI).
+    """
     with db() as conn:
-        cur = conn.execute("SELECT id, role, content, kind, created_at FROM messages WHERE thread_id=? ORDER BY id", (thread_id,))
-        return [{"id": i, "role": r, "content": c, "kind": k, "at": t} for (i,r,c,k,t) in cur.fetchall()]
-
-def get_history_for_model(thread_id: str, limit: int = 60) -> List[dict]:
+        th = conn.execute("SELECT COALESCE(NULLIF(title,''), id), use_memory FROM threads WHERE id=?",
+                          (thread_id,)).fetchone()
+        if not th:
+            return None
+        rows = conn.execute("SELECT id, role, content, kind, created_at, route FROM messages WHERE thread_id=? AND id<? "
+                            "ORDER BY id DESC LIMIT ?", (thread_id, before_id or 2**62, limit + 1)).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit][::-1]
+        offset = conn.execute("SELECT COUNT(*) FROM messages WHERE thread_id=? AND id<? AND role='user' AND kind='text'",
+                              (thread_id, rows[0][0] if rows else 0)).fetchone()[0] if rows else 0
+    return {"thread": {"id": thread_id, "title": th[0], "use_memory": bool(th[1])},
+            "items": [_msg_row(r) for r in rows], "turn_offset": offset,
+            "next": rows[0][0] if more else None}
+
+def iter_thread_messages(thread_id: str, upto_id: int, batch: int = PDF_BATCH):
+    """Wiadomości wątku do ``upto_id`` włącznie, czytane partiami po id (bez całej historii w pamięci)."""
+    last = 0
+    while True:
+        with db() as conn:
+            rows = conn.execute("SELECT id, role, content, kind, created_at, route FROM messages "
+                                "WHERE thread_id=? AND id>? AND id<=? ORDER BY id LIMIT ?",
+                                (thread_id, last, upto_id, batch)).fetchall()
+        for r in rows:
+            yield _msg_row(r)
+        if len(rows) < batch:
+            return
+        last = rows[-1][0]
+
+def get_history_for_model(thread_id: str, budget: int, keep_from_id: int = 0) -> dict:
+    """Najnowsza historia wątku mieszcząca się w ``budget`` tokenów.
+
+    Wiadomości starsze niż zapisane podsumowanie są pomijane (zastępuje je
+    podsumowanie). Wiadomości o id >= ``keep_from_id`` trafiają zawsze.
+    ``summarize_upto`` > 0 oznacza, że historia się nie zmieściła i wszystko
+    do tego id należy dołożyć do podsumowania.
+    """
     with db() as conn:
+        row = conn.execute("SELECT upto_id, summary, tokens FROM thread_summaries WHERE thread_id=?",
+                           (thread_id,)).fetchone()
+        upto, summary, sum_tokens = row if row else (0, "", 0)
+        budget -= sum_tokens or 0
+        keep_budget = int(budget * CONTEXT_KEEP_SHARE)
         cur = conn.execute(
-            "SELECT role, content, kind FROM messages WHERE thread_id=? ORDER BY id DESC LIMIT ?",
-            (thread_id, limit)
-        )
-        rows = list(reversed(cur.fetchall()))
+            "SELECT id, role, content, kind, tokens FROM messages "
+            "WHERE thread_id=? AND id>? AND kind IN ('text','search') ORDER BY id DESC",
+            (thread_id, upto))
+        rows, used, keep_id, overflow = [], 0, None, False
+        for (i, role, content, kind, tok) in cur:
+            tok = tok if tok is not None else count_tokens(content)
+            if used + tok > budget and i < keep_from_id:
+                overflow = True
+                break
+            used += tok
+            if used > keep_budget and keep_id is None and i < keep_from_id:
+                keep_id = i
+            rows.append((role, content, kind))
     msgs = []
-    for (role, content, kind) in rows:
+    for (role, content, kind) in reversed(rows):
         if kind == "text":
             msgs.append({"role": role, "content": content})
         elif kind == "search":
             msgs.append({"role": "system", "content": content})
-    return msgs
+    return {"messages": msgs, "summary": summary or "",
+            "summarize_upto": keep_id if overflow and keep_id else 0}
+
+def _clip_tokens(text: str, max_tokens: int) -> str:
+    limit = max(max_tokens - 4, 0) * 4
+    return text if len(text) <= limit else text[:limit] + "\n[…obcięto]"
+
+def build_context(thread_id: str, model: str, system_prompt: str, file_blocks: List[str],
+                  keep_from_id: int) -> dict:
+    """Składa listę ``messages`` w budżecie tokenów modelu.
+
+    Kolejność: prompt systemowy (z profilem pamięci), podsumowanie starszej
+    części wątku, historia, bloki plików, bieżące wiadomości tury.
+    """
+    budget = CONTEXT_BUDGET.get(model, CONTEXT_BUDGET_DEFAULT) - count_tokens(system_prompt)
+    files_budget = int(CONTEXT_BUDGET.get(model, CONTEXT_BUDGET_DEFAULT) * CONTEXT_FILES_SHARE)
+    clipped = []
+    for block in file_blocks:
+        block = _clip_tokens(block, max(files_budget // max(len(file_blocks), 1), 0))
+        clipped.append(block)
+        budget -= count_tokens(block)
+    hist = get_history_for_model(thread_id, budget, keep_from_id)
+    history = hist["messages"]
+    messages = [{"role": "system", "content": system_prompt}]
+    if hist["summary"]:
+        messages.append({"role": "system", "content": "Podsumowanie wcześniejszej części rozmowy:\n" + hist["summary"]})
+    # Bloki plików wstawiamy przed wiadomościami bieżącej tury (użytkownik + wyniki wyszukiwania).
+    cut = len(history)
+    while cut > 0 and history[cut - 1]["role"] != "user":
+        cut -= 1
+    cut = max(cut - 1, 0)
+    messages += history[:cut]
+    messages += [{"role": "system", "content": b} for b in clipped]
+    messages += history[cut:]
+    return {"messages": messages, "summarize_upto": hist["summarize_upto"]}
+
+# -------------- UTIL: SUMMARY ------------------
+_SUMMARY_RUNNING = set()
+_BG_TASKS = set()
+
+def spawn(coro):
+    """Uruchamia zadanie w tle i trzyma do niego referencję do końca."""
+    task = asyncio.get_running_loop().create_task(coro)
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+    return task
+
+class KeyedLock:
+    """asyncio.Lock per klucz. Wpis żyje, dopóki ktoś trzyma blokadę albo na nią czeka (licznik),
+    więc czekający i nowy chętny zawsze dostają tę samą blokadę."""
+
+    def __init__(self):
+        self.locks = {}  # klucz -> [Lock, liczba trzymających i czekających]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self.locks.pop(key, None)
+
+def _summary_batch(thread_id: str, upto_id: int):
+    with db() as conn:
+        row = conn.execute("SELECT upto_id, summary FROM thread_summaries WHERE thread_id=?", (thread_id,)).fetchone()
+        prev_upto, prev = row if row else (0, "")
+        cur = conn.execute(
+            "SELECT id, role, content, tokens FROM messages "
+            "WHERE thread_id=? AND id>? AND id<=? AND kind='text' ORDER BY id",
+            (thread_id, prev_upto, upto_id))
+        batch, used, last_id = [], 0, prev_upto
+        for (i, role, content, tok) in cur:
+            if batch and used + (tok or 0) > SUMMARY_BATCH_TOKENS:
+                break
+            batch.append(f"{role}: {_clip_tokens(content or '', SUMMARY_BATCH_TOKENS // 2)}")
+            used += tok or 0
+            last_id = i
+    return prev or "", batch, last_id
+
+def _summary_store(thread_id: str, upto_id: int, summary: str):
+    with db() as conn:
+        conn.execute(
+            "INSERT INTO thread_summaries(thread_id, upto_id, summary, tokens, updated_at) VALUES(?,?,?,?,?) "
+            "ON CONFLICT(thread_id) DO UPDATE SET upto_id=excluded.upto_id, summary=excluded.summary, "
+            "tokens=excluded.tokens, updated_at=excluded.updated_at",
+            (thread_id, upto_id, summary, count_tokens(summary), datetime.now(timezone.utc).isoformat()))
+
+async def update_thread_summary(thread_id: str, upto_id: int):
+    """Dokłada wiadomości do ``upto_id`` do kroczącego podsumowania wątku.
+
+    Podsumowanie jest aktualizowane przyrostowo (stare podsumowanie + nowe
+    wiadomości), partiami po SUMMARY_BATCH_TOKENS.
+    """
+    if thread_id in _SUMMARY_RUNNING:
+        return
+    _SUMMARY_RUNNING.add(thread_id)
+    try:
+        while True:
+            prev, batch, last_id = await run_db(_summary_batch, thread_id, upto_id)
+            if not batch:
+                return
+            prompt = [
+                {"role": "system", "content":
+                    "You maintain a running summary of a conversation. Merge the previous summary with the new "
+                    "messages into one concise summary (max ~300 words) in the conversation's language. Keep "
+                    "facts, decisions, names, numbers and open questions; drop pleasantries."},
+                {"role": "user", "content": f"Previous summary:\n{prev or '(none)'}\n\nNew messages:\n" + "\n".join(batch)},
+            ]
+            resp, model = await upstream("responses", MODEL_SUMMARY,
+                                     lambda m: client.responses.create(model=m, input=prompt), failover=True)
+            record_usage(model, resp)
+            summary = (getattr(resp, "output_text", None) or "").strip()
+            if not summary:
+                return
+            await run_db(_summary_store, thread_id, last_id, summary)
+            if last_id >= upto_id:
+                return
+    except Exception as e:
+        print(f"[summary] {thread_id}: {e}")
+    finally:
+        _SUMMARY_RUNNING.discard(thread_id)
 
 # -------------- UTIL: ANCHORS ------------------
 def anchors_get(thread_id: str):
@@ -348,50 +1284,230 @@ def mem_restore(id_: int):
         conn.execute("UPDATE global_memory SET is_active=1, updated_at=? WHERE id=?",
                      (datetime.now(timezone.utc).isoformat(), id_))
 
+_MEM_PROFILE = {"version": None, "text": ""}
+_MEM_SCOPES = [("style", "Preferencje stylu", 3), ("voice", "Preferencje głosu", 3),
+               ("facts", "Fakty", 2), ("other", "Inne", 1)]
+
+def _mem_profile_build(rows) -> str:
+    """Najważniejsze wpisy w budżecie MEM_PROFILE_CHARS: najpierw zakres (styl/głos > fakty > inne),
+    potem świeżość. Wpis, który się nie mieści, jest pomijany w całości (zamiast ucinać tekst)."""
+    weight = {sc: w for sc, _, w in _MEM_SCOPES}
+    ranked = sorted(rows, key=lambda r: (weight.get(r[1], 1), r[2] or ""), reverse=True)
+    picked, seen, used = {sc: [] for sc, _, _ in _MEM_SCOPES}, set(), 0
+    for value, scope, _ in ranked:
+        value = " ".join((value or "").split())
+        scope = scope if scope in picked else "other"
+        if not value or value.lower() in seen:
+            continue
+        label = next(lbl for sc, lbl, _ in _MEM_SCOPES if sc == scope)
+        cost = len(value) + (2 if picked[scope] else len(label) + 3)
+        if used + cost > MEM_PROFILE_CHARS:
+            continue
+        seen.add(value.lower())
+        picked[scope].append(value)
+        used += cost
+    return "\n".join(f"{lbl}: " + "; ".join(picked[sc]) for sc, lbl, _ in _MEM_SCOPES if picked[sc])
+
 def mem_profile_snippet() -> str:
-    active = mem_list(active=True)
-    if not active: return ""
-    parts = {"style": [], "voice": [], "facts": [], "other": []}
-    for m in active:
-        parts.get(m["scope"] if m["scope"] in parts else "other").append(m["value"])
-    def join(key, arr):
-        return f"{key}: " + "; ".join(arr) if arr else ""
-    lines = [join("Preferencje stylu", parts["style"]),
-             join("Preferencje głosu", parts["voice"]),
-             join("Fakty", parts["facts"]),
-             join("Inne", parts["other"])]
-    snippet = "\n".join([l for l in lines if l])[:800]
-    return snippet
+    """Profil z cache procesu; przebudowa tylko, gdy zmienił się licznik 'memory' w tabeli versions."""
+    with db() as conn:
+        ver = conn.execute("SELECT version FROM versions WHERE name='memory'").fetchone()[0]
+        if _MEM_PROFILE["version"] == ver:
+            return _MEM_PROFILE["text"]
+        rows = conn.execute("SELECT value, scope, updated_at FROM global_memory WHERE is_active=1").fetchall()
+    text = _mem_profile_build(rows)
+    _MEM_PROFILE.update(version=ver, text=text)
+    return text
 
 def mem_forget_by_phrase(phrase: str):
-    phrase = phrase.strip().lower()
-    if not phrase: return []
-    cands = []
-    for m in mem_list(active=True):
-        hay = f"{(m['key'] or '').lower()} {m['value'].lower()}"
-        if phrase in hay:
-            cands.append(m)
+    q = _fts_query(phrase, op="AND")
+    if not q: return []
+    with db() as conn:
+        cands = conn.execute(
+            "SELECT m.id, m.key, m.value FROM memory_fts JOIN global_memory m ON m.id = memory_fts.rowid "
+            "WHERE memory_fts MATCH ? AND m.is_active=1 ORDER BY bm25(memory_fts) LIMIT 20", (q,)).fetchall()
     if len(cands) == 1:
-        mem_forget(cands[0]["id"])
-        return [{"id": cands[0]["id"], "status": "forgotten"}]
+        mem_forget(cands[0][0])
+        return [{"id": cands[0][0], "status": "forgotten"}]
     else:
-        return [{"id": x["id"], "key": x["key"], "value": x["value"]} for x in cands]
+        return [{"id": i, "key": k, "value": v} for (i, k, v) in cands]
+
+# -------------- UTIL: WYSZUKIWANIE (FTS5) ------
+_HL_OPEN, _HL_CLOSE = "\ue000", "\ue001"
+
+def _highlight(snippet: str) -> str:
+    """HTML-bezpieczny fragment z trafieniami w <mark> (znaczniki wstawia FTS jako znaki prywatne)."""
+    import html
+    return html.escape(snippet or "").replace(_HL_OPEN, "<mark>").replace(_HL_CLOSE, "</mark>")
+
+def search_all(text: str, scope: str = "all", limit: int = 20, offset: int = 0) -> dict:
+    """Wyniki z wiadomości i pamięci uszeregowane wg BM25 (oba indeksy mają ten sam tokenizer)."""
+    q = _fts_query(text, op="AND", prefix=True)
+    if not q:
+        return {"items": [], "next": None}
+    want = offset + limit + 1
+    hits = []
+    with db() as conn:
+        if scope in ("all", "messages"):
+            for (mid, tid, title, role, at, snip, rank) in conn.execute(
+                    "SELECT m.id, m.thread_id, COALESCE(NULLIF(t.title,''), m.thread_id), m.role, m.created_at, "
+                    f"snippet(messages_fts, 0, '{_HL_OPEN}', '{_HL_CLOSE}', '…', 16), bm25(messages_fts) "
+                    "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                    "LEFT JOIN threads t ON t.id = m.thread_id "
+                    "WHERE messages_fts MATCH ? ORDER BY bm25(messages_fts) LIMIT ?", (q, want)):
+                hits.append((rank, {"type": "message", "id": mid, "thread_id": tid, "thread_title": title,
+                                    "role": role, "at": at, "snippet": _highlight(snip)}))
+        if scope in ("all", "memory"):
+            for (mid, key, sc, active, snip, rank) in conn.execute(
+                    "SELECT m.id, m.key, m.scope, m.is_active, "
+                    f"snippet(memory_fts, -1, '{_HL_OPEN}', '{_HL_CLOSE}', '…', 16), bm25(memory_fts) "
+                    "FROM memory_fts JOIN global_memory m ON m.id = memory_fts.rowid "
+                    "WHERE memory_fts MATCH ? ORDER BY bm25(memory_fts) LIMIT ?", (q, want)):
+                hits.append((rank, {"type": "memory", "id": mid, "key": key, "scope": sc, "is_active": bool(active),
+                                    "snippet": _highlight(snip)}))
+    hits.sort(key=lambda h: h[0])
+    page = [h[1] for h in hits[offset:offset + limit]]
+    return {"items": page, "next": offset + limit if len(hits) > offset + limit else None}
 
 # -------------- UTIL: SEARCH -------------------
-def web_search(query: str, n: int = 5) -> List[dict]:
+class TTLCache:
+    """Mały cache LRU w pamięci z czasem życia wpisów."""
+
+    def __init__(self, ttl: float, maxsize: int = 512):
+        self.ttl, self.maxsize = ttl, maxsize
+        self.data = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        item = self.data.get(key)
+        if item is None or item[0] < time.monotonic():
+            self.data.pop(key, None)
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"size": len(self.data), "hits": self.hits, "misses": self.misses}
+
+SEARCH_CACHE = TTLCache(SEARCH_CACHE_TTL)
+PAGE_CACHE = TTLCache(PAGE_CACHE_TTL, 256)
+_HTTP = None
+
+def http_client() -> httpx.AsyncClient:
+    """Współdzielona pula połączeń do pobierania stron (osobna od klienta OpenAI)."""
+    global _HTTP
+    if _HTTP is None:
+        _HTTP = httpx.AsyncClient(
+            follow_redirects=True, timeout=httpx.Timeout(WEB_FETCH_DEADLINE, connect=2.0),
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            headers={"User-Agent": "Mozilla/5.0"},
+        )
+    return _HTTP
+
+def _ddg_search(query: str, n: int) -> List[dict]:
+    from duckduckgo_search import DDGS
     out = []
     with DDGS() as ddgs:
         for r in ddgs.text(query, max_results=n, safesearch="moderate", region="wt-wt"):
             out.append({"title": r.get("title",""), "url": r.get("href",""), "snippet": r.get("body","")})
     return out
 
-def fetch_url_preview(url: str, timeout: float = 6.0) -> str:
-    try:
-        r = requests.get(url, timeout=timeout, headers={"User-Agent":"Mozilla/5.0"})
+async def web_search(query: str, n: int = 5) -> List[dict]:
+    key = (" ".join(query.lower().split()), n)
+    hit = SEARCH_CACHE.get(key)
+    if hit is not None:
+        return [dict(r) for r in hit]
+    if SEARCH_BACKEND_URL:
+        r = await http_client().get(SEARCH_BACKEND_URL, params={"q": query, "n": n})
         r.raise_for_status()
-        return r.text[:800]
-    except:
+        out = r.json()[:n]
+    else:
+        out = await run_in_threadpool(_ddg_search, query, n)
+    SEARCH_CACHE.set(key, out)
+    return [dict(r) for r in out]
+
+class _TextExtractor(HTMLParser):
+    SKIP = {"script", "style", "noscript", "head", "nav", "footer", "header", "svg", "form", "aside", "template"}
+    BLOCK = {"p", "div", "br", "li", "h1", "h2", "h3", "h4", "h5", "h6", "tr", "section", "article", "pre"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts, self.skip = [], 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skip += 1
+        elif tag in self.BLOCK:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self.skip:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(data)
+
+def html_to_text(html: str) -> str:
+    p = _TextExtractor()
+    try:
+        p.feed(html)
+        p.close()
+    except Exception:
+        pass
+    lines = (" ".join(l.split()) for l in "".join(p.parts).splitlines())
+    return "\n".join(l for l in lines if len(l) > 1)
+
+async def fetch_url_preview(url: str) -> str:
+    hit = PAGE_CACHE.get(url)
+    if hit is not None:
+        return hit
+    text = ""
+    try:
+        async with http_client().stream("GET", url) as r:
+            r.raise_for_status()
+            ctype = r.headers.get("content-type", "")
+            if "html" in ctype or "text/plain" in ctype:
+                body = bytearray()
+                async for chunk in r.aiter_bytes():
+                    body += chunk
+                    if len(body) >= WEB_MAX_PAGE_BYTES:
+                        break
+                raw = body.decode(r.encoding or "utf-8", errors="ignore")
+                text = raw if "text/plain" in ctype else await run_in_threadpool(html_to_text, raw)
+                text = text[:WEB_PREVIEW_CHARS]
+    except Exception:
         return ""
+    PAGE_CACHE.set(url, text)
+    return text
+
+async def fetch_previews(urls: List[str], deadline: float = WEB_FETCH_DEADLINE) -> dict:
+    """Pobiera strony równolegle; co nie zdąży przed ``deadline``, jest pomijane."""
+    tasks = {asyncio.ensure_future(fetch_url_preview(u)): u for u in urls if u}
+    if not tasks:
+        return {}
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for t in pending:
+        t.cancel()
+    return {tasks[t]: t.result() for t in done if not t.exception() and t.result()}
+
+async def web_context(query: str, n: int = 5) -> str:
+    with span("web_search"):
+        results = await web_search(query, n)
+    with span("web_fetch"):
+        previews = await fetch_previews([r["url"] for r in results[:WEB_FETCH_TOP]])
+    for r in results:
+        if previews.get(r["url"]):
+            r["snippet"] += f"\n[preview]\n{previews[r['url']]}"
+    return format_sources_block(results)
 
 def format_sources_block(results: List[dict]) -> str:
     if not results: return "Brak wyników wyszukiwania."
@@ -400,125 +1516,631 @@ def format_sources_block(results: List[dict]) -> str:
         lines.append(f"{i}. {r['title']} — {r['url']}\n   {r['snippet']}")
     return "\n".join(lines)
 
+# -------------- UTIL: CACHE EKSTRAKCJI ---------
+EXTRACT_CACHE_STATS = {"hits": 0, "misses": 0}
+
+def file_sha256(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def extract_cache_get(key: str) -> Optional[str]:
+    with db(immediate=True) as conn:
+        row = conn.execute("SELECT text FROM extract_cache WHERE key=?", (key,)).fetchone()
+        if row:
+            conn.execute("UPDATE extract_cache SET last_used=? WHERE key=?", (time.time(), key))
+    EXTRACT_CACHE_STATS["hits" if row else "misses"] += 1
+    return row[0] if row else None
+
+def extract_cache_put(key: str, text: str):
+    """Zapisuje wynik i usuwa najdawniej używane wpisy ponad EXTRACT_CACHE_MAX_BYTES."""
+    now = time.time()
+    with db() as conn:
+        conn.execute("INSERT OR REPLACE INTO extract_cache(key, text, size, created_at, last_used) VALUES(?,?,?,?,?)",
+                     (key, text, len(text.encode("utf-8")), datetime.now(timezone.utc).isoformat(), now))
+        conn.execute("""DELETE FROM extract_cache WHERE key IN (
+            SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS run FROM extract_cache)
+            WHERE run > ?)""", (EXTRACT_CACHE_MAX_BYTES,))
+
+def _doc_sha256(doc_id: str, info: dict) -> str:
+    sha = info.get("sha256")
+    if not sha:
+        sha = info["sha256"] = file_sha256(info["path"])
+        with db() as conn:
+            conn.execute("UPDATE documents SET sha256=? WHERE id=?", (sha, doc_id))
+    return sha
+
+def extract_cache_key(kind: str, sha: str, **params) -> str:
+    extra = ":".join(f"{k}={params[k]}" for k in sorted(params))
+    return f"v{EXTRACT_CACHE_VERSION}:{kind}:{sha}:{extra}"
+
+# -------------- UTIL: DOKUMENTY (fragmenty + FTS5) -
+_INDEX_LOCKS = KeyedLock()
+
+def chunk_text(text: str, max_tokens: int = DOC_CHUNK_TOKENS) -> List[str]:
+    """Dzieli tekst na fragmenty po akapitach, nie dłuższe niż ~max_tokens."""
+    limit = max_tokens * 4
+    paras = [p.strip() for p in re.split(r"\n\s*\n", text or "") if p.strip()]
+    chunks, cur = [], ""
+    for p in paras:
+        while len(p) > limit:
+            cut = p.rfind(" ", 0, limit)
+            cut = cut if cut > limit // 2 else limit
+            head, p = p[:cut], p[cut:].lstrip()
+            if cur:
+                chunks.append(cur); cur = ""
+            chunks.append(head)
+        if cur and len(cur) + len(p) + 2 > limit:
+            chunks.append(cur); cur = ""
+        cur = f"{cur}\n\n{p}" if cur else p
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+def _store_chunks(doc_id: str, chunks: List[str]):
+    with db(immediate=True) as conn:
+        if not conn.execute("SELECT 1 FROM documents WHERE id=?", (doc_id,)).fetchone():
+            return
+        conn.execute("DELETE FROM doc_chunks WHERE doc_id=?", (doc_id,))
+        conn.executemany("INSERT INTO doc_chunks(doc_id, seq, content, tokens) VALUES(?,?,?,?)",
+                         [(doc_id, i, c, count_tokens(c)) for i, c in enumerate(chunks)])
+        conn.execute("UPDATE documents SET chunks=? WHERE id=?", (len(chunks), doc_id))
+
+def _doc_chunk_count(doc_id: str) -> Optional[int]:
+    with db() as conn:
+        row = conn.execute("SELECT chunks FROM documents WHERE id=?", (doc_id,)).fetchone()
+    return row[0] if row else None
+
+async def index_document(doc_id: str) -> int:
+    """Parsuje dokument raz i zapisuje jego fragmenty w doc_chunks (z indeksem FTS5)."""
+    async with _INDEX_LOCKS.hold(doc_id):
+        n = await run_db(_doc_chunk_count, doc_id)
+        if n is not None:
+            return n
+        text = (await run_job("text", {"doc_id": doc_id})).get("text", "")
+        chunks = chunk_text(text)
+        await run_db(_store_chunks, doc_id, chunks)
+    return len(chunks)
+
+def _fts_query(text: str, max_terms: int = 32, op: str = "OR", prefix: bool = False) -> str:
+    """Zapytanie FTS5 (domyślnie OR); dłuższe słowa jako prefiksy (prosta obsługa fleksji).
+
+    ``prefix=True`` robi prefiks z każdego słowa (wyszukiwarka: "kot" znajduje "kota").
+    """
+    terms = []
+    for t in re.findall(r"\w{2,}", (text or "").lower()):
+        t = f'"{t[:-2]}"*' if len(t) >= 6 else (f'"{t}"*' if prefix else f'"{t}"')
+        if t not in terms:
+            terms.append(t)
+    return f" {op} ".join(terms[:max_terms])
+
+def doc_file_blocks(doc_ids: List[str], query: str, k: int = DOC_TOP_K) -> List[str]:
+    """Bloki systemowe z fragmentami dokumentów najlepiej pasującymi do ``query`` (BM25)."""
+    blocks = []
+    q = _fts_query(query)
+    with db() as conn:
+        for doc_id in doc_ids:
+            row = conn.execute("SELECT orig_name FROM documents WHERE id=?", (doc_id,)).fetchone()
+            if not row:
+                continue
+            total, tokens = conn.execute("SELECT COUNT(*), COALESCE(SUM(tokens),0) FROM doc_chunks WHERE doc_id=?",
+                                         (doc_id,)).fetchone()
+            if not total:
+                continue
+            if tokens <= DOC_SMALL_TOKENS:
+                picked = conn.execute("SELECT seq, content FROM doc_chunks WHERE doc_id=? ORDER BY seq",
+                                      (doc_id,)).fetchall()
+            else:
+                picked = []
+                if q:
+                    picked = conn.execute(
+                        "SELECT c.seq, c.content FROM doc_chunks_fts JOIN doc_chunks c ON c.id = doc_chunks_fts.rowid "
+                        "WHERE doc_chunks_fts MATCH ? AND c.doc_id=? ORDER BY bm25(doc_chunks_fts) LIMIT ?",
+                        (q, doc_id, k)).fetchall()
+                if not picked:
+                    picked = conn.execute("SELECT seq, content FROM doc_chunks WHERE doc_id=? ORDER BY seq LIMIT ?",
+                                          (doc_id, k)).fetchall()
+                picked.sort()
+            head = f"Plik: {row[0]}" + ("" if len(picked) == total else f" — fragmenty {len(picked)} z {total}")
+            blocks.append(head + "\n\n" + "\n\n".join(f"[#{seq + 1}] {c}" if len(picked) != total else c
+                                                          for seq, c in picked))
+    return blocks
+
 # -------------- HANDLERY BŁĘDÓW ---------------
-@app.exception_handler(Exception)
 async def all_exception_handler(request: Request, exc: Exception):
     return JSONResponse(status_code=500, content={"detail": f"{exc.__class__.__name__}: {exc}"})
 
 # -------------- ENDPOINTY: THREADS ------------
-@app.post("/api/new_thread")
+@router.post("/api/new_thread")
 def api_new_thread():
     return {"thread_id": new_thread()}
 
-@app.post("/api/rename_thread")
+@router.post("/api/rename_thread")
 def api_rename_thread(req: RenameReq):
     set_thread_title(req.thread_id, req.title.strip()[:120])
     return {"ok": True}
 
-@app.post("/api/thread/use_memory")
+@router.post("/api/thread/use_memory")
 def api_thread_use_memory(req: ToggleMemReq):
     set_thread_use_memory(req.thread_id, req.use_memory)
     return {"ok": True}
 
-@app.get("/api/threads")
-def list_threads():
+def get_threads(before: Optional[str] = None, limit: int = PAGE_THREADS) -> dict:
+    """Wątki z wiadomościami, od najnowszych; kursor ``before`` = "created_at|id" ostatniego wpisu strony."""
+    at, _, tid = (before or "").partition("|")
+    where, args = ("(created_at, id) < (?, ?) AND ", [at, tid]) if at else ("", [])
     with db() as conn:
-        cur = conn.execute("SELECT id, created_at, COALESCE(NULLIF(title,''), id), use_memory FROM threads ORDER BY created_at DESC")
-        return [{"id": i, "created_at": t, "title": ttl, "use_memory": bool(um)} for (i,t,ttl,um) in cur.fetchall()]
+        cur = conn.execute(
+            "SELECT id, created_at, COALESCE(NULLIF(title,''), id), use_memory FROM threads t "
+            f"WHERE {where}EXISTS (SELECT 1 FROM messages m WHERE m.thread_id = t.id) "
+            "ORDER BY created_at DESC, id DESC LIMIT ?", (*args, limit + 1))
+        rows = cur.fetchall()
+    items = [{"id": i, "created_at": t, "title": ttl, "use_memory": bool(um)} for (i,t,ttl,um) in rows[:limit]]
+    nxt = f"{items[-1]['created_at']}|{items[-1]['id']}" if len(rows) > limit else None
+    return {"items": items, "next": nxt}
 
-@app.get("/api/thread/{thread_id}")
-def api_thread(thread_id: str):
-    return get_thread_messages(thread_id)
+def sweep_empty_threads() -> int:
+    cutoff = datetime.fromtimestamp(time.time() - EMPTY_THREAD_TTL, timezone.utc).isoformat()
+    with db() as conn:
+        cur = conn.execute("DELETE FROM threads WHERE created_at < ? "
+                           "AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.thread_id = threads.id)", (cutoff,))
+        return cur.rowcount
+
+@router.get("/api/threads")
+async def list_threads(before: Optional[str] = None, limit: int = PAGE_THREADS):
+    return await run_db(get_threads, before, max(1, min(limit, 200)))
+
+@router.get("/api/thread/{thread_id}")
+async def api_thread(thread_id: str, before_id: Optional[int] = None, limit: int = PAGE_MESSAGES):
+    page = await run_db(get_messages_page, thread_id, before_id, max(1, min(limit, 500)))
+    if page is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    return page
 
-@app.delete("/api/thread/{thread_id}")
+@router.delete("/api/thread/{thread_id}")
 def api_delete_thread(thread_id: str):
-    delete_thread(thread_id)
+    if not delete_thread(thread_id):
+        raise HTTPException(status_code=404, detail="Not found")
     return {"ok": True}
 
-def create_pdf(thread_id: str) -> pathlib.Path:
-    msgs = get_thread_messages(thread_id)
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-    fpath = pathlib.Path(tmp.name)
-    c = canvas.Canvas(str(fpath))
-    width, height = c._pagesize
-    textobj = c.beginText(40, height - 40)
-    for m in msgs:
-        textobj.textLine(f"{m['role']}: ")
-        for line in (m['content'] or '').splitlines():
-            textobj.textLine('  ' + line)
-        textobj.textLine('')
-    c.drawText(textobj)
-    c.save()
-    return fpath
-
-@app.get("/api/thread/{thread_id}/pdf")
-def thread_pdf(thread_id: str, background: BackgroundTasks):
-    fpath = create_pdf(thread_id)
-    background.add_task(remove_path, fpath)
-    return FileResponse(fpath, media_type="application/pdf", filename=f"{thread_id}.pdf")
+# -------------- EKSPORT PDF -------------------
+_PDF_FONTS = None
+_PDF_LOCKS = KeyedLock()
+
+def _pdf_fonts() -> dict:
+    """DejaVu (polskie znaki), jeśli jest w systemie; inaczej wbudowane fonty reportlab."""
+    global _PDF_FONTS
+    if _PDF_FONTS is None:
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        base = pathlib.Path(os.environ.get("CHEAPCHAT_PDF_FONT_DIR", "/usr/share/fonts/truetype/dejavu"))
+        files = {"body": "DejaVuSans.ttf", "bold": "DejaVuSans-Bold.ttf", "mono": "DejaVuSansMono.ttf"}
+        try:
+            for name, fname in files.items():
+                pdfmetrics.registerFont(TTFont(f"cc-{name}", str(base / fname)))
+            _PDF_FONTS = {name: f"cc-{name}" for name in files}
+        except Exception:
+            _PDF_FONTS = {"body": "Helvetica", "bold": "Helvetica-Bold", "mono": "Courier"}
+    return _PDF_FONTS
+
+def _md_blocks(text: str):
+    """Prosty podział markdownu na bloki: (rodzaj, tekst, wcięcie) dla nagłówków, list, kodu i akapitów."""
+    in_code, para = False, []
+    def flush():
+        if para:
+            yield "p", " ".join(para), 0
+            para.clear()
+    for line in (text or "").splitlines():
+        if line.lstrip().startswith("```"):
+            yield from flush()
+            in_code = not in_code
+            continue
+        if in_code:
+            yield "code", line.expandtabs(4), 0
+            continue
+        stripped = line.strip()
+        inline = re.sub(r"(\*\*|__|`)", "", stripped)
+        inline = re.sub(r"\[([^\]]+)\]\(([^)]+)\)", r"\1 (\2)", inline)
+        if not stripped:
+            yield from flush()
+        elif m := re.match(r"(#{1,6})\s+", stripped):
+            yield from flush()
+            yield f"h{min(len(m.group(1)), 3)}", inline[m.end():], 0
+        elif m := re.match(r"([-*+]|\d+[.)])\s+", stripped):
+            yield from flush()
+            bullet = "•" if m.group(1) in "-*+" else m.group(1)
+            yield "li", f"{bullet} {inline[m.end():]}", 12 + (len(line) - len(line.lstrip())) * 3
+        elif stripped.startswith(">"):
+            yield from flush()
+            yield "quote", inline.lstrip("> "), 12
+        else:
+            para.append(inline)
+    yield from flush()
+
+class _PdfWriter:
+    """Układ tekstu na stronach A4: zawijanie wierszy i nowa strona, gdy brakuje miejsca."""
+    MARGIN = 48
+
+    def __init__(self, path: pathlib.Path, title: str):
+        from reportlab.lib.pagesizes import A4
+        from reportlab.pdfgen import canvas
+        from reportlab.lib.utils import simpleSplit
+        self.split = simpleSplit
+        self.fonts = _pdf_fonts()
+        self.c = canvas.Canvas(str(path), pagesize=A4, pageCompression=1)
+        self.c.setTitle(title)
+        self.w, self.h = A4
+        self.page = 0
+        self._new_page()
+
+    def _new_page(self):
+        if self.page:
+            self.c.showPage()
+        self.page += 1
+        self.c.setFont(self.fonts["body"], 8)
+        self.c.setFillGray(0.5)
+        self.c.drawRightString(self.w - self.MARGIN, self.MARGIN / 2, str(self.page))
+        self.c.setFillGray(0)
+        self.y = self.h - self.MARGIN
+
+    def space(self, pts: float):
+        self.y -= pts
+
+    def text(self, text: str, font: str = "body", size: float = 10, indent: float = 0, gray: float = 0):
+        fname = self.fonts[font]
+        lead = size * 1.35
+        width = self.w - 2 * self.MARGIN - indent
+        if font == "mono":
+            per = max(int(width / (size * 0.6)), 1)  # stała szerokość znaku: tniemy po liczbie znaków
+            lines = [text[i:i + per] for i in range(0, len(text), per)]
+        else:
+            lines = self.split(text, fname, size, width)
+        for line in lines or [""]:
+            if self.y - lead < self.MARGIN:
+                self._new_page()
+            self.y -= lead
+            self.c.setFont(fname, size)
+            self.c.setFillGray(gray)
+            self.c.drawString(self.MARGIN + indent, self.y, line)
+        self.c.setFillGray(0)
+
+    def save(self):
+        self.c.save()
+
+_PDF_ROLES = {"user": "Ty", "assistant": "Asystent", "system": "System"}
+_PDF_STYLE = {"h1": ("bold", 14), "h2": ("bold", 12.5), "h3": ("bold", 11), "p": ("body", 10),
+              "li": ("body", 10), "quote": ("body", 10), "code": ("mono", 8.5)}
+
+def create_pdf(thread_id: str, upto_id: int, path: pathlib.Path, title: str):
+    pdf = _PdfWriter(path, title)
+    pdf.text(title, "bold", 16)
+    pdf.space(8)
+    for m in iter_thread_messages(thread_id, upto_id):
+        content = m["content"] or ""
+        if m["kind"] == "image":
+            try:
+                img = json.loads(content)
+                content = f"[obraz] {img.get('prompt', '')}"
+            except ValueError:
+                pass
+        label = "Źródła" if m["kind"] == "search" else _PDF_ROLES.get(m["role"], m["role"])
+        pdf.space(6)
+        pdf.text(f"{label} · {(m['at'] or '')[:16].replace('T', ' ')}", "bold", 9, gray=0.35)
+        for kind, text, indent in _md_blocks(content):
+            font, size = _PDF_STYLE[kind]
+            pdf.text(text, font, size, indent, gray=0.3 if kind == "quote" else 0)
+            if kind in ("p", "h1", "h2", "h3"):
+                pdf.space(3)
+    pdf.save()
+
+def _pdf_export(thread_id: str) -> pathlib.Path:
+    with db() as conn:
+        th = conn.execute("SELECT COALESCE(NULLIF(title,''), id) FROM threads WHERE id=?", (thread_id,)).fetchone()
+        last = conn.execute("SELECT MAX(id) FROM messages WHERE thread_id=?", (thread_id,)).fetchone()[0]
+    if not th:
+        raise HTTPException(status_code=404, detail="Not found")
+    # Klucz = ostatnia wiadomość: dopóki wątek się nie zmieni, eksport jest gotowy od ręki.
+    path = EXPORT_DIR / f"{thread_id}-{last or 0}-v{PDF_EXPORT_VERSION}.pdf"
+    if path.exists():
+        return path
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    try:
+        create_pdf(thread_id, last or 0, tmp, th[0])
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+    for old in _pdf_exports(thread_id):
+        if old != path:
+            old.unlink(missing_ok=True)
+    return path
+
+@router.get("/api/thread/{thread_id}/pdf")
+async def thread_pdf(thread_id: str):
+    async with _PDF_LOCKS.hold(thread_id):
+        path = await run_in_threadpool(_pdf_export, thread_id)
+    return FileResponse(path, media_type="application/pdf", filename=f"{thread_id}.pdf")
+
+# -------------- EKSPORT / IMPORT DANYCH -------
+# Format: NDJSON skompresowany gzipem, jeden rekord na linię z polem "t":
+# header, thread, message, anchor, memory. Wiadomości idą zaraz po swoim wątku.
+def iter_dump():
+    """Rekordy całej bazy czytane partiami (stała pamięć; każda partia to osobna krótka transakcja,
+    zamknięta przed ``yield``)."""
+    with db() as conn:
+        ver = conn.execute("PRAGMA user_version").fetchone()[0]
+    yield {"t": "header", "format": DUMP_FORMAT, "version": DUMP_VERSION, "schema": ver,
+           "created_at": datetime.now(timezone.utc).isoformat()}
+    at, tid = "", ""
+    while True:
+        with db() as conn:
+            threads = conn.execute("SELECT id, created_at, title, use_memory FROM threads WHERE (created_at, id) > (?, ?) "
+                                   "ORDER BY created_at, id LIMIT ?", (at, tid, DUMP_BATCH)).fetchall()
+        for (tid, at, title, um) in threads:
+            yield {"t": "thread", "id": tid, "created_at": at, "title": title, "use_memory": um}
+            for m in iter_thread_messages(tid, 2**62, DUMP_BATCH):
+                rec = {"t": "message", "thread_id": tid, "role": m["role"], "content": m["content"],
+                       "kind": m["kind"], "created_at": m["at"]}
+                if "route" in m:
+                    rec["route"] = m["route"]
+                yield rec
+            with db() as conn:
+                anchors = conn.execute("SELECT turn_index, label FROM anchors WHERE thread_id=?", (tid,)).fetchall()
+            for (turn, label) in anchors:
+                yield {"t": "anchor", "thread_id": tid, "turn_index": turn, "label": label}
+        if len(threads) < DUMP_BATCH:
+            break
+    last_id = 0
+    while True:
+        with db() as conn:
+            rows = conn.execute("SELECT id, key, value, scope, is_active, created_at, updated_at FROM global_memory "
+                                "WHERE id>? ORDER BY id LIMIT ?", (last_id, DUMP_BATCH)).fetchall()
+        for (last_id, k, v, sc, act, ca, ua) in rows:
+            yield {"t": "memory", "key": k, "value": v, "scope": sc, "is_active": act, "created_at": ca, "updated_at": ua}
+        if len(rows) < DUMP_BATCH:
+            break
+
+def iter_dump_gz(level: int = 6):
+    """Strumień bajtów gzip z iter_dump(), kompresowany przyrostowo."""
+    z = zlib.compressobj(level, zlib.DEFLATED, 31)
+    buf = []
+    for rec in iter_dump():
+        buf.append(json.dumps(rec, ensure_ascii=False))
+        if len(buf) >= DUMP_BATCH:
+            out = z.compress(("\n".join(buf) + "\n").encode("utf-8"))
+            buf.clear()
+            if out:
+                yield out
+    yield z.compress(("\n".join(buf) + "\n").encode("utf-8") if buf else b"") + z.flush()
+
+def import_dump(lines) -> dict:
+    """Wczytuje rekordy z iterowalnych linii NDJSON w jednej transakcji.
+
+    Idempotentne: istniejące wątki (po id) są pomijane razem z wiadomościami i
+    kotwicami, wpisy pamięci po (key, value, scope, created_at) też.
+    """
+    stats = {"threads": 0, "messages": 0, "anchors": 0, "memory": 0, "skipped_threads": 0}
+    accepted, batches = {}, {"message": [], "anchor": [], "memory": []}
+    sql = {
+        "message": "INSERT INTO messages(thread_id, role, content, kind, created_at, tokens, route) "
+                   "VALUES(?,?,?,?,?,?,?)",
+        "anchor": "INSERT OR IGNORE INTO anchors(thread_id, turn_index, label) VALUES(?,?,?)",
+        "memory": "INSERT INTO global_memory(key, value, scope, is_active, created_at, updated_at) "
+                  "SELECT ?,?,?,?,?,? WHERE NOT EXISTS (SELECT 1 FROM global_memory "
+                  "WHERE key IS ? AND value IS ? AND scope IS ? AND created_at IS ?)",
+    }
+    plural = {"message": "messages", "anchor": "anchors", "memory": "memory"}
+
+    def flush(conn, kind):
+        if batches[kind]:
+            stats[plural[kind]] += conn.executemany(sql[kind], batches[kind]).rowcount
+            batches[kind].clear()
+
+    with db() as conn:
+        for n, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                rec = json.loads(line)
+                t = rec["t"]
+            except (ValueError, KeyError, TypeError):
+                raise HTTPException(status_code=400, detail=f"Bad record at line {n}.")
+            if t == "header":
+                if rec.get("format") != DUMP_FORMAT or rec.get("version", 0) > DUMP_VERSION:
+                    raise HTTPException(status_code=400, detail="Unsupported dump format.")
+            elif t == "thread":
+                tid = rec["id"]
+                ok = conn.execute("INSERT OR IGNORE INTO threads(id, created_at, title, use_memory) VALUES(?,?,?,?)",
+                                  (tid, rec.get("created_at") or datetime.now(timezone.utc).isoformat(),
+                                   rec.get("title") or "",
+                                   1 if rec.get("use_memory", 1) else 0)).rowcount == 1
+                accepted[tid] = ok
+                stats["threads" if ok else "skipped_threads"] += 1
+            elif t == "message":
+                if not accepted.get(rec["thread_id"]):
+                    continue
+                content = rec.get("content") or ""
+                route = json.dumps(rec["route"], ensure_ascii=False) if rec.get("route") else None
+                batches["message"].append((rec["thread_id"], rec.get("role"), content, rec.get("kind") or "text",
+                                           rec.get("created_at"), count_tokens(content), route))
+            elif t == "anchor":
+                if accepted.get(rec["thread_id"]):
+                    batches["anchor"].append((rec["thread_id"], rec["turn_index"], rec.get("label")))
+            elif t == "memory":
+                row = (rec.get("key"), rec.get("value"), rec.get("scope"), 1 if rec.get("is_active", 1) else 0,
+                       rec.get("created_at"), rec.get("updated_at"))
+                batches["memory"].append(row + (row[0], row[1], row[2], row[4]))
+            for kind, rows in batches.items():
+                if len(rows) >= DUMP_BATCH:
+                    flush(conn, kind)
+        for kind in batches:
+            flush(conn, kind)
+    return stats
+
+def _gz_lines(path) -> Iterator[str]:
+    """Linie z pliku gzip albo zwykłego NDJSON (rozpoznanie po nagłówku)."""
+    with open(path, "rb") as f:
+        gz = f.read(2) == b"\x1f\x8b"
+    opener = gzip.open if gz else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        yield from f
+
+@router.get("/api/search")
+async def api_search(q: str, scope: str = "all", limit: int = 20, offset: int = 0):
+    if scope not in ("all", "messages", "memory"):
+        raise HTTPException(status_code=400, detail="scope: all | messages | memory")
+    return await run_db(search_all, q, scope, max(1, min(limit, 100)), max(0, offset))
+
+@router.get("/api/export")
+def api_export():
+    name = f"cheapchat-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}.ndjson.gz"
+    return StreamingResponse(iter_dump_gz(), media_type="application/gzip",
+                             headers={"Content-Disposition": f'attachment; filename="{name}"'})
+
+@router.post("/api/import")
+async def api_import(request: Request):
+    """Body: zrzut z /api/export (gzip lub zwykły NDJSON). Najpierw trafia na dysk, potem do bazy."""
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = EXPORT_DIR / f"import-{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            async for chunk in request.stream():
+                await run_in_threadpool(f.write, chunk)
+        return await run_db(lambda: import_dump(_gz_lines(tmp)))
+    finally:
+        tmp.unlink(missing_ok=True)
 
 # -------------- ENDPOINTY: ANCHORS ------------
-@app.get("/api/anchors/{thread_id}")
+@router.get("/api/anchors/{thread_id}")
 def api_get_anchors(thread_id: str):
     return anchors_get(thread_id)
 
-@app.post("/api/anchors")
+@router.post("/api/anchors")
 def api_set_anchor(req: AnchorReq):
     anchors_set(req.thread_id, req.turn_index, req.label.strip()[:120])
     return {"ok": True}
 
-@app.delete("/api/anchors")
+@router.delete("/api/anchors")
 def api_del_anchor(req: AnchorDelReq):
     anchors_delete(req.thread_id, req.turn_index)
     return {"ok": True}
 
 # -------------- ENDPOINTY: MEMORY 2.0 ---------
-@app.get("/api/memory/list")
+@router.get("/api/memory/list")
 def api_mem_list(active: Optional[int] = None):
     if active is None:
         return mem_list(None)
     return mem_list(bool(active))
 
-@app.post("/api/memory/add")
+@router.post("/api/memory/add")
 def api_mem_add(req: MemAddReq):
     mem_add(req.key, req.value, req.scope or "other")
     return {"ok": True}
 
-@app.post("/api/memory/update")
+@router.post("/api/memory/update")
 def api_mem_update(req: MemUpdateReq):
     mem_update(req); return {"ok": True}
 
-@app.post("/api/memory/forget")
+@router.post("/api/memory/forget")
 def api_mem_forget(req: MemToggleReq):
     mem_forget(req.id); return {"ok": True}
 
-@app.post("/api/memory/restore")
+@router.post("/api/memory/restore")
 def api_mem_restore(req: MemToggleReq):
     mem_restore(req.id); return {"ok": True}
 
 # -------------- MODELS -------------------------
-@app.get("/api/models")
+@router.get("/api/models")
 def list_models():
-    return {"default": MODEL_TEXT, "models": MODEL_CHOICES}
+    return {"default": MODEL_TEXT, "models": MODEL_CHOICES, "auto": MODEL_AUTO}
+
+# -------------- ROUTING MODELI (model: auto) ---
+# Klasa zapytania (rozmiar promptu, pliki, wyszukiwanie, długość wątku) wyznacza modele
+# wystarczające; spośród nich wybieramy najszybszy wg bieżących statystyk procesu
+# (średnia krocząca czasu pełnej odpowiedzi i odsetka błędów). Decyzja z uzasadnieniem
+# trafia do kolumny messages.route odpowiedzi.
+_ROUTE_STATS = {}  # model -> {"n", "latency", "errors", "at"}
+_ROUTE_PROBES = {}  # model -> czas ostatniej próby (monotonic)
+ROUTE_TOTAL = Counter("cheapchat_route_total", "Decyzje trybu model=auto.", ("class", "model"))
+METRICS.append(ROUTE_TOTAL)
+
+def route_latency(model: str, seconds: float):
+    st = _ROUTE_STATS.setdefault(model, {"n": 0, "latency": None, "errors": 0.0, "at": 0.0})
+    if st["latency"] is None or time.monotonic() - st["at"] > ROUTE_STALE:
+        st["n"], st["latency"] = 0, seconds
+    else:
+        st["latency"] += ROUTE_EWMA * (seconds - st["latency"])
+    st["n"] += 1
+    st["at"] = time.monotonic()
+
+def route_error(model: str, failed: bool):
+    st = _ROUTE_STATS.setdefault(model, {"n": 0, "latency": None, "errors": 0.0, "at": 0.0})
+    st["errors"] += ROUTE_EWMA * ((1.0 if failed else 0.0) - st["errors"])
+
+def route_class(text: str, files: int, web: bool, history: int):
+    tokens = count_tokens(text)
+    if files:
+        return "heavy", f"załączone pliki ({files})"
+    if tokens >= ROUTE_HEAVY_TOKENS:
+        return "heavy", f"długi prompt (~{tokens} tok.)"
+    if web:
+        return "standard", "wyszukiwanie w sieci"
+    if tokens <= ROUTE_LIGHT_TOKENS and history <= ROUTE_LIGHT_HISTORY:
+        return "light", f"krótka wiadomość (~{tokens} tok., {history} wiad. w wątku)"
+    return "standard", f"~{tokens} tok., {history} wiad. w wątku"
+
+def route_model(text: str, files: int, web: bool, history: int) -> dict:
+    cls, why = route_class(text, files, web, history)
+    tier = [m for m in ROUTE_TIERS[cls] if m in MODEL_CHOICES] or [MODEL_TEXT]
+    cands = [m for m in tier if _up_breaker(m).state != "open"] or tier
+    now = time.monotonic()
+    stats = {m: _ROUTE_STATS.get(m, {"n": 0, "latency": None, "errors": 0.0, "at": 0.0}) for m in cands}
+    healthy = [m for m in cands if stats[m]["errors"] <= ROUTE_MAX_ERRORS]
+    measured = [m for m in healthy if stats[m]["latency"] is not None]
+
+    def due(m):
+        st = stats[m]
+        return ((st["n"] < ROUTE_MIN_SAMPLES or now - st["at"] > ROUTE_STALE or m not in healthy)
+                and now - _ROUTE_PROBES.get(m, -ROUTE_PROBE_INTERVAL) >= ROUTE_PROBE_INTERVAL)
+
+    # Próba modelu bez pomiarów, z nieświeżymi albo z błędami: najwyżej raz na ROUTE_PROBE_INTERVAL,
+    # żeby przy małym ruchu zapytania nie zamieniały się w same próby (także najdroższych modeli).
+    probe = next((m for m in cands if due(m)), None) if measured else None
+    if probe:
+        model = probe
+        _ROUTE_PROBES[model] = now
+        why += f"; próba {model} (pomiary: {stats[model]['n']}, błędy {stats[model]['errors']:.0%})"
+    elif measured:
+        model = min(measured, key=lambda m: stats[m]["latency"])
+        st = stats[model]
+        why += f"; najszybszy z {'/'.join(measured)} (~{st['latency'] * 1000:.0f} ms, błędy {st['errors']:.0%})"
+    else:
+        model = (healthy or cands)[0]
+        why += f"; brak pomiarów, pierwszy z {'/'.join(healthy or cands)}"
+    ROUTE_TOTAL.inc(cls, model)
+    return {"model": model, "class": cls, "reason": why}
 
-# -------------- SEND (komendy + web + memory) -
-@app.post("/api/send", response_model=SendResp)
-def send(req: SendReq):
-    try:
-        thread_id = req.thread_id or new_thread()
-        text = (req.text or "").strip()
-        if not text:
-            raise HTTPException(status_code=400, detail="Empty message.")
+def route_stats() -> dict:
+    return {m: {"samples": st["n"], "latency_ms": round(st["latency"] * 1000) if st["latency"] else None,
+                "errors": round(st["errors"], 3)} for m, st in sorted(_ROUTE_STATS.items())}
 
+# -------------- SEND (komendy + web + memory) -
+def _send_command(req: SendReq, text: str) -> Optional[dict]:
+    """Obsługuje komendy pamięci w jednej transakcji; None, jeśli to zwykła wiadomość."""
+    low = text.lower().strip()
+    with db(immediate=True):
         # Komendy: zapamiętaj / zapomnij
-        low = text.lower().strip()
         if low.startswith(("zapamiętaj:", "zapamietaj:", "remember:")):
+            thread_id = req.thread_id or new_thread()
             payload = text.split(":",1)[1].strip() if ":" in text else text
             mem_add(None, payload, "other")
             add_msg(thread_id, "system", f"Zapisano do pamięci: {payload}", "text")
             return {"thread_id": thread_id, "reply": "✅ Zapamiętane.", "tokens": 0}
 
         if low.startswith(("zapomnij:", "forget:")):
+            thread_id = req.thread_id or new_thread()
             phrase = text.split(":",1)[1].strip() if ":" in text else ""
             cands = mem_forget_by_phrase(phrase)
             if len(cands)==1 and cands[0].get("status")=="forgotten":
@@ -531,165 +2153,887 @@ def send(req: SendReq):
                 lines += [f"- #{x['id']}: {x.get('key','')} — {x['value']}" for x in cands]
                 add_msg(thread_id, "system", "\n".join(lines), "text")
                 return {"thread_id": thread_id, "reply": "\n".join(lines), "tokens": 0}
+    return None
 
-        add_msg(thread_id, "user", text, "text")
-        file_blocks = []
-        for doc_id in req.files:
-            try:
-                txt = files_text(doc_id).get("text", "")
-                if txt:
-                    file_blocks.append(txt)
-            except Exception:
-                pass
-
-        # Web search
-        search_block = ""
-        if req.web:
-            results = web_search(text, n=5)
-            if results:
-                preview = fetch_url_preview(results[0]["url"])
-                if preview:
-                    results[0]["snippet"] += f"\n[preview]\n{preview}"
-            search_block = format_sources_block(results)
+def _system_prompt(prof: str, web: bool) -> str:
+    system_prompt = (
+        "You are a helpful assistant. Reply in clean, GitHub-flavored Markdown. "
+        "Use headings, bullet/numbered lists, tables, and fenced code blocks with language hints when helpful. "
+    )
+    if prof:
+        system_prompt += "\nUser profile (global memory):\n" + prof
+    if web:
+        system_prompt += "\nIf a 'Źródła wyszukiwania' block is present, ground the answer in it and cite briefly."
+    return system_prompt
+
+def _send_begin(req: SendReq, text: str, search_block: str, file_blocks: List[str], model: Optional[str]):
+    """Zapisy i odczyty przed wywołaniem modelu — jedna transakcja. ``model=None`` = tryb auto."""
+    use_mem = bool(req.use_memory)
+    with db(immediate=True) as conn:
+        row = None
+        if req.thread_id:
+            row = conn.execute("SELECT use_memory FROM threads WHERE id=?", (req.thread_id,)).fetchone()
+        thread_id = req.thread_id or new_thread(use_memory=use_mem)
+        if row is not None:
+            use_mem = bool(row[0])
+        elif req.thread_id:
+            set_thread_use_memory(thread_id, use_mem)
+        user_id = add_msg(thread_id, "user", text, "text")
+        if search_block:
             add_msg(thread_id, "system", search_block, "search")
-
-        # Memory flag
-        use_mem = bool(req.use_memory)
-        with db() as conn:
-            cur = conn.execute("SELECT use_memory FROM threads WHERE id=?", (thread_id,))
-            row = cur.fetchone()
-            if row is not None and req.thread_id:
-                use_mem = bool(row[0])
-            else:
-                set_thread_use_memory(thread_id, use_mem)
-
+        route = None
+        if model is None:
+            history = conn.execute("SELECT COUNT(*) FROM messages WHERE thread_id=? AND kind='text'",
+                                   (thread_id,)).fetchone()[0]
+            route = route_model(text, len(file_blocks), bool(search_block), history)
+            model = route["model"]
         # Kontext
-        history = get_history_for_model(thread_id)
-        system_prompt = (
-            "You are a helpful assistant. Reply in clean, GitHub-flavored Markdown. "
-            "Use headings, bullet/numbered lists, tables, and fenced code blocks with language hints when helpful. "
-        )
-        if use_mem:
-            prof = mem_profile_snippet()
-            if prof:
-                system_prompt += "\nUser profile (global memory):\n" + prof
-        if req.web and search_block:
-            system_prompt += "\nIf a 'Źródła wyszukiwania' block is present, ground the answer in it and cite briefly."
-
-        context = history[:-1] if len(history) > 1 else []
-        user_msg = history[-1] if history else {"role": "user", "content": text}
-        messages = [{"role": "system", "content": system_prompt}] + context
-        for block in file_blocks:
-            messages.append({"role": "system", "content": block})
-        messages.append(user_msg)
-
+        with span("memory_profile"):
+            prof = mem_profile_snippet() if use_mem else ""
+        with span("build_context"):
+            ctx = build_context(thread_id, model, _system_prompt(prof, bool(search_block)), file_blocks, user_id)
+    ctx.update(model=model, route=route)
+    return thread_id, ctx
+
+async def _send_prepare(req: SendReq) -> dict:
+    """Zapisuje wiadomość użytkownika i składa kontekst dla modelu.
+
+    Zwraca {"thread_id", "reply", "tokens"} dla komend (bez wywołania modelu)
+    albo {"thread_id", "text", "model", "messages"} gotowe do wysłania.
+    """
+    text = (req.text or "").strip()
+    if not text:
+        raise HTTPException(status_code=400, detail="Empty message.")
+    cmd = await run_db(_send_command, req, text)
+    if cmd is not None:
+        return cmd
+
+    file_blocks = []
+    if req.files:
+        with span("files_index"):
+            for doc_id in req.files:
+                try:
+                    await index_document(doc_id)
+                except Exception:
+                    pass
+        with span("files_blocks"):
+            file_blocks = await run_db(doc_file_blocks, req.files, text)
+
+    # Web search
+    search_block = await web_context(text) if req.web else ""
+
+    if req.model == MODEL_AUTO:
+        model = None
+    else:
         model = req.model if req.model in MODEL_CHOICES else MODEL_TEXT
-        resp = client.responses.create(model=model, input=messages)
-        reply = getattr(resp, "output_text", None) or str(resp)
-        tokens = 0
-        usage = getattr(resp, "usage", None)
-        if usage:
-            tokens = getattr(usage, "total_tokens", 0)
-        elif isinstance(resp, dict):
-            tokens = resp.get("usage", {}).get("total_tokens", 0)
-        add_msg(thread_id, "assistant", reply, "text")
+    thread_id, ctx = await run_db(_send_begin, req, text, search_block, file_blocks, model)
+    return {"thread_id": thread_id, "text": text, "model": ctx["model"], "messages": ctx["messages"],
+            "summarize_upto": ctx["summarize_upto"], "route": ctx["route"]}
+
+def _route_record(route: Optional[dict], model: str) -> Optional[dict]:
+    """Decyzja routingu do zapisu; po przełączeniu bramki odnotowuje faktycznie użyty model."""
+    if not route:
+        return None
+    rec = {"model": model, "routed": route["model"], "class": route["class"], "reason": route["reason"]}
+    if model != route["model"]:
+        rec["reason"] += f"; przełączono na {model} (awaria {route['model']})"
+    return rec
 
+def _send_finish(thread_id: str, text: str, reply: str, route: Optional[dict] = None):
+    """Zapisy po wywołaniu modelu (odpowiedź + automatyczny tytuł) — jedna transakcja."""
+    with db() as conn:
+        msg_id = add_msg(thread_id, "assistant", reply, "text")
+        if route:
+            conn.execute("UPDATE messages SET route=? WHERE id=?", (json.dumps(route, ensure_ascii=False), msg_id))
         # Nadaj tytuł, jeśli pusty
-        with db() as conn:
-            cur = conn.execute("SELECT title FROM threads WHERE id=?", (thread_id,))
-            row = cur.fetchone()
-        if row and not row[0]:
-            set_thread_title(thread_id, text[:60])
+        conn.execute("UPDATE threads SET title=? WHERE id=? AND COALESCE(title,'')=''", (text[:60], thread_id))
+
+def _usage_tokens(resp) -> int:
+    usage = getattr(resp, "usage", None)
+    if usage:
+        return getattr(usage, "total_tokens", 0) or 0
+    if isinstance(resp, dict):
+        return resp.get("usage", {}).get("total_tokens", 0)
+    return 0
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# Powtórzone wysłanie (podwójny klik, ponowienie przeglądarki/proxy, podwójne onstop nagrania)
+# nie woła modelu drugi raz ani nie dopisuje wiadomości: identyczne żądania w locie czekają
+# na jeden wynik, a klucz idempotencji zapamiętuje odpowiedź w bazie (także między procesami).
+_SEND_INFLIGHT = {}  # skrót (klucz idempotencji, treść żądania) -> Future z odpowiedzią
+REPLY_CACHE = TTLCache(REPLY_CACHE_TTL, 1024)
+
+def _send_key_claim(key: str) -> Optional[dict]:
+    """Rezerwuje klucz; None = obsługujemy my, inaczej {"status", "response"} istniejącego wpisu."""
+    now = time.time()
+    with db(immediate=True) as conn:
+        row = conn.execute("SELECT status, response, created_at FROM send_keys WHERE key=?", (key,)).fetchone()
+        if row is None or (row[0] == "pending" and row[2] < now - SEND_KEY_PENDING):
+            conn.execute("INSERT OR REPLACE INTO send_keys(key, status, created_at) VALUES(?, 'pending', ?)",
+                         (key, now))
+            return None
+    return {"status": row[0], "response": json.loads(row[1]) if row[1] else None}
+
+def _send_key_store(key: str, response: Optional[dict]):
+    with db() as conn:
+        if response is None:
+            conn.execute("DELETE FROM send_keys WHERE key=?", (key,))  # błąd: ponowienie wykona się od nowa
+        else:
+            conn.execute("UPDATE send_keys SET status='done', response=? WHERE key=?", (json.dumps(response), key))
+
+def sweep_send_keys() -> int:
+    with db() as conn:
+        return conn.execute("DELETE FROM send_keys WHERE created_at<?", (time.time() - SEND_KEY_TTL,)).rowcount
+
+async def _send_join(req: SendReq, request: Request):
+    """Zwraca (klucze, gotowa odpowiedź albo None). Przy None wywołujący wykonuje żądanie
+    i musi je zamknąć przez _send_settle()."""
+    ikey = (request.headers.get("idempotency-key") or req.idempotency_key or "").strip()[:200] or None
+    # Z kluczem łączymy tylko powtórzenia tego samego klucza: dwa osobne "dalej" o identycznej
+    # treści (albo ta sama pierwsza wiadomość z dwóch kart) to dwie różne wiadomości.
+    body = req.model_dump(exclude={"idempotency_key"})
+    fkey = hashlib.sha256(f"{request.url.path}|{ikey or ''}|{json.dumps(body, sort_keys=True)}".encode()).hexdigest()
+    fut = _SEND_INFLIGHT.get(fkey)
+    if fut is not None:
+        return None, await asyncio.shield(fut)
+    _SEND_INFLIGHT[fkey] = asyncio.get_running_loop().create_future()
+    keys = (fkey, ikey)
+    if ikey:
+        try:
+            while (row := await run_db(_send_key_claim, ikey)) is not None:
+                if row["status"] == "done":
+                    await _send_settle((fkey, None), row["response"])
+                    return None, row["response"]
+                await asyncio.sleep(SEND_KEY_POLL)  # to samo żądanie obsługuje inny proces
+        except BaseException as e:
+            await _send_settle((fkey, None), exc=e)
+            raise
+    return keys, None
+
+async def _send_settle(keys, result: Optional[dict] = None, exc: Optional[BaseException] = None):
+    fkey, ikey = keys
+    if ikey:
+        with anyio.CancelScope(shield=True):
+            await run_db(_send_key_store, ikey, result)
+    fut = _SEND_INFLIGHT.pop(fkey, None)
+    if fut is not None and not fut.done():
+        if result is not None:
+            fut.set_result(result)
+        else:
+            if not isinstance(exc, HTTPException):
+                exc = HTTPException(status_code=502, detail=f"Upstream error: {exc}")
+            fut.set_exception(exc)
+            fut.exception()  # bez czekających asyncio loguje "never retrieved"
 
-        return {"thread_id": thread_id, "reply": reply, "tokens": tokens}
+def _reply_key(ctx: dict) -> str:
+    return hashlib.sha256(json.dumps([ctx["model"], ctx["messages"]], sort_keys=True).encode()).hexdigest()
+
+async def _send_run(req: SendReq) -> dict:
+    try:
+        ctx = await _send_prepare(req)
+        if "reply" in ctx:
+            return ctx
+        t0 = time.perf_counter()
+        rkey = _reply_key(ctx) if REPLY_CACHE_TTL else None
+        hit = REPLY_CACHE.get(rkey) if rkey else None
+        if hit is not None:
+            reply, tokens, model = hit["reply"], 0, hit["model"]
+        else:
+            t_up = time.perf_counter()
+            resp, model = await upstream("responses", ctx["model"],
+                                         lambda m: client.responses.create(model=m, input=ctx["messages"]),
+                                         failover=True)
+            route_latency(model, time.perf_counter() - t_up)
+            reply = getattr(resp, "output_text", None) or str(resp)
+            tokens = _usage_tokens(resp)
+            record_usage(model, resp)
+            if rkey:
+                REPLY_CACHE.set(rkey, {"reply": reply, "model": model})
+        print(f"[send] model={model} total={(time.perf_counter() - t0) * 1000:.0f}ms tokens={tokens}"
+              f"{' (cache)' if hit else ''}")
+        route = _route_record(ctx["route"], model)
+        await run_db(_send_finish, ctx["thread_id"], ctx["text"], reply, route)
+        if ctx["summarize_upto"]:
+            spawn(update_thread_summary(ctx["thread_id"], ctx["summarize_upto"]))
+        return {"thread_id": ctx["thread_id"], "reply": reply, "tokens": tokens, "model": model,
+                "cached": hit is not None, "route": route}
 
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Upstream error: {e}")
 
+@router.post("/api/send", response_model=SendResp)
+async def send(req: SendReq, request: Request):
+    keys, done = await _send_join(req, request)
+    if done is not None:
+        return done
+    try:
+        result = await _send_run(req)
+    except BaseException as e:
+        await _send_settle(keys, exc=e)
+        raise
+    await _send_settle(keys, result)
+    return result
+
+def _sse_replay(res: dict):
+    """Gotowa odpowiedź (komenda, duplikat, cache) jako jeden fragment strumienia."""
+    yield _sse("meta", {"thread_id": res["thread_id"], "model": res.get("model")})
+    yield _sse("delta", {"t": res["reply"]})
+    yield _sse("done", {"tokens": res.get("tokens", 0), "ttft_ms": 0, "total_ms": 0})
+
+@router.post("/api/send/stream")
+async def send_stream(req: SendReq, request: Request):
+    """Wariant /api/send strumieniujący odpowiedź jako Server-Sent Events.
+
+    Zdarzenia: ``meta`` (thread_id, model), ``delta`` (kolejny fragment tekstu),
+    ``done`` (tokens, ttft_ms, total_ms) lub ``error`` (detail). Duplikat żądania
+    (ten sam klucz idempotencji albo identyczne żądanie w locie) dostaje całą
+    odpowiedź w jednym ``delta``.
+    """
+    t0 = time.perf_counter()
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    keys, done = await _send_join(req, request)
+    if done is not None:
+        return StreamingResponse(_sse_replay(done), media_type="text/event-stream", headers=headers)
+    try:
+        ctx = await _send_prepare(req)
+        rkey = _reply_key(ctx) if REPLY_CACHE_TTL and "reply" not in ctx else None
+        hit = REPLY_CACHE.get(rkey) if rkey else None
+        if hit is not None:
+            route = _route_record(ctx["route"], hit["model"])
+            await run_db(_send_finish, ctx["thread_id"], ctx["text"], hit["reply"], route)
+            if ctx["summarize_upto"]:
+                spawn(update_thread_summary(ctx["thread_id"], ctx["summarize_upto"]))
+            ctx = {"thread_id": ctx["thread_id"], "reply": hit["reply"], "tokens": 0, "model": hit["model"],
+                   "cached": True, "route": route}
+    except BaseException as e:
+        await _send_settle(keys, exc=e)
+        raise
+    thread_id = ctx["thread_id"]
+    if "reply" in ctx:
+        await _send_settle(keys, ctx)
+        return StreamingResponse(_sse_replay(ctx), media_type="text/event-stream", headers=headers)
+
+    async def events():
+        yield _sse("meta", {"thread_id": thread_id, "model": ctx["model"],
+                            "route": ctx["route"]["reason"] if ctx["route"] else None})
+        parts, tokens, ttft, finished, stream, release = [], 0, None, False, None, None
+        model, error = ctx["model"], None
+        try:
+            t_up = time.perf_counter()
+            stream, model, release = await upstream(
+                "responses", model, lambda m: client.responses.create(model=m, input=ctx["messages"], stream=True),
+                failover=True, hold=True)
+            if model != ctx["model"]:
+                yield _sse("meta", {"thread_id": thread_id, "model": model, "failover_from": ctx["model"]})
+            async for ev in stream:
+                kind = getattr(ev, "type", "")
+                if kind == "response.output_text.delta":
+                    if ttft is None:
+                        ttft = time.perf_counter() - t0
+                    parts.append(ev.delta)
+                    yield _sse("delta", {"t": ev.delta})
+                elif kind == "response.completed":
+                    # Ta sama miara co w /api/send: od wywołania do pełnej odpowiedzi.
+                    route_latency(model, time.perf_counter() - t_up)
+                    tokens = _usage_tokens(ev.response)
+                    record_usage(model, ev.response)
+                elif kind in ("error", "response.failed"):
+                    raise RuntimeError(getattr(ev, "message", None) or kind)
+                if await request.is_disconnected():
+                    break
+            else:
+                finished = True
+        except Exception as e:
+            error = e
+            yield _sse("error", {"detail": f"Upstream error: {e}"})
+        finally:
+            if stream is not None:
+                with anyio.CancelScope(shield=True):
+                    try:
+                        await stream.close()
+                    except Exception:
+                        pass
+                    await release()
+            reply = "".join(parts)
+            total = time.perf_counter() - t0
+            ttft_ms = round((ttft or total) * 1000)
+            if ttft is not None:
+                span_add("ttft", ttft)
+            print(f"[send/stream] model={model} ttft={ttft_ms}ms total={total * 1000:.0f}ms "
+                  f"tokens={tokens}{'' if finished else ' (partial)'}")
+            if reply:
+                # Przy zerwanym połączeniu zapisujemy to, co już przyszło.
+                with anyio.CancelScope(shield=True):
+                    await run_db(_send_finish, thread_id, ctx["text"], reply, _route_record(ctx["route"], model))
+                if ctx["summarize_upto"]:
+                    spawn(update_thread_summary(thread_id, ctx["summarize_upto"]))
+                if finished and rkey:
+                    REPLY_CACHE.set(rkey, {"reply": reply, "model": model})
+            # Zapisana (choćby częściowa) odpowiedź jest wynikiem żądania — ponowienie nie dopisze jej drugi raz.
+            result = {"thread_id": thread_id, "reply": reply, "tokens": tokens, "model": model} if reply else None
+            await _send_settle(keys, result, error or RuntimeError("empty reply"))
+        if finished:
+            yield _sse("done", {"tokens": tokens, "ttft_ms": ttft_ms, "total_ms": round(total * 1000)})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
 # -------------- AUDIO --------------------------
-@app.post("/api/transcribe")
+@router.post("/api/transcribe")
 async def transcribe(file: UploadFile = File(...)):
     audio_bytes = await file.read()
-    resp = client.audio.transcriptions.create(
-        model=MODEL_STT,
+    resp, _ = await upstream("transcriptions", MODEL_STT, lambda m: client.audio.transcriptions.create(
+        model=m,
         file=("audio.webm", audio_bytes)
-    )
+    ))
     text = getattr(resp, "text", None) or (resp.get("text") if isinstance(resp, dict) else None)
     return {"text": text}
 
-@app.get("/api/voices")
+async def _stt_segment(sid: str, seq: int, audio: bytes) -> str:
+    try:
+        resp, _ = await upstream("transcriptions", MODEL_STT,
+                                 lambda m: client.audio.transcriptions.create(model=m, file=("audio.webm", audio)))
+        text = (getattr(resp, "text", None) or "").strip()
+    except Exception as e:
+        print(f"[stt] segment {seq} failed: {e}")
+        text = ""
+    await run_db(_stt_store, sid, seq, text)
+    return text
+
+def _stt_new() -> str:
+    sid = uuid.uuid4().hex
+    with db() as conn:
+        conn.execute("INSERT INTO stt_sessions(id, touched) VALUES(?,?)", (sid, time.time()))
+    return sid
+
+def _stt_touch(conn, sid: str) -> bool:
+    now = time.time()
+    return conn.execute("UPDATE stt_sessions SET touched=? WHERE id=? AND touched>?",
+                        (now, sid, now - STT_SESSION_TTL)).rowcount == 1
+
+def _stt_claim(sid: str, seq: int) -> Optional[bool]:
+    """None = nieznana sesja, False = segment już był, True = segment zarezerwowany."""
+    with db() as conn:
+        if not _stt_touch(conn, sid):
+            return None
+        return conn.execute("INSERT OR IGNORE INTO stt_segments(session_id, seq, started_at) VALUES(?,?,?)",
+                            (sid, seq, time.time())).rowcount == 1
+
+def _stt_store(sid: str, seq: int, text: str):
+    with db() as conn:
+        conn.execute("UPDATE stt_segments SET text=? WHERE session_id=? AND seq=?", (text, sid, seq))
+
+def _stt_rows(sid: str) -> Optional[list]:
+    with db() as conn:
+        if not _stt_touch(conn, sid):
+            return None
+        return conn.execute("SELECT seq, text, started_at FROM stt_segments WHERE session_id=? ORDER BY seq",
+                            (sid,)).fetchall()
+
+def _stt_drop(sid: str):
+    with db() as conn:
+        conn.execute("DELETE FROM stt_segments WHERE session_id=?", (sid,))
+        conn.execute("DELETE FROM stt_sessions WHERE id=?", (sid,))
+
+def sweep_stt_sessions() -> int:
+    cutoff = time.time() - STT_SESSION_TTL
+    with db() as conn:
+        conn.execute("DELETE FROM stt_segments WHERE session_id IN (SELECT id FROM stt_sessions WHERE touched<?)",
+                     (cutoff,))
+        return conn.execute("DELETE FROM stt_sessions WHERE touched<?", (cutoff,)).rowcount
+
+def _stt_stitch(rows, final: bool = False) -> str:
+    """Skleja gotowe segmenty po kolei; wynik częściowy kończy się na pierwszym niegotowym."""
+    got = {seq: text for seq, text, _ in rows}
+    parts = []
+    for seq in range(max(got, default=-1) + 1):
+        t = got.get(seq)
+        if t is None:
+            if final:
+                continue
+            break
+        if t:
+            parts.append(t)
+    return " ".join(parts)
+
+@router.post("/api/transcribe/session")
+async def transcribe_session():
+    return {"session_id": await run_db(_stt_new)}
+
+@router.post("/api/transcribe/session/{sid}/{seq:int}")
+async def transcribe_segment(sid: str, seq: int, request: Request):
+    """Jeden samodzielny segment nagrania (surowe body). Segmenty transkrybowane są równolegle."""
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > STT_SEGMENT_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="Segment too large.")
+    claimed = await run_db(_stt_claim, sid, seq)
+    if claimed is None:
+        raise HTTPException(status_code=404, detail="Unknown transcription session.")
+    if not claimed:
+        raise HTTPException(status_code=409, detail="Segment already uploaded.")
+    # Transkrypcja kończy się i zapisuje także wtedy, gdy klient się rozłączy.
+    text = await asyncio.shield(spawn(_stt_segment(sid, seq, bytes(body))))
+    rows = await run_db(_stt_rows, sid)
+    return {"seq": seq, "text": text, "partial": _stt_stitch(rows or [])}
+
+@router.post("/api/transcribe/session/{sid}/finish")
+async def transcribe_finish(sid: str):
+    rows = await run_db(_stt_rows, sid)
+    if rows is None:
+        raise HTTPException(status_code=404, detail="Unknown transcription session.")
+    # Segmenty w toku mogą się transkrybować w innym workerze — czekamy, aż zapiszą wynik.
+    while any(t is None and time.time() - at < STT_SEGMENT_WAIT for _, t, at in rows):
+        await asyncio.sleep(0.2)
+        rows = await run_db(_stt_rows, sid) or []
+    await run_db(_stt_drop, sid)
+    return {"text": _stt_stitch(rows, final=True)}
+
+@router.get("/api/voices")
 def voices():
     return {"default": TTS_DEFAULT, "voices": TTS_VOICES}
 
-@app.post("/api/tts")
-def tts(req: TTSReq):
-    voice = (req.voice or TTS_DEFAULT)
-    vnorm = voice.lower().strip()
+TTS_DIR = DATA_DIR / "tts"
+TTS_CACHE_STATS = {"hits": 0, "misses": 0}
+_TTS_INFLIGHT = {}
+
+def _tts_norm(text: str) -> str:
+    return " ".join((text or "").split())
+
+def _tts_voice(voice: Optional[str]) -> str:
+    vnorm = (voice or TTS_DEFAULT).lower().strip()
     if vnorm not in [v.lower() for v in TTS_VOICES]:
         raise HTTPException(status_code=400, detail=f"Unknown voice: {voice}")
-    audio = client.audio.speech.create(
-        model=MODEL_TTS, voice=vnorm, input=req.text, format="mp3",
-    )
-    data = getattr(audio, "content", None) or (audio.read() if hasattr(audio, "read") else None)
-    if data is None:
-        raise HTTPException(status_code=502, detail="TTS failed.")
-    return Response(content=data, media_type="audio/mpeg")
+    return vnorm
+
+def _tts_path(voice: str, text: str) -> pathlib.Path:
+    key = hashlib.sha256(f"{MODEL_TTS}\0{voice}\0{text}".encode("utf-8")).hexdigest()
+    return TTS_DIR / key[:2] / f"{key}.mp3"
+
+def _tts_read(path: pathlib.Path) -> Optional[bytes]:
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    os.utime(path)  # mtime = ostatnie użycie, według niego usuwamy
+    return data
+
+def _tts_store(path: pathlib.Path, data: bytes):
+    """Zapis atomowy + usunięcie najdawniej używanych plików ponad TTS_CACHE_MAX_BYTES."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+    files = []
+    for f in TTS_DIR.glob("*/*.mp3"):
+        try:
+            st = f.stat()
+        except FileNotFoundError:
+            continue
+        files.append((st.st_mtime, st.st_size, f))
+    total = sum(sz for _, sz, _ in files)
+    for _, sz, f in sorted(files):
+        if total <= TTS_CACHE_MAX_BYTES:
+            break
+        f.unlink(missing_ok=True)
+        total -= sz
+
+async def tts_synthesize(voice: str, text: str) -> bytes:
+    """MP3 dla (model, głos, znormalizowany tekst); z cache na dysku, równoległe prośby o to samo łączone."""
+    path = _tts_path(voice, text)
+    data = await run_in_threadpool(_tts_read, path)
+    if data is not None:
+        TTS_CACHE_STATS["hits"] += 1
+        return data
+    fut = _TTS_INFLIGHT.get(path)
+    if fut is not None:
+        return await asyncio.shield(fut)
+    TTS_CACHE_STATS["misses"] += 1
+    fut = _TTS_INFLIGHT[path] = asyncio.get_running_loop().create_future()
+    try:
+        audio, _ = await upstream("speech", MODEL_TTS, lambda m: client.audio.speech.create(
+            model=m, voice=voice, input=text, response_format="mp3"))
+        data = getattr(audio, "content", None)
+        if not data:
+            raise HTTPException(status_code=502, detail="TTS failed.")
+        await run_in_threadpool(_tts_store, path, data)
+        fut.set_result(data)
+        return data
+    except asyncio.CancelledError:
+        fut.set_exception(HTTPException(status_code=503, detail="TTS cancelled."))
+        fut.exception()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # nikt może nie czekać; bez tego asyncio loguje "never retrieved"
+        raise
+    finally:
+        _TTS_INFLIGHT.pop(path, None)
+
+def tts_chunks(text: str, limit: int = TTS_CHUNK_CHARS) -> List[str]:
+    """Dzieli tekst na zdania i skleja je we fragmenty do ~limit znaków; pierwszy krótki, żeby szybko zagrać."""
+    sentences = [x for x in re.split(r"(?<=[.!?…:;])\s+|\n+", text) if x.strip()]
+    out, cur = [], ""
+    for sent in sentences:
+        cap = limit // 4 if not out else limit
+        if cur and len(cur) + len(sent) + 1 > cap:
+            out.append(cur)
+            cur = sent
+        else:
+            cur = f"{cur} {sent}" if cur else sent
+    if cur:
+        out.append(cur)
+    return out
+
+@router.post("/api/tts")
+async def tts(req: TTSReq):
+    voice, text = _tts_voice(req.voice), _tts_norm(req.text)
+    if not text:
+        raise HTTPException(status_code=400, detail="Empty text.")
+    data = await tts_synthesize(voice, text)
+    return Response(content=data, media_type="audio/mpeg", headers={"Cache-Control": "private, max-age=86400"})
+
+@router.post("/api/tts/stream")
+async def tts_stream(req: TTSReq):
+    """MP3 sklejane z fragmentów po zdaniach: syntezowane równolegle, wysyłane po kolei."""
+    voice, text = _tts_voice(req.voice), _tts_norm(req.text)
+    chunks = tts_chunks(text)
+    if not chunks:
+        raise HTTPException(status_code=400, detail="Empty text.")
+    sem = asyncio.Semaphore(TTS_PARALLEL)
+
+    async def one(chunk: str) -> bytes:
+        async with sem:
+            return await tts_synthesize(voice, chunk)
+
+    async def body():
+        tasks = [asyncio.ensure_future(one(c)) for c in chunks]
+        try:
+            for t in tasks:
+                try:
+                    yield await t
+                except Exception as e:
+                    print(f"[tts] fragment failed: {e}")
+                    return
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    return StreamingResponse(body(), media_type="audio/mpeg", headers={"Cache-Control": "no-cache"})
 
 # -------------- IMAGES -------------------------
-@app.post("/api/image")
-def gen_image(req: ImageReq, background: BackgroundTasks):
+async def _job_image(params: dict, progress) -> dict:
+    thread_id, prompt = params["thread_id"], params["prompt"]
     try:
-        thread_id = req.thread_id or new_thread()
-        prompt = (req.prompt or "").strip()
-        if not prompt:
-            raise HTTPException(status_code=400, detail="Empty image prompt.")
-        img = client.images.generate(model=MODEL_IMAGE, prompt=prompt, size=req.size or "1024x1024", n=1)
-        b64 = img.data[0].b64_json
-        raw = base64.b64decode(b64)
-        file_id = uuid.uuid4().hex
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-        tmp.write(raw)
-        tmp.close()
-        path = pathlib.Path(tmp.name)
-        TEMP_FILES[file_id] = {"path": path, "mime": "image/png"}
-        background.add_task(remove_temp_file, file_id)
-        url = f"/api/temp/{file_id}"
-        add_msg(thread_id, "assistant", json.dumps({"prompt": prompt, "url": url}), "image")
-        return {"thread_id": thread_id, "url": url, "prompt": prompt}
+        img, _ = await upstream("images", MODEL_IMAGE,
+                                lambda m: client.images.generate(model=m, prompt=prompt, size=params["size"], n=1))
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Image generation failed: {e}")
+    file_id = uuid.uuid4().hex
+    await run_db(store_b64_file, file_id, img.data[0].b64_json, ".png", "image.png", "image/png", "image")
+    url = f"/api/temp/{file_id}"
+    await run_db(add_msg, thread_id, "assistant", json.dumps({"prompt": prompt, "url": url}), "image")
+    return {"thread_id": thread_id, "url": url, "prompt": prompt}
+
+@router.post("/api/image")
+async def gen_image(req: ImageReq):
+    prompt = (req.prompt or "").strip()
+    if not prompt:
+        raise HTTPException(status_code=400, detail="Empty image prompt.")
+    thread_id = req.thread_id or await run_db(new_thread)
+    # Ponowienie tego samego żądania w trakcie generowania dołącza do istniejącego zadania.
+    job_id = await enqueue_job("image", {"thread_id": thread_id, "prompt": prompt, "size": req.size or "1024x1024"},
+                               reuse_done=False)
+    if req.mode == "job":
+        return {"job_id": job_id, "thread_id": thread_id}
+    return await job_wait(job_id)
+
+# -------------- FILES: magazyn plików ----------
+# Bloby leżą w DATA_DIR/files/<sha[:2]>/<sha><ext> (ten sam plik = jeden blob),
+# metadane i termin ważności w tabeli documents, więc pliki widzą wszystkie
+# procesy i przeżywają restart. Sprząta jeden okresowy sweeper.
+def _blob_rel(sha: str, suffix: str) -> str:
+    return f"{sha[:2]}/{sha}{suffix.lower()}"
+
+class BlobWriter:
+    """Zapis pliku do magazynu kawałkami: liczy sha256 i rozmiar, pamięta początek do rozpoznania typu."""
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        tmp_dir = FILES_DIR / ".incoming"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp = tmp_dir / f"{uuid.uuid4().hex}.tmp"
+        self.fh = open(self.tmp, "wb")
+        self.sha = hashlib.sha256()
+        self.size, self.head, self.max_bytes = 0, b"", max_bytes
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise HTTPException(status_code=413, detail=f"File too large (max {self.max_bytes // 2**20} MB).")
+        if len(self.head) < 512:
+            self.head += data[:512 - len(self.head)]
+        self.sha.update(data)
+        self.fh.write(data)
+
+    def commit(self, suffix: str) -> tuple:
+        """Przenosi plik na miejsce bloba (albo usuwa, jeśli taki blob już jest); zwraca (rel, sha, rozmiar)."""
+        self.fh.close()
+        sha = self.sha.hexdigest()
+        rel = _blob_rel(sha, suffix)
+        path = FILES_DIR / rel
+        if path.exists():
+            self.tmp.unlink(missing_ok=True)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(self.tmp, path)
+        return rel, sha, self.size
+
+    def discard(self):
+        self.fh.close()
+        self.tmp.unlink(missing_ok=True)
+
+_MAGIC = [
+    (b"%PDF-", "application/pdf"), (b"\x89PNG\r\n\x1a\n", "image/png"), (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"), (b"II*\x00", "image/tiff"), (b"MM\x00*", "image/tiff"), (b"\xd0\xcf\x11\xe0", "application/msword"),
+]
+_ZIP_MIME = {".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+             ".odt": "application/vnd.oasis.opendocument.text"}
+
+def sniff_mime(head: bytes, suffix: str, declared: Optional[str]) -> str:
+    """Typ z nagłówka pliku; przeglądarki często wysyłają application/octet-stream albo nic."""
+    for magic, mime in _MAGIC:
+        if head.startswith(magic):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith(b"PK\x03\x04"):
+        return _ZIP_MIME.get(suffix.lower(), "application/zip")
+    if declared and declared != "application/octet-stream":
+        return declared
+    try:
+        head.decode("utf-8")
+        return "text/plain"
+    except UnicodeDecodeError as e:
+        # Ucięty wielobajtowy znak na końcu próbki to nadal tekst.
+        return "text/plain" if e.start >= len(head) - 3 else "application/octet-stream"
+
+def _insert_file(file_id: str, rel: str, sha: str, size: int, orig_name: str, mime: str, kind: str):
+    with db() as conn:
+        conn.execute(
+            "INSERT INTO documents(id, filename, orig_name, mime, size, created_at, sha256, path, kind, expires_at) "
+            "VALUES(?,?,?,?,?,?,?,?,?,?)",
+            (file_id, pathlib.PurePath(rel).name, orig_name, mime, size, datetime.now(timezone.utc).isoformat(),
+             sha, rel, kind, time.time() + FILE_TTL),
+        )
+
+def store_b64_file(file_id: str, b64: str, suffix: str, orig_name: str, mime: str, kind: str = "doc") -> dict:
+    """Dekoduje base64 kawałkami prosto do magazynu, bez drugiej pełnej kopii w pamięci."""
+    w = BlobWriter()
+    try:
+        step = 4 * 256 * 1024
+        for i in range(0, len(b64), step):
+            w.write(base64.b64decode(b64[i:i + step]))
+        rel, sha, size = w.commit(suffix)
+    except BaseException:
+        w.discard()
+        raise
+    _insert_file(file_id, rel, sha, size, orig_name, mime, kind)
+    return {"path": FILES_DIR / rel, "mime": mime, "sha256": sha, "kind": kind}
+
+def get_file(file_id: str) -> Optional[dict]:
+    """Metadane ważnego pliku albo None (także gdy wygasł, a sweeper jeszcze nie przeszedł)."""
+    with db() as conn:
+        row = conn.execute("SELECT path, mime, sha256, kind FROM documents WHERE id=? AND path IS NOT NULL "
+                           "AND (expires_at IS NULL OR expires_at > ?)", (file_id, time.time())).fetchone()
+    if not row:
+        return None
+    return {"path": FILES_DIR / row[0], "mime": row[1], "sha256": row[2], "kind": row[3]}
+
+def _file_or_404(file_id: str) -> dict:
+    info = get_file(file_id)
+    if not info or not info["path"].exists():
+        raise HTTPException(status_code=404, detail="Not found")
+    return info
+
+def _unlink_blobs(rels):
+    for rel in rels:
+        try:
+            (FILES_DIR / rel).unlink(missing_ok=True)
+        except OSError:
+            pass
+
+def _drop_files(conn, ids: List[str]) -> List[str]:
+    """Usuwa wpisy (z fragmentami) i zwraca ścieżki blobów, na które nic już nie wskazuje."""
+    if not ids:
+        return []
+    marks = ",".join("?" * len(ids))
+    rels = [r[0] for r in conn.execute(f"SELECT DISTINCT path FROM documents WHERE id IN ({marks})", ids)]
+    conn.execute(f"DELETE FROM doc_chunks WHERE doc_id IN ({marks})", ids)
+    conn.execute(f"DELETE FROM documents WHERE id IN ({marks})", ids)
+    return [rel for rel in rels
+            if rel and not conn.execute("SELECT 1 FROM documents WHERE path=?", (rel,)).fetchone()]
+
+def delete_file(file_id: str) -> bool:
+    with db(immediate=True) as conn:
+        if not conn.execute("SELECT 1 FROM documents WHERE id=?", (file_id,)).fetchone():
+            return False
+        rels = _drop_files(conn, [file_id])
+    _unlink_blobs(rels)
+    return True
+
+def sweep_files() -> dict:
+    """Hurtowo: wygasłe wpisy, potem najstarsze ponad FILES_MAX_BYTES, na końcu osierocone bloby."""
+    now = time.time()
+    with db(immediate=True) as conn:
+        ids = [r[0] for r in conn.execute("SELECT id FROM documents WHERE expires_at <= ?", (now,))]
+        over = [r[0] for r in conn.execute(
+            """SELECT id FROM (SELECT id, SUM(size) OVER (ORDER BY created_at DESC, id) AS run
+                               FROM documents WHERE expires_at > ? OR expires_at IS NULL) WHERE run > ?""",
+            (now, FILES_MAX_BYTES))]
+        rels = _drop_files(conn, ids + over)
+        known = {r[0] for r in conn.execute("SELECT DISTINCT path FROM documents WHERE path IS NOT NULL")}
+    _unlink_blobs(rels)
+    orphans = 0
+    for f in FILES_DIR.glob("*/*"):
+        rel = f"{f.parent.name}/{f.name}"
+        # Świeże pliki mogą właśnie czekać na wpis w bazie. Pliki w .incoming to uploady w toku:
+        # wcześniejsza część wieloplikowego uploadu czeka na commit, aż dojdą kolejne.
+        age = INCOMING_TTL if f.parent.name == ".incoming" else FILE_SWEEP_INTERVAL
+        try:
+            if rel not in known and now - f.stat().st_mtime > age:
+                f.unlink()
+                orphans += 1
+        except OSError:
+            pass
+    return {"expired": len(ids), "evicted": len(over), "orphans": orphans}
+
+async def _sweeper():
+    """Okresowe sprzątanie: pliki (TTL, limit, osierocone bloby) i stare puste wątki."""
+    while True:
+        try:
+            stats = await run_db(sweep_files)
+            stats["empty_threads"] = await run_db(sweep_empty_threads)
+            stats["send_keys"] = await run_db(sweep_send_keys)
+            stats["stt_sessions"] = await run_db(sweep_stt_sessions)
+            if any(stats.values()):
+                print(f"[sweep] {stats}")
+        except Exception as e:
+            print(f"[sweep] failed: {e}")
+        await asyncio.sleep(FILE_SWEEP_INTERVAL)
+
+async def start_sweeper():
+    FILES_DIR.mkdir(parents=True, exist_ok=True)
+    spawn(_sweeper())
 
 # -------------- FILES: upload/list/delete -------
-@app.post("/api/files/upload")
-async def files_upload(background: BackgroundTasks, files: List[UploadFile] = File(...)):
-    results = []
-    for file in files:
-        raw = await file.read()
-        doc_id = uuid.uuid4().hex
-        suffix = pathlib.Path(file.filename).suffix
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-        tmp.write(raw)
-        tmp.close()
-        path = pathlib.Path(tmp.name)
-        with db() as conn:
-            conn.execute(
-                "INSERT INTO documents(id, filename, orig_name, mime, size, created_at) VALUES(?,?,?,?,?,?)",
-                (doc_id, path.name, file.filename, file.content_type, len(raw), datetime.now(timezone.utc).isoformat()),
-            )
-        TEMP_FILES[doc_id] = {"path": path, "mime": file.content_type, "doc": True}
-        background.add_task(remove_temp_file, doc_id)
-        url = f"/api/temp/{doc_id}"
-        results.append({"id": doc_id, "url": url, "name": file.filename, "mime": file.content_type, "size": len(raw)})
+class _UploadParser:
+    """Strumieniowy parser multipart: pliki z pola "files" idą kawałkami prosto na dysk."""
+
+    def __init__(self, boundary: bytes):
+        self.parts, self.part, self.pending = [], None, []
+        self.total, self.header, self.headers = 0, b"", {}
+        self.parser = MultipartParser(boundary, {
+            "on_part_begin": self._begin, "on_header_field": self._hfield, "on_header_value": self._hvalue,
+            "on_header_end": self._hend, "on_headers_finished": self._hdone,
+            "on_part_data": self._data, "on_part_end": self._end,
+        })
+
+    def _begin(self):
+        self.headers, self.header, self.value = {}, b"", b""
+
+    def _hfield(self, data, start, end):
+        self.header += data[start:end]
+
+    def _hvalue(self, data, start, end):
+        self.value += data[start:end]
+
+    def _hend(self):
+        self.headers[self.header.decode("latin-1").lower()] = self.value.decode("utf-8", errors="replace")
+        self.header, self.value = b"", b""
+
+    def _hdone(self):
+        _, opts = parse_options_header(self.headers.get("content-disposition", ""))
+        name = opts.get(b"filename")
+        self.part = None
+        if opts.get(b"name") == b"files" and name is not None:
+            self.part = {"name": os.path.basename(name.decode("utf-8", errors="replace")) or "plik",
+                         "mime": self.headers.get("content-type"), "writer": None}
+
+    def _data(self, data, start, end):
+        if self.part is not None:
+            self.pending.append((self.part, bytes(data[start:end])))
+
+    def _end(self):
+        if self.part is not None:
+            self.parts.append(self.part)
+            self.part = None
+
+    def flush(self):
+        """Zapis zebranych kawałków na dysk (wołane w wątku, nie w pętli zdarzeń)."""
+        pending, self.pending = self.pending, []
+        for part, data in pending:
+            if part["writer"] is None:
+                part["writer"] = BlobWriter(UPLOAD_MAX_FILE_BYTES)
+            part["writer"].write(data)
+
+    def discard(self):
+        for part in self.parts + ([self.part] if self.part else []):
+            if part.get("writer"):
+                part["writer"].discard()
+
+def _commit_upload(part: dict) -> dict:
+    w = part["writer"] or BlobWriter()
+    suffix = pathlib.Path(part["name"]).suffix
+    mime = sniff_mime(w.head, suffix, part["mime"])
+    rel, sha, size = w.commit(suffix)
+    doc_id = uuid.uuid4().hex
+    _insert_file(doc_id, rel, sha, size, part["name"], mime, "doc")
+    return {"id": doc_id, "url": f"/api/temp/{doc_id}", "name": part["name"], "mime": mime, "size": size}
+
+@router.post("/api/files/upload")
+async def files_upload(request: Request, index: bool = True):
+    """Pliki (pole "files") zapisywane w locie; limity CHEAPCHAT_UPLOAD_FILE_MB i CHEAPCHAT_UPLOAD_REQUEST_MB.
+
+    ``index=false`` pomija indeksowanie w tle (dokument zindeksuje się przy pierwszym użyciu w czacie).
+    """
+    ctype, opts = parse_options_header(request.headers.get("content-type", ""))
+    if ctype != b"multipart/form-data" or b"boundary" not in opts:
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data.")
+    if int(request.headers.get("content-length") or 0) > UPLOAD_MAX_REQUEST_BYTES:
+        raise HTTPException(status_code=413, detail="Upload too large.")
+    up = _UploadParser(opts[b"boundary"])
+    try:
+        async for chunk in request.stream():
+            up.total += len(chunk)
+            if up.total > UPLOAD_MAX_REQUEST_BYTES:
+                raise HTTPException(status_code=413, detail="Upload too large.")
+            up.parser.write(chunk)
+            if up.pending:
+                await run_in_threadpool(up.flush)
+        up.parser.finalize()
+        await run_in_threadpool(up.flush)
+        if not up.parts:
+            raise HTTPException(status_code=400, detail="No files.")
+        results = await asyncio.gather(*(run_db(_commit_upload, part) for part in up.parts))
+    except BaseException:
+        await run_in_threadpool(up.discard)
+        raise
+    if index:
+        for r in results:
+            spawn(index_document(r["id"]))
     return {"files": results}
 
-@app.get("/api/files/list")
+@router.get("/api/files/list")
 def files_list():
     with db() as conn:
-        cur = conn.execute("SELECT id, orig_name, mime, size, created_at FROM documents ORDER BY created_at DESC")
+        cur = conn.execute("SELECT id, orig_name, mime, size, created_at FROM documents "
+                           "WHERE kind='doc' AND expires_at > ? ORDER BY created_at DESC", (time.time(),))
         return [
             {
                 "id": i,
@@ -700,83 +3044,486 @@ def files_list():
                 "created_at": ca,
             }
             for (i, on, m, s, ca) in cur.fetchall()
-            if i in TEMP_FILES
         ]
 
-@app.delete("/api/files/{doc_id}")
+@router.delete("/api/files/{doc_id}")
 def files_delete(doc_id: str):
-    info = TEMP_FILES.pop(doc_id, None)
-    if not info:
+    if not delete_file(doc_id):
         raise HTTPException(status_code=404, detail="Not found")
-    try:
-        info["path"].unlink(missing_ok=True)
-    except Exception:
-        pass
-    with db() as conn:
-        conn.execute("DELETE FROM documents WHERE id=?", (doc_id,))
     return {"ok": True}
 
-@app.get("/api/files/{doc_id}/text")
-def files_text(doc_id: str):
-    info = TEMP_FILES.get(doc_id)
-    if not info:
-        raise HTTPException(status_code=404, detail="Not found")
+def extract_text(doc_id: str) -> dict:
+    info = _file_or_404(doc_id)
     fpath = info["path"]
     suffix = fpath.suffix.lower()
+    key = extract_cache_key("text", _doc_sha256(doc_id, info), suffix=suffix)
+    text = extract_cache_get(key)
+    if text is not None:
+        return {"id": doc_id, "text": text, "cached": True}
     try:
         if suffix == ".pdf":
+            from pdfminer.high_level import extract_text as pdf_extract_text
             text = pdf_extract_text(str(fpath))
         elif suffix in (".docx", ".doc"):
+            from docx import Document
             doc = Document(str(fpath))
             text = "\n".join(p.text for p in doc.paragraphs)
         elif suffix == ".odt":
+            from odf.opendocument import load as odf_load
+            from odf import text as odf_text
             doc = odf_load(str(fpath))
             text = "\n".join(t.firstChild.data if t.firstChild else "" for t in doc.getElementsByType(odf_text.P))
         else:
             text = fpath.read_text(encoding="utf-8", errors="ignore")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"text extraction failed: {e}")
+    extract_cache_put(key, text or "")
     return {"id": doc_id, "text": text or ""}
 
-@app.get("/api/files/{doc_id}/ocr")
-def files_ocr(doc_id: str, lang: str = "pol+eng", dpi: int = 250):
-    info = TEMP_FILES.get(doc_id)
-    if not info:
-        raise HTTPException(status_code=404, detail="Not found")
+@router.get("/api/files/{doc_id}/text")
+async def files_text(doc_id: str, mode: Optional[str] = None):
+    job_id = await enqueue_job("text", {"doc_id": doc_id})
+    if mode == "job":
+        return {"job_id": job_id}
+    return await job_wait(job_id)
+
+# -------------- OCR (strona po stronie, równolegle) -
+_OCR_POOL = None
+
+def _ocr_pool() -> ProcessPoolExecutor:
+    global _OCR_POOL
+    if _OCR_POOL is None:
+        _OCR_POOL = ProcessPoolExecutor(max_workers=OCR_WORKERS)
+    return _OCR_POOL
+
+def _ocr_page(path: str, page: int, dpi: int, lang: str) -> str:
+    """OCR jednej strony w procesie roboczym; page=0 oznacza plik graficzny."""
+    import pytesseract
+    if page == 0:
+        from PIL import Image
+        return pytesseract.image_to_string(Image.open(path), lang=lang)
+    from pdf2image import convert_from_path
+    images = convert_from_path(path, dpi=dpi, first_page=page, last_page=page)
+    return pytesseract.image_to_string(images[0], lang=lang) if images else ""
+
+def _parse_pages(spec: Optional[str], total: int) -> List[int]:
+    """'1-3,7' -> [1, 2, 3, 7] (w granicach 1..total); pusty spec = wszystkie strony."""
+    if not spec:
+        return list(range(1, total + 1))
+    out = []
+    for part in spec.split(","):
+        a, _, b = part.strip().partition("-")
+        try:
+            lo, hi = int(a), int(b or a)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Bad page range: {part}")
+        out += [p for p in range(max(lo, 1), min(hi, total) + 1) if p not in out]
+    return out
+
+def _ocr_plan(doc_id: str, pages: Optional[str]):
+    info = _file_or_404(doc_id)
     fpath = info["path"]
-    suffix = fpath.suffix.lower()
+    if fpath.suffix.lower() != ".pdf":
+        page_list = [0]
+    else:
+        try:
+            from pdf2image import pdfinfo_from_path
+            total = int(pdfinfo_from_path(str(fpath))["Pages"])
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"OCR failed: {e}")
+        page_list = _parse_pages(pages, total)
+    return fpath, _doc_sha256(doc_id, info), page_list
+
+async def ocr_iter(doc_id: str, lang: str, dpi: int, pages: Optional[str] = None):
+    """Asynchronicznie zwraca (strona, tekst, liczba_stron) w kolejności ukończenia.
+
+    W locie jest najwyżej 2×OCR_WORKERS stron, więc pamięć nie rośnie z
+    długością dokumentu. Wyniki stron trafiają do cache ekstrakcji.
+    """
+    fpath, sha, page_list = await run_in_threadpool(_ocr_plan, doc_id, pages)
+    total = len(page_list)
+    loop = asyncio.get_running_loop()
+    todo, running = iter(page_list), {}
     try:
-        if suffix == ".pdf":
-            images = convert_from_path(str(fpath), dpi=dpi)
-            texts = [pytesseract.image_to_string(img, lang=lang) for img in images]
-            full = "\n\n".join(texts)
-        else:
-            img = Image.open(fpath)
-            full = pytesseract.image_to_string(img, lang=lang)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"OCR failed: {e}")
+        while True:
+            while len(running) < OCR_WORKERS * 2:
+                page = next(todo, None)
+                if page is None:
+                    break
+                key = extract_cache_key("ocr-page", sha, lang=lang, dpi=dpi, page=page)
+                cached = await run_db(extract_cache_get, key)
+                if cached is not None:
+                    yield page, cached, total
+                    continue
+                fut = loop.run_in_executor(_ocr_pool(), _ocr_page, str(fpath), page, dpi, lang)
+                running[fut] = (page, key)
+            if not running:
+                return
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                page, key = running.pop(fut)
+                try:
+                    text = fut.result()
+                except Exception as e:
+                    raise HTTPException(status_code=500, detail=f"OCR failed (page {page}): {e}")
+                await run_db(extract_cache_put, key, text)
+                yield page, text, total
+    finally:
+        for fut in running:
+            fut.cancel()
+
+async def ocr_document(doc_id: str, lang: str = "pol+eng", dpi: int = 250, pages: Optional[str] = None,
+                       progress=None) -> dict:
+    info = await run_db(_file_or_404, doc_id)
+    sha = await run_db(_doc_sha256, doc_id, info)
+    key = extract_cache_key("ocr", sha, lang=lang, dpi=dpi, pages=pages or "")
+    full = await run_db(extract_cache_get, key)
+    if full is not None:
+        return {"id": doc_id, "lang": lang, "text": full, "cached": True}
+    texts = {}
+    async for page, text, total in ocr_iter(doc_id, lang, dpi, pages):
+        texts[page] = text
+        if progress:
+            progress(len(texts), total)
+    full = "\n\n".join(texts[p] for p in sorted(texts))
+    await run_db(extract_cache_put, key, full)
     return {"id": doc_id, "lang": lang, "text": full}
 
+@router.get("/api/files/{doc_id}/ocr")
+async def files_ocr(doc_id: str, lang: str = "pol+eng", dpi: int = 250, pages: Optional[str] = None,
+                    mode: Optional[str] = None):
+    job_id = await enqueue_job("ocr", {"doc_id": doc_id, "lang": lang, "dpi": dpi, "pages": pages})
+    if mode == "job":
+        return {"job_id": job_id}
+    return await job_wait(job_id)
+
+@router.get("/api/files/{doc_id}/ocr/stream")
+async def files_ocr_stream(doc_id: str, lang: str = "pol+eng", dpi: int = 250, pages: Optional[str] = None):
+    """OCR strona po stronie jako NDJSON: {"page", "total", "text"} w kolejności ukończenia."""
+    await run_in_threadpool(_ocr_plan, doc_id, pages)  # 404/400 zanim zaczniemy strumień
+
+    async def lines():
+        try:
+            async for page, text, total in ocr_iter(doc_id, lang, dpi, pages):
+                yield json.dumps({"page": page, "total": total, "text": text}, ensure_ascii=False) + "\n"
+            yield json.dumps({"done": True}) + "\n"
+        except HTTPException as e:
+            yield json.dumps({"error": e.detail}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# -------------- JOBS (kolejka w SQLite) --------
+_JOB_WORKER_ID = f"{os.uname().nodename}:{os.getpid()}"
+_JOB_WAKE = None
+_JOB_DONE = {}  # job_id -> [Event, liczba czekających]; wpis usuwa ostatni czekający
+
+async def _job_text(params: dict, progress) -> dict:
+    return await run_in_threadpool(extract_text, params["doc_id"])
+
+async def _job_ocr(params: dict, progress) -> dict:
+    return await ocr_document(params["doc_id"], params["lang"], params["dpi"], params.get("pages"), progress)
+
+JOB_HANDLERS = {"text": _job_text, "ocr": _job_ocr, "image": _job_image}
+
+def _job_wake() -> asyncio.Event:
+    global _JOB_WAKE
+    if _JOB_WAKE is None:
+        _JOB_WAKE = asyncio.Event()
+    return _JOB_WAKE
+
+def _job_row(row) -> dict:
+    (i, kind, status, done, total, result, error, created, finished) = row
+    return {"id": i, "kind": kind, "status": status, "done": done, "total": total,
+            "result": json.loads(result) if result else None, "error": error,
+            "created_at": created, "finished_at": finished}
+
+def get_job(job_id: str) -> Optional[dict]:
+    with db() as conn:
+        row = conn.execute("SELECT id, kind, status, done, total, result, error, created_at, finished_at "
+                           "FROM jobs WHERE id=?", (job_id,)).fetchone()
+    return _job_row(row) if row else None
+
+def _job_enqueue(kind: str, params: dict, reuse_done: bool) -> str:
+    key = hashlib.sha256((kind + json.dumps(params, sort_keys=True)).encode()).hexdigest()
+    now = time.time()
+    with db(immediate=True) as conn:
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE dedupe_key=? AND (status IN ('queued','running') "
+            "OR (? AND status='done' AND finished_at>?)) ORDER BY created_at DESC LIMIT 1",
+            (key, 1 if reuse_done else 0, now - JOB_RETENTION)).fetchone()
+        if row:
+            return row[0]
+        job_id = uuid.uuid4().hex
+        conn.execute("INSERT INTO jobs(id, kind, params, dedupe_key, status, created_at) VALUES(?,?,?,?,?,?)",
+                     (job_id, kind, json.dumps(params), key, "queued", now))
+    return job_id
+
+async def enqueue_job(kind: str, params: dict, reuse_done: bool = True) -> str:
+    """Dodaje zadanie do kolejki (albo zwraca identyczne oczekujące/zakończone)."""
+    job_id = await run_db(_job_enqueue, kind, params, reuse_done)
+    _job_wake().set()
+    return job_id
+
+async def job_wait(job_id: str):
+    """Czeka na wynik zadania; błąd zadania zamienia na HTTPException."""
+    entry = _JOB_DONE.setdefault(job_id, [asyncio.Event(), 0])
+    entry[1] += 1
+    try:
+        while True:
+            job = await run_db(get_job, job_id)
+            if job is None:
+                raise HTTPException(status_code=404, detail="Job not found")
+            if job["status"] == "done":
+                return job["result"]
+            if job["status"] == "error":
+                code, _, detail = (job["error"] or "500:").partition(":")
+                raise HTTPException(status_code=int(code) if code.isdigit() else 500, detail=detail or job["error"])
+            try:
+                # Zadanie może wykonywać inny proces — wtedy sprawdzamy co sekundę.
+                await asyncio.wait_for(entry[0].wait(), timeout=1.0)
+                entry[0].clear()
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # Także gdy zadanie skończył inny proces i nikt tu nie ustawił zdarzenia.
+        entry[1] -= 1
+        if not entry[1] and _JOB_DONE.get(job_id) is entry:
+            del _JOB_DONE[job_id]
+
+async def run_job(kind: str, params: dict, reuse_done: bool = True):
+    return await job_wait(await enqueue_job(kind, params, reuse_done))
+
+def _job_claim(token: str, kinds: Optional[tuple] = None):
+    """Przejmuje najstarsze zadanie (z ``kinds``: tylko tych rodzajów)."""
+    now = time.time()
+    only = f"kind IN ({','.join('?' * len(kinds))}) AND " if kinds else ""
+    with db() as conn:
+        # Jedno UPDATE = atomowe przejęcie także przy wielu procesach.
+        conn.execute(
+            "UPDATE jobs SET status='running', worker=?, started_at=?, lease_until=?, attempts=attempts+1 "
+            f"WHERE id=(SELECT id FROM jobs WHERE {only}(status='queued' OR (status='running' AND lease_until<?)) "
+            "ORDER BY created_at LIMIT 1)",
+            (token, now, now + JOB_LEASE, *(kinds or ()), now))
+        return conn.execute("SELECT id, kind, params, attempts FROM jobs WHERE worker=? AND status='running'",
+                            (token,)).fetchone()
+
+def _job_update(job_id: str, token: str, done, total):
+    with db() as conn:
+        conn.execute("UPDATE jobs SET done=?, total=?, lease_until=? WHERE id=? AND worker=?",
+                     (done, total, time.time() + JOB_LEASE, job_id, token))
 
-@app.get("/api/temp/{file_id}")
-def temp_file(file_id: str):
-    info = TEMP_FILES.get(file_id)
-    if not info or not info["path"].exists():
+def _job_finish(job_id: str, token: str, result, error: Optional[str]):
+    with db() as conn:
+        conn.execute("UPDATE jobs SET status=?, result=?, error=?, finished_at=?, worker=NULL, lease_until=NULL "
+                     "WHERE id=? AND worker=?",
+                     ("error" if error else "done", json.dumps(result) if result is not None else None,
+                      error, time.time(), job_id, token))
+
+def _job_recover():
+    """Po restarcie zwraca do kolejki zadania przerwane przez martwe procesy tego hosta."""
+    host = os.uname().nodename
+    with db(immediate=True) as conn:
+        rows = conn.execute("SELECT id, worker FROM jobs WHERE status='running'").fetchall()
+        for job_id, worker in rows:
+            h, _, pid = (worker or "").partition(":")
+            pid = pid.split(":")[0]
+            if h != host or not pid.isdigit():
+                continue
+            try:
+                os.kill(int(pid), 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                continue
+            conn.execute("UPDATE jobs SET status='queued', worker=NULL WHERE id=?", (job_id,))
+        conn.execute("DELETE FROM jobs WHERE status IN ('done','error') AND finished_at<?",
+                     (time.time() - JOB_RETENTION,))
+
+async def _job_run(job_id: str, kind: str, params: str, attempts: int, token: str):
+    state = {"done": None, "total": None}
+
+    def progress(done, total):
+        state.update(done=done, total=total)
+
+    async def heartbeat():
+        _SPANS.set(None)  # odnawianie dzierżawy to nie etap zadania
+        while True:
+            await asyncio.sleep(1.0)
+            await run_db(_job_update, job_id, token, state["done"], state["total"])
+
+    hb = spawn(heartbeat())
+    result, error = None, None
+    try:
+        if attempts > JOB_MAX_ATTEMPTS:
+            raise RuntimeError(f"gave up after {attempts - 1} attempts")
+        with span(f"job_{kind}"):
+            result = await JOB_HANDLERS[kind](json.loads(params), progress)
+    except HTTPException as e:
+        error = f"{e.status_code}:{e.detail}"
+    except Exception as e:
+        error = f"500:{e.__class__.__name__}: {e}"
+    finally:
+        hb.cancel()
+    await run_db(_job_finish, job_id, token, result, error)
+    entry = _JOB_DONE.get(job_id)
+    if entry:
+        entry[0].set()
+
+async def _job_worker(n: int, kinds: Optional[tuple] = None):
+    token = f"{_JOB_WORKER_ID}:{n}"
+    last_cleanup = 0.0
+    while True:
+        try:
+            if time.time() - last_cleanup > 600:
+                last_cleanup = time.time()
+                await run_db(_job_recover)
+            row = await run_db(_job_claim, token, kinds)
+        except Exception as e:
+            print(f"[jobs] worker {n}: {e}")
+            row = None
+        if row is None:
+            wake = _job_wake()
+            wake.clear()
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        ctx = _SPANS.set({})  # etapy zadania trafiają do metryk jak etapy żądania
+        try:
+            await _job_run(*row, token)
+        finally:
+            _SPANS.reset(ctx)
+
+async def start_job_workers():
+    for n in range(JOB_WORKERS):
+        spawn(_job_worker(n))
+    for n in range(JOB_WORKERS, JOB_WORKERS + JOB_FAST_WORKERS):
+        spawn(_job_worker(n, JOB_FAST_KINDS))
+
+@router.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await run_db(get_job, job_id)
+    if not job:
         raise HTTPException(status_code=404, detail="Not found")
+    return job
+
+@router.get("/api/temp/{file_id}")
+def temp_file(file_id: str):
+    info = _file_or_404(file_id)
     return FileResponse(info["path"], media_type=info.get("mime"))
 
 # -------------- HEALTH -------------------------
-@app.get("/-/health")
+@router.get("/-/health")
 def health():
-    import openai as _openai
-    return {"ok": True, "openai_version": getattr(_openai, "__version__", "unknown"),
+    return {"ok": True, "openai_version": getattr(openai, "__version__", "unknown"),
+            "extract_cache": EXTRACT_CACHE_STATS,
+            "tts_cache": TTS_CACHE_STATS,
+            "search_cache": SEARCH_CACHE.stats(), "page_cache": PAGE_CACHE.stats(),
+            "reply_cache": REPLY_CACHE.stats(), "send_inflight": len(_SEND_INFLIGHT),
+            "routing": route_stats(),
+            "upstream": upstream_stats(),
             "models": {"text": MODEL_TEXT, "stt": MODEL_STT, "tts": MODEL_TTS, "image": MODEL_IMAGE}}
 
-# Serve public directory at root so assets can be loaded relatively
-app.mount("/", StaticFiles(directory=str(PUBLIC_DIR), html=True), name="public_root")
+@router.get("/-/metrics")
+def metrics():
+    """Metryki w formacie tekstowym Prometheusa (histogramy + bieżący stan bramki i cache)."""
+    lines = []
+    for m in METRICS:
+        lines += m.render()
+    up = upstream_stats()
+    gauges = [
+        ("cheapchat_upstream_inflight", "Trwające wywołania OpenAI.", "inflight"),
+        ("cheapchat_upstream_queued", "Wywołania czekające na semafor bramki.", "queued"),
+    ]
+    for name, help, key in gauges:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+        lines += [f'{name}{{endpoint="{e}"}} {v[key]}' for e, v in up["endpoints"].items()]
+        lines += [f'{name}{{model="{m}"}} {v[key]}' for m, v in up["models"].items()]
+    lines += ["# HELP cheapchat_upstream_rate_waiting Wywołania czekające na limit RPM.",
+              "# TYPE cheapchat_upstream_rate_waiting gauge"]
+    lines += [f'cheapchat_upstream_rate_waiting{{model="{m}"}} {v["rate_waiting"]}' for m, v in up["models"].items()]
+    lines += ["# HELP cheapchat_upstream_breaker_open Bezpiecznik modelu otwarty (1) lub nie (0).",
+              "# TYPE cheapchat_upstream_breaker_open gauge"]
+    lines += [f'cheapchat_upstream_breaker_open{{model="{m}"}} {int(v["breaker"] == "open")}'
+              for m, v in up["models"].items()]
+    lines += ["# HELP cheapchat_upstream_calls_total Wywołania OpenAI według wyniku.",
+              "# TYPE cheapchat_upstream_calls_total counter"]
+    lines += [f'cheapchat_upstream_calls_total{{model="{m}",result="{k}"}} {v.get(k, 0)}'
+              for m, v in up["models"].items() for k in ("ok", "retries", "rate_limited", "errors", "failovers")]
+    caches = {"search": SEARCH_CACHE.stats(), "page": PAGE_CACHE.stats(), "reply": REPLY_CACHE.stats(),
+              "tts": TTS_CACHE_STATS, "extract": EXTRACT_CACHE_STATS}
+    lines += ["# HELP cheapchat_cache_requests_total Trafienia i chybienia cache.",
+              "# TYPE cheapchat_cache_requests_total counter"]
+    lines += [f'cheapchat_cache_requests_total{{cache="{c}",result="{r}"}} {v.get(k, 0)}'
+              for c, v in caches.items() for k, r in (("hits", "hit"), ("misses", "miss"))]
+    lines += ["# HELP cheapchat_send_inflight Wysyłki w toku (po scaleniu duplikatów).",
+              "# TYPE cheapchat_send_inflight gauge", f"cheapchat_send_inflight {len(_SEND_INFLIGHT)}"]
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# -------------- APLIKACJA ---------------------
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client
+    print(f"[data] dir: {DATA_DIR}")
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    print(f"[db] using {DB_PATH}")
+    await run_in_threadpool(ensure_schema)
+    client = make_client()
+    await start_sweeper()
+    await start_job_workers()
+    try:
+        yield
+    finally:
+        # Sweeper, workery kolejki i zadania w tle nie mogą przeżyć pętli, która je uruchomiła.
+        tasks = list(_BG_TASKS)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await close_upstream()
+
+def create_app() -> FastAPI:
+    """Import modułu nie dotyka dysku, klucza ani sieci; wszystko to dzieje się w lifespan."""
+    app = FastAPI(title="Prywatny czat z pamięcią", lifespan=lifespan)
+    app.add_exception_handler(Exception, all_exception_handler)
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(router)
+    app.mount("/public", StaticFiles(directory=str(PUBLIC_DIR)), name="public")
+    # Serve public directory at root so assets can be loaded relatively
+    app.mount("/", StaticFiles(directory=str(PUBLIC_DIR), html=True), name="public_root")
+    return app
+
+app = create_app()
 
 # -------------- AUTOSTART ----------------------
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run("app:app", host="0.0.0.0", port=PORT, reload=True)
-
+    import argparse, sys, uvicorn
+    ap = argparse.ArgumentParser(description="Cheapchat")
+    sub = ap.add_subparsers(dest="cmd")
+    p_exp = sub.add_parser("export", help="zrzut wątków, wiadomości, kotwic i pamięci do NDJSON.gz")
+    p_exp.add_argument("file", help="plik wyjściowy albo '-' (stdout)")
+    p_imp = sub.add_parser("import", help="wczytanie zrzutu (istniejące wątki są pomijane)")
+    p_imp.add_argument("file")
+    ap.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    ap.add_argument("--port", type=int, default=PORT)
+    ap.add_argument("--workers", type=int, default=int(os.environ.get("CHEAPCHAT_WORKERS", 1)),
+                    help="liczba procesów (produkcyjnie: np. liczba rdzeni)")
+    ap.add_argument("--reload", action="store_true", help="tryb deweloperski z przeładowaniem kodu")
+    args = ap.parse_args()
+    os.environ["CHEAPCHAT_WORKERS"] = str(args.workers)  # procesy robocze dzielą limity bramki
+    if args.cmd in ("export", "import"):
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        ensure_schema()
+        if args.cmd == "export":
+            out = sys.stdout.buffer if args.file == "-" else open(args.file, "wb")
+            with out:
+                for chunk in iter_dump_gz():
+                    out.write(chunk)
+        else:
+            print(json.dumps(import_dump(_gz_lines(args.file))))
+    elif args.reload:
+        uvicorn.run("app:create_app", factory=True, host=args.host, port=args.port, reload=True)
+    else:
+        uvicorn.run("app:create_app", factory=True, host=args.host, port=args.port, workers=args.workers,
+                    proxy_headers=True, log_level="info")
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Powtarzalny benchmark aplikacji względem bench/stub_openai.py.
+
+Uruchamia stub OpenAI i app.py na świeżym katalogu danych zasianym syntetycznymi
+wątkami, wiadomościami i pamięcią (skala small/medium/large), a potem obciąża
+wybrane endpointy na zadanych poziomach współbieżności. Wynik (przepustowość,
+p50/p95/p99, błędy per endpoint i poziom) trafia do JSON-a, z którym można
+porównać kolejne przebiegi:
+
+    python bench/bench.py run --scale medium --out baseline.json
+    python bench/bench.py run --scale medium --compare baseline.json   # kod 1 przy regresji p95
+    python bench/bench.py compare baseline.json nowy.json
+    python bench/bench.py seed --scale large --data-dir /tmp/cc-large   # samo zasianie danych
+
+Endpointy: send, send_stream (+ send_stream_ttft), threads, thread, search,
+upload, text, ocr (wymaga tesseracta), tts, export (pełny eksport równolegle z wysyłką
+i listą wątków; błąd oznacza, że strumień eksportu zablokował bazę).
+"""
+import argparse, asyncio, gzip, io, json, os, pathlib, platform, random, shutil, signal, statistics
+import subprocess, sys, tempfile, time, zlib
+
+import httpx
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+SCALES = {  # wątki, wiadomości na wątek, wpisy pamięci
+    "small": (50, 20, 50),
+    "medium": (500, 50, 500),
+    "large": (2000, 200, 5000),
+}
+WORDS = ("kot pies dom praca projekt raport umowa faktura spotkanie termin budżet klient serwer baza "
+         "kod test błąd wdrożenie plan analiza wynik dane model pytanie odpowiedź lista notatka").split()
+ENDPOINTS = ["send", "send_stream", "threads", "thread", "search", "upload", "text", "ocr", "tts", "export"]
+STUB_KEY = "sk-stub-000000000000000000"
+
+
+# ---------------- dane ----------------
+def _sentence(rng: random.Random, n: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+def seed_dump(path: pathlib.Path, scale: str, seed: int = 1):
+    """Zapisuje zrzut NDJSON.gz w formacie `python app.py export` (deterministyczny dla danego seed)."""
+    threads, per_thread, memories = SCALES[scale]
+    rng = random.Random(seed)
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=1) as f:
+        f.write(json.dumps({"t": "header", "format": "cheapchat-dump", "version": 1}) + "\n")
+        for t in range(threads):
+            tid = f"bench-{seed}-{t:06d}"
+            day = f"2025-{1 + t % 12:02d}-{1 + t % 28:02d}"
+            f.write(json.dumps({"t": "thread", "id": tid, "created_at": f"{day} 10:00:00",
+                                "title": _sentence(rng, 4)[:60], "use_memory": 1}) + "\n")
+            for m in range(per_thread):
+                role = "user" if m % 2 == 0 else "assistant"
+                text = _sentence(rng, 8 if role == "user" else 60)
+                f.write(json.dumps({"t": "message", "thread_id": tid, "role": role, "content": text,
+                                    "kind": "text", "created_at": f"{day} 10:{m // 60 % 60:02d}:{m % 60:02d}"},
+                                   ensure_ascii=False) + "\n")
+            for turn in range(1, per_thread // 2, 10):
+                f.write(json.dumps({"t": "anchor", "thread_id": tid, "turn_index": turn,
+                                    "label": _sentence(rng, 3)}, ensure_ascii=False) + "\n")
+        for i in range(memories):
+            f.write(json.dumps({"t": "memory", "key": f"fakt{i}", "value": _sentence(rng, 10),
+                                "scope": rng.choice(["profile", "preferences", "other"]), "is_active": 1,
+                                "created_at": "2025-01-01T00:00:00", "updated_at": "2025-01-01T00:00:00"},
+                               ensure_ascii=False) + "\n")
+
+def seed_data_dir(data_dir: pathlib.Path, scale: str, seed: int = 1):
+    data_dir.mkdir(parents=True, exist_ok=True)
+    dump = data_dir / f"seed-{scale}.ndjson.gz"
+    t0 = time.perf_counter()
+    seed_dump(dump, scale, seed)
+    env = {**os.environ, "CHEAPCHAT_DATA_DIR": str(data_dir)}
+    out = subprocess.run([sys.executable, str(ROOT / "app.py"), "import", str(dump)],
+                         env=env, check=True, capture_output=True, text=True).stdout
+    dump.unlink()
+    print(f"[seed] {scale}: {out.strip().splitlines()[-1]} ({time.perf_counter() - t0:.1f}s)")
+
+
+# ---------------- procesy ----------------
+def _wait_http(url: str, proc: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"proces zakończył się (kod {proc.returncode}): {url}")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"brak odpowiedzi: {url}")
+
+def start_stack(args, data_dir: pathlib.Path) -> list:
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    procs = [subprocess.Popen(
+        [sys.executable, str(ROOT / "bench" / "stub_openai.py"), "--port", str(args.stub_port),
+         "--latency", str(args.latency), "--ttft", str(args.ttft), "--tokens", str(args.tokens)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)]
+    _wait_http(f"{stub_url}/stats", procs[0])
+    env = {**os.environ, "CHEAPCHAT_DATA_DIR": str(data_dir), "OPENAI_BASE_URL": f"{stub_url}/v1",
+           "OPENAI_API_KEY": STUB_KEY, "CHEAPCHAT_SEARCH_URL": f"{stub_url}/search",
+           # Bramka nie powinna być wąskim gardłem, chyba że mierzymy właśnie ją (--rpm).
+           "CHEAPCHAT_UPSTREAM_RPM": f"*={args.rpm}",
+           "CHEAPCHAT_UPSTREAM_CONCURRENCY": "*=100000", "CHEAPCHAT_UPSTREAM_MODEL_CONCURRENCY": "*=100000"}
+    log = open(data_dir / "app.log", "w")
+    procs.append(subprocess.Popen(
+        [sys.executable, str(ROOT / "app.py"), "--host", "127.0.0.1", "--port", str(args.port),
+         "--workers", str(args.workers)], env=env, stdout=log, stderr=subprocess.STDOUT))
+    _wait_http(f"http://127.0.0.1:{args.port}/-/health", procs[1])
+    return procs
+
+def stop_stack(procs: list):
+    for p in reversed(procs):
+        if p.poll() is None:
+            p.send_signal(signal.SIGINT)
+    for p in reversed(procs):
+        try:
+            p.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+# ---------------- scenariusze ----------------
+# Każdy scenariusz: async (ctx, i) -> (sekundy, ok[, dodatkowe pomiary]); prepare(ctx, n) przed pomiarem.
+def _text_file(rng: random.Random, kb: int = 20) -> bytes:
+    return "\n".join(_sentence(rng, 12) for _ in range(kb * 1024 // 90)).encode()
+
+async def _upload(ctx, name: str, data: bytes, mime: str) -> str:
+    # Bez indeksowania w tle: ono samo uruchamia ekstrakcję i mierzylibyśmy gotowe zadanie z kolejki.
+    r = await ctx["http"].post(ctx["app"] + "/api/files/upload", params={"index": "false"},
+                               files={"files": (name, data, mime)})
+    r.raise_for_status()
+    return r.json()["files"][0]["id"]
+
+async def _timed(coro):
+    t0 = time.perf_counter()
+    r = await coro
+    return time.perf_counter() - t0, r.status_code < 400
+
+async def sc_send(ctx, i):
+    tid = ctx["rng"].choice(ctx["threads"]) if ctx["threads"] else None
+    return await _timed(ctx["http"].post(ctx["app"] + "/api/send", json={
+        "thread_id": tid, "text": f"{_sentence(ctx['rng'], 10)} #{i}", "use_memory": True}))
+
+async def sc_send_stream(ctx, i):
+    tid = ctx["rng"].choice(ctx["threads"]) if ctx["threads"] else None
+    body = {"thread_id": tid, "text": f"{_sentence(ctx['rng'], 10)} #{i}", "use_memory": True}
+    t0, ttft = time.perf_counter(), None
+    async with ctx["http"].stream("POST", ctx["app"] + "/api/send/stream", json=body) as r:
+        async for line in r.aiter_lines():
+            if ttft is None and line == "event: delta":
+                ttft = time.perf_counter() - t0
+        ok = r.status_code < 400
+    total = time.perf_counter() - t0
+    return total, ok and ttft is not None, {"send_stream_ttft": ttft if ttft is not None else total}
+
+async def sc_threads(ctx, i):
+    return await _timed(ctx["http"].get(ctx["app"] + "/api/threads"))
+
+async def sc_thread(ctx, i):
+    return await _timed(ctx["http"].get(f"{ctx['app']}/api/thread/{ctx['rng'].choice(ctx['threads'])}"))
+
+async def sc_search(ctx, i):
+    q = " ".join(ctx["rng"].sample(WORDS, 2))
+    return await _timed(ctx["http"].get(ctx["app"] + "/api/search", params={"q": q}))
+
+async def sc_upload(ctx, i):
+    return await _timed(ctx["http"].post(ctx["app"] + "/api/files/upload",
+                                         files={"files": (f"bench{i}.txt", _text_file(ctx["rng"]), "text/plain")}))
+
+async def prep_text(ctx, n):
+    # Osobny, niezindeksowany dokument na każde zapytanie — mierzymy ekstrakcję, nie cache ani kolejkę.
+    sem = asyncio.Semaphore(16)
+
+    async def one(i):
+        async with sem:
+            return await _upload(ctx, f"text{i}.txt", _text_file(ctx["rng"]), "text/plain")
+    ctx["docs"] = await asyncio.gather(*(one(i) for i in range(n)))
+
+async def sc_text(ctx, i):
+    return await _timed(ctx["http"].get(f"{ctx['app']}/api/files/{ctx['docs'][i]}/text"))
+
+async def prep_ocr(ctx, n):
+    from PIL import Image, ImageDraw
+    sem = asyncio.Semaphore(16)
+
+    async def one(i):
+        img = Image.new("L", (800, 200), 255)
+        ImageDraw.Draw(img).text((20, 80), f"{_sentence(ctx['rng'], 6)} {i}", fill=0)
+        buf = io.BytesIO()
+        img.save(buf, "PNG")
+        async with sem:
+            return await _upload(ctx, f"ocr{i}.png", buf.getvalue(), "image/png")
+    ctx["docs"] = await asyncio.gather(*(one(i) for i in range(n)))
+
+async def sc_ocr(ctx, i):
+    return await _timed(ctx["http"].get(f"{ctx['app']}/api/files/{ctx['docs'][i]}/ocr", params={"lang": "eng"}))
+
+async def sc_tts(ctx, i):
+    # Unikalny tekst, żeby nie mierzyć cache TTS.
+    return await _timed(ctx["http"].post(ctx["app"] + "/api/tts", json={"text": f"{_sentence(ctx['rng'], 12)} {i}"}))
+
+async def sc_export(ctx, i):
+    # Pełny eksport razem z wysyłką i listą wątków: strumień eksportu czyta bazę partiami
+    # w wątkach puli i nie może przy tym blokować bazy pozostałym żądaniom.
+    async def export():
+        t0, z, lines = time.perf_counter(), zlib.decompressobj(31), 0
+        async with ctx["http"].stream("GET", ctx["app"] + "/api/export") as r:
+            async for chunk in r.aiter_bytes():
+                lines += z.decompress(chunk).count(b"\n")
+            ok = r.status_code < 400 and z.eof and lines > 0
+        return time.perf_counter() - t0, ok
+
+    (t, ok), (t_send, ok_send), (_, ok_list) = await asyncio.gather(export(), sc_send(ctx, i), sc_threads(ctx, i))
+    return t, ok and ok_send and ok_list, {"export_send": t_send}
+
+SCENARIOS = {
+    "send": (sc_send, None), "send_stream": (sc_send_stream, None), "threads": (sc_threads, None),
+    "thread": (sc_thread, None), "search": (sc_search, None), "upload": (sc_upload, None),
+    "text": (sc_text, prep_text), "ocr": (sc_ocr, prep_ocr), "tts": (sc_tts, None),
+    "export": (sc_export, None),
+}
+
+
+# ---------------- pomiar ----------------
+def summarize(lat: list, errors: int, wall: float) -> dict:
+    lat = sorted(lat)
+    if len(lat) >= 2:
+        q = statistics.quantiles(lat, n=100, method="inclusive")
+        p50, p95, p99 = q[49], q[94], q[98]
+    else:
+        p50 = p95 = p99 = lat[0] if lat else 0.0
+    return {"n": len(lat), "errors": errors, "rps": round(len(lat) / wall, 2) if wall else 0.0,
+            "p50_ms": round(p50 * 1000, 1), "p95_ms": round(p95 * 1000, 1), "p99_ms": round(p99 * 1000, 1),
+            "max_ms": round(lat[-1] * 1000, 1) if lat else 0.0}
+
+async def run_level(ctx, name: str, conc: int, n: int) -> dict:
+    fn, prep = SCENARIOS[name]
+    if prep:
+        await prep(ctx, n)
+    lat, extra, errors, counter = [], {}, 0, iter(range(n))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            try:
+                res = await fn(ctx, i)
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            if not res[1]:
+                errors += 1
+                continue
+            lat.append(res[0])
+            for k, v in (res[2] if len(res) > 2 else {}).items():
+                extra.setdefault(k, []).append(v)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(conc)))
+    wall = time.perf_counter() - t0
+    out = {name: summarize(lat, errors, wall)}
+    out.update({k: summarize(v, 0, wall) for k, v in extra.items()})
+    return out
+
+async def run_all(args, app: str) -> dict:
+    levels = [int(x) for x in args.levels.split(",")]
+    limits = httpx.Limits(max_connections=max(levels) + 16, max_keepalive_connections=max(levels) + 16)
+    results = {}
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as http:
+        threads = (await http.get(app + "/api/threads", params={"limit": 200})).json().get("items", [])
+        ctx = {"http": http, "app": app, "rng": random.Random(args.seed), "threads": [t["id"] for t in threads]}
+        for name in args.endpoints.split(","):
+            if name not in SCENARIOS:
+                raise SystemExit(f"nieznany endpoint: {name} (dostępne: {', '.join(SCENARIOS)})")
+            if name == "thread" and not ctx["threads"]:
+                print("thread: brak wątków w bazie, pomijam")
+                continue
+            for conc in levels:
+                n = args.requests or max(conc * 4, 40)
+                for key, stats in (await run_level(ctx, name, conc, n)).items():
+                    results.setdefault(key, {})[str(conc)] = stats
+                    print(f"{key:<17} c={conc:<4} n={stats['n']:<5} err={stats['errors']:<4} "
+                          f"req/s={stats['rps']:8.1f}  p50={stats['p50_ms']:8.1f}ms  "
+                          f"p95={stats['p95_ms']:8.1f}ms  p99={stats['p99_ms']:8.1f}ms")
+    return results
+
+
+# ---------------- porównanie ----------------
+def compare(base: dict, new: dict, threshold: float) -> int:
+    """Wypisuje różnice p50/p95/rps; zwraca liczbę regresji p95 powyżej progu (w %)."""
+    regressions, common = 0, 0
+    print(f"{'endpoint':<17} {'c':>4} {'p50 ms':>17} {'p95 ms':>17} {'req/s':>15}")
+    for name, levels in new["results"].items():
+        for conc, s in levels.items():
+            b = base["results"].get(name, {}).get(conc)
+            if not b:
+                continue
+            common += 1
+
+            def delta(k):
+                return (s[k] - b[k]) / b[k] * 100 if b[k] else 0.0
+            bad = delta("p95_ms") > threshold or s["errors"] > b["errors"]
+            regressions += bad
+            print(f"{name:<17} {conc:>4} {b['p50_ms']:7.1f}→{s['p50_ms']:7.1f} "
+                  f"{b['p95_ms']:7.1f}→{s['p95_ms']:7.1f} {b['rps']:6.1f}→{s['rps']:6.1f} "
+                  f"({delta('p95_ms'):+.0f}% p95){'  REGRESJA' if bad else ''}")
+    if not common:
+        print("(brak wspólnych endpointów i poziomów współbieżności)")
+    return regressions
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p_seed = sub.add_parser("seed", help="zasiewa katalog danych syntetycznymi danymi")
+    p_seed.add_argument("--scale", choices=SCALES, default="small")
+    p_seed.add_argument("--data-dir", required=True)
+    p_seed.add_argument("--seed", type=int, default=1)
+    p_run = sub.add_parser("run", help="uruchamia stub + aplikację i mierzy endpointy")
+    p_run.add_argument("--scale", choices=SCALES, default="small")
+    p_run.add_argument("--data-dir", help="gotowy (zasiany) katalog danych; domyślnie tymczasowy")
+    p_run.add_argument("--app", help="mierz już działającą aplikację (bez startu stuba i app.py)")
+    p_run.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    p_run.add_argument("--levels", default="1,10,50")
+    p_run.add_argument("--requests", type=int, default=0, help="zapytań na poziom [domyślnie max(4*c, 40)]")
+    p_run.add_argument("--workers", type=int, default=1)
+    p_run.add_argument("--port", type=int, default=8765)
+    p_run.add_argument("--stub-port", type=int, default=9765)
+    p_run.add_argument("--latency", type=float, default=0.5, help="opóźnienie stuba [s]")
+    p_run.add_argument("--ttft", type=float, default=0.2, help="czas do pierwszego tokenu stuba [s]")
+    p_run.add_argument("--tokens", type=int, default=60)
+    p_run.add_argument("--rpm", type=int, default=10**6, help="CHEAPCHAT_UPSTREAM_RPM dla aplikacji")
+    p_run.add_argument("--timeout", type=float, default=120)
+    p_run.add_argument("--seed", type=int, default=1)
+    p_run.add_argument("--out", help="zapis wyników (JSON)")
+    p_run.add_argument("--compare", help="baseline JSON do porównania")
+    p_run.add_argument("--threshold", type=float, default=15.0, help="dopuszczalny wzrost p95 [%%]")
+    p_cmp = sub.add_parser("compare", help="porównuje dwa pliki wyników")
+    p_cmp.add_argument("base")
+    p_cmp.add_argument("new")
+    p_cmp.add_argument("--threshold", type=float, default=15.0)
+    args = ap.parse_args()
+
+    if args.cmd == "seed":
+        seed_data_dir(pathlib.Path(args.data_dir), args.scale, args.seed)
+        return
+    if args.cmd == "compare":
+        base, new = (json.loads(pathlib.Path(p).read_text()) for p in (args.base, args.new))
+        sys.exit(1 if compare(base, new, args.threshold) else 0)
+
+    tmp, procs = None, []
+    try:
+        if args.app:
+            app = args.app.rstrip("/")
+        else:
+            if args.data_dir:
+                data_dir = pathlib.Path(args.data_dir)
+                if not (data_dir / "memory.sqlite").exists():
+                    seed_data_dir(data_dir, args.scale, args.seed)
+            else:
+                data_dir = pathlib.Path(tmp := tempfile.mkdtemp(prefix="cheapchat-bench-"))
+                seed_data_dir(data_dir, args.scale, args.seed)
+            procs = start_stack(args, data_dir)
+            app = f"http://127.0.0.1:{args.port}"
+        results = asyncio.run(run_all(args, app))
+    finally:
+        stop_stack(procs)
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+    report = {
+        "meta": {"created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "git": _git_rev(), "scale": args.scale,
+                 "levels": args.levels, "workers": args.workers, "python": platform.python_version(),
+                 "stub": {"latency": args.latency, "ttft": args.ttft, "tokens": args.tokens}},
+        "results": results,
+    }
+    if args.out:
+        pathlib.Path(args.out).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+        print(f"[bench] zapisano {args.out}")
+    if args.compare:
+        sys.exit(1 if compare(json.loads(pathlib.Path(args.compare).read_text()), report, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
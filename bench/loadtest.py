@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test skalowania współbieżności /api/send względem bench/stub_openai.py.
+
+Dla każdego poziomu współbieżności wysyła N równoległych zapytań i wypisuje
+przepustowość, medianę i maksimum czasu oraz szczyt równoległych wywołań
+widziany przez stub. Przy opóźnieniu stuba 1 s przepustowość powinna rosnąć
+liniowo z poziomem współbieżności, także powyżej ~40 wątków Starlette.
+
+    python bench/loadtest.py --app http://127.0.0.1:8000 --stub http://127.0.0.1:9100 --levels 1,10,50,200
+"""
+import argparse, asyncio, statistics, time
+
+import httpx
+
+
+async def one(http: httpx.AsyncClient, app: str, i: int) -> float:
+    t0 = time.perf_counter()
+    r = await http.post(f"{app}/api/send", json={"text": f"ping {i}", "use_memory": False})
+    r.raise_for_status()
+    return time.perf_counter() - t0
+
+
+async def level(app: str, stub: str, n: int):
+    limits = httpx.Limits(max_connections=n, max_keepalive_connections=n)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as http:
+        t0 = time.perf_counter()
+        lat = await asyncio.gather(*(one(http, app, i) for i in range(n)))
+        wall = time.perf_counter() - t0
+        peak = (await http.get(f"{stub}/stats")).json().get("peak_inflight")
+    print(f"c={n:<4} req/s={n / wall:7.1f}  p50={statistics.median(lat):6.2f}s  "
+          f"max={max(lat):6.2f}s  wall={wall:6.2f}s  stub_peak={peak}")
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--app", default="http://127.0.0.1:8000")
+    ap.add_argument("--stub", default="http://127.0.0.1:9100")
+    ap.add_argument("--levels", default="1,10,50,100,200")
+    args = ap.parse_args()
+    for n in (int(x) for x in args.levels.split(",")):
+        await level(args.app, args.stub, n)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Lokalny, udawany serwer OpenAI do testów obciążeniowych.
+
+Obsługuje te endpointy, których używa app.py (responses, audio, images),
+z konfigurowalnym opóźnieniem i wstrzykiwaniem błędów (429 z Retry-After, 5xx,
+awaria wybranych modeli). Uruchomienie:
+
+    python bench/stub_openai.py --port 9100 --latency 1.0
+    python bench/stub_openai.py --rate-limit 20 --error-rate 0.1 --fail-models gpt-5-mini
+
+a potem aplikacja z:
+
+    OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=sk-stub-000000000000000000 python app.py
+"""
+import argparse, asyncio, base64, json, random, time, uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# 1x1 PNG
+PNG_1PX = base64.b64encode(bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082"
+)).decode()
+
+CFG = {"latency": 1.0, "ttft": 0.3, "tokens": 60, "inflight": 0, "peak": 0,
+       "rate_limit": 0, "retry_after": 1.0, "error_rate": 0.0, "fail_models": set()}
+COUNTS = {"requests": 0, "rate_limited": 0, "errors": 0}
+_WINDOW = []  # znaczniki czasu zapytań z ostatniej sekundy (limit --rate-limit)
+app = FastAPI(title="stub-openai")
+
+
+def _inject(model: str = ""):
+    """Zwraca odpowiedź z błędem, jeśli to zapytanie ma dostać 429/5xx, inaczej None."""
+    COUNTS["requests"] += 1
+    now = time.monotonic()
+    if CFG["rate_limit"]:
+        while _WINDOW and now - _WINDOW[0] >= 1.0:
+            _WINDOW.pop(0)
+        if len(_WINDOW) >= CFG["rate_limit"]:
+            COUNTS["rate_limited"] += 1
+            return JSONResponse({"error": {"message": "Rate limit reached", "type": "requests",
+                                           "code": "rate_limit_exceeded"}},
+                                status_code=429, headers={"retry-after": f"{CFG['retry_after']:g}"})
+        _WINDOW.append(now)
+    if model in CFG["fail_models"] or random.random() < CFG["error_rate"]:
+        COUNTS["errors"] += 1
+        return JSONResponse({"error": {"message": "The server had an error", "type": "server_error"}},
+                            status_code=random.choice((500, 502, 503)))
+    return None
+
+
+class _Inflight:
+    def __enter__(self):
+        CFG["inflight"] += 1
+        CFG["peak"] = max(CFG["peak"], CFG["inflight"])
+
+    def __exit__(self, *exc):
+        CFG["inflight"] -= 1
+
+
+def _response_obj(model: str, text: str) -> dict:
+    return {
+        "id": f"resp_{uuid.uuid4().hex}", "object": "response", "created_at": int(time.time()),
+        "model": model, "status": "completed",
+        "output": [{
+            "type": "message", "id": f"msg_{uuid.uuid4().hex}", "status": "completed", "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "usage": {"input_tokens": 10, "output_tokens": CFG["tokens"], "total_tokens": 10 + CFG["tokens"],
+                  "input_tokens_details": {"cached_tokens": 0}, "output_tokens_details": {"reasoning_tokens": 0}},
+    }
+
+
+@app.post("/v1/responses")
+async def responses(request: Request):
+    body = await request.json()
+    model = body.get("model", "stub")
+    if (err := _inject(model)) is not None:
+        return err
+    words = [f"słowo{i} " for i in range(CFG["tokens"])]
+    if not body.get("stream"):
+        with _Inflight():
+            await asyncio.sleep(CFG["latency"])
+        return _response_obj(model, "".join(words))
+
+    async def events():
+        with _Inflight():
+            await asyncio.sleep(CFG["ttft"])
+            step = max(CFG["latency"] - CFG["ttft"], 0) / max(len(words), 1)
+            for n, w in enumerate(words):
+                ev = {"type": "response.output_text.delta", "delta": w, "item_id": "msg_stub",
+                      "output_index": 0, "content_index": 0, "sequence_number": n}
+                yield f"event: {ev['type']}\ndata: {json.dumps(ev, ensure_ascii=False)}\n\n"
+                await asyncio.sleep(step)
+            ev = {"type": "response.completed", "sequence_number": len(words),
+                  "response": _response_obj(model, "".join(words))}
+            yield f"event: {ev['type']}\ndata: {json.dumps(ev, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/v1/audio/speech")
+async def speech(request: Request):
+    body = await request.json()
+    if (err := _inject(body.get("model", ""))) is not None:
+        return err
+    with _Inflight():
+        await asyncio.sleep(CFG["latency"])
+    # Nie jest to poprawne MP3, ale wystarcza do pomiarów.
+    return Response(content=b"ID3" + (body.get("input", "") * 16).encode()[:65536], media_type="audio/mpeg")
+
+
+@app.post("/v1/audio/transcriptions")
+async def transcriptions(request: Request):
+    size = len(await request.body())
+    if (err := _inject()) is not None:
+        return err
+    with _Inflight():
+        await asyncio.sleep(CFG["latency"])
+    return {"text": f"transkrypcja testowa ({size} B)"}
+
+
+@app.post("/v1/images/generations")
+async def images(request: Request):
+    body = await request.json()
+    if (err := _inject(body.get("model", ""))) is not None:
+        return err
+    with _Inflight():
+        await asyncio.sleep(CFG["latency"])
+    return {"created": int(time.time()), "data": [{"b64_json": PNG_1PX}]}
+
+
+@app.get("/search")
+async def search(request: Request, q: str = "", n: int = 5):
+    # Zastępczy backend wyszukiwania (CHEAPCHAT_SEARCH_URL=http://127.0.0.1:9100/search).
+    base = str(request.base_url).rstrip("/")
+    await asyncio.sleep(CFG["latency"] / 4)
+    return [{"title": f"{q} #{i}", "url": f"{base}/page/{i}?q={q}", "snippet": f"wynik {i} dla: {q}"} for i in range(n)]
+
+
+@app.get("/page/{i}")
+async def page(i: int, q: str = ""):
+    await asyncio.sleep(CFG["latency"] / 2 * (i + 1))
+    html = (f"<html><head><title>{q}</title><style>p{{}}</style></head><body><nav>menu</nav>"
+            f"<h1>Strona {i}</h1><p>Treść o: {q}.</p><script>var x=1;</script></body></html>")
+    return Response(content=html, media_type="text/html; charset=utf-8")
+
+
+@app.get("/stats")
+def stats():
+    # Szczyt jest zerowany przy każdym odczycie, żeby mierzyć kolejne serie osobno.
+    peak, CFG["peak"] = CFG["peak"], CFG["inflight"]
+    return JSONResponse({"inflight": CFG["inflight"], "peak_inflight": peak, **COUNTS})
+
+
+@app.post("/config")
+async def config(request: Request):
+    # Zmiana wstrzykiwanych błędów w trakcie testu, np. {"fail_models": ["gpt-5-mini"]} albo {"error_rate": 0}.
+    body = await request.json()
+    for k in ("latency", "ttft", "tokens", "rate_limit", "retry_after", "error_rate"):
+        if k in body:
+            CFG[k] = type(CFG[k])(body[k])
+    if "fail_models" in body:
+        CFG["fail_models"] = set(body["fail_models"])
+    return {k: (sorted(v) if isinstance(v, set) else v) for k, v in CFG.items()}
+
+
+if __name__ == "__main__":
+    import uvicorn
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=9100)
+    ap.add_argument("--latency", type=float, default=CFG["latency"], help="czas odpowiedzi [s]")
+    ap.add_argument("--ttft", type=float, default=CFG["ttft"], help="czas do pierwszego tokenu przy stream [s]")
+    ap.add_argument("--tokens", type=int, default=CFG["tokens"], help="liczba tokenów w odpowiedzi")
+    ap.add_argument("--rate-limit", type=int, default=0, help="max zapytań/s; powyżej 429 [0 = bez limitu]")
+    ap.add_argument("--retry-after", type=float, default=CFG["retry_after"], help="Retry-After przy 429 [s]")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="odsetek losowych odpowiedzi 5xx (0..1)")
+    ap.add_argument("--fail-models", default="", help="modele, które zawsze dostają 5xx (po przecinku)")
+    args = ap.parse_args()
+    CFG.update(latency=args.latency, ttft=args.ttft, tokens=args.tokens, rate_limit=args.rate_limit,
+               retry_after=args.retry_after, error_rate=args.error_rate,
+               fail_models={m for m in args.fail_models.split(",") if m})
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -1,5 +1,8 @@
 // --- ELEMENTY ---
 let threadId = "";
+let lastTurn = 0;          // numer ostatniej tury użytkownika w bieżącym wątku
+let olderCursor = null;    // before_id starszej strony historii (null = wszystko wczytane)
+let threadsCursor = null;
 const threadsDiv = document.getElementById('threads');
 const renameInp = document.getElementById('renameInp');
 const renameBtn = document.getElementById('renameBtn');
@@ -49,17 +52,22 @@ function enhanceCodeBlocks(container){
 }
 function setStatus(txt){ statusEl.textContent = txt; }
 
-function addTextMsg(role, text, turnIndex=null){
+function textMsgEl(role, text, turnIndex=null){
   const b = el('div','msg ' + (role==='user'?'user':'assistant'));
   const meta = el('div','meta'); meta.textContent = role==='user' ? (turnIndex ? `Ty (#${turnIndex})` : 'Ty') : 'Asystent';
   const body = el('div');
   if (role === 'assistant') body.innerHTML = renderMarkdown(text);
   else body.textContent = text;
   if (turnIndex) b.id = `turn-${turnIndex}`;
-  b.appendChild(meta); b.appendChild(body); chat.appendChild(b);
-  chat.scrollTop = chat.scrollHeight;
+  b.appendChild(meta); b.appendChild(body);
   return {container:b, body};
 }
+function addTextMsg(role, text, turnIndex=null){
+  const m = textMsgEl(role, text, turnIndex);
+  chat.appendChild(m.container);
+  chat.scrollTop = chat.scrollHeight;
+  return m;
+}
 function addTypingBubble(){
   const {container, body} = addTextMsg('assistant', '');
   container.classList.add('typing-bubble');
@@ -76,55 +84,117 @@ function replaceTypingBubble(bubble, md){
   chat.scrollTop = chat.scrollHeight;
 }
 
-function addImageMsg(url, alt="Wygenerowany obraz"){
+function imageMsgEl(url, alt="Wygenerowany obraz"){
   const b = el('div','msg assistant');
   const meta = el('div','meta'); meta.textContent = 'Asystent (obraz)';
-  const img = el('img','chatimg'); img.src=url; img.alt=alt;
-  b.appendChild(meta); b.appendChild(img); chat.appendChild(b);
+  const img = el('img','chatimg'); img.src=url; img.alt=alt; img.loading='lazy';
+  b.appendChild(meta); b.appendChild(img);
+  return b;
+}
+function addImageMsg(url, alt="Wygenerowany obraz"){
+  chat.appendChild(imageMsgEl(url, alt));
   chat.scrollTop = chat.scrollHeight;
 }
 
-// Wątki
+// Wątki (lista stronicowana kursorem; puste wątki serwer pomija i sprząta)
 async function refreshThreads(){
-  const r = await fetch('/api/threads'); const data = await r.json();
+  const data = await (await fetch('/api/threads')).json();
+  threadsDiv.innerHTML = "";
   renderThreadList(data);
-  if (threadId){
-    const me = data.find(t => t.id === threadId);
-    if (me){ renameInp.value = me.title || ''; localStorage.setItem('use_mem', me.use_memory ? '1' : '0'); }
-  }
 }
-function renderThreadList(items){
-  threadsDiv.innerHTML = "";
-  for(const t of items){
-    const d = el('div','th' + (t.id===threadId?' active':'')); d.textContent = t.title || t.id;
+async function moreThreads(){
+  if(!threadsCursor) return;
+  const data = await (await fetch('/api/threads?before='+encodeURIComponent(threadsCursor))).json();
+  renderThreadList(data);
+}
+function renderThreadList(data){
+  threadsDiv.querySelector('.more')?.remove();
+  threadsCursor = data.next;
+  for(const t of data.items){
+    const d = el('div','th' + (t.id===threadId?' active':'')); d.textContent = t.title || t.id; d.dataset.id = t.id;
     const del = el('button','del'); del.innerHTML = '🗑️'; del.title='Usuń wątek';
     del.onclick = async (ev)=>{ ev.stopPropagation(); if(!confirm('Na pewno usunąć ten wątek?')) return;
       const r = await fetch('/api/thread/'+t.id, {method:'DELETE'});
-      if(r.ok){ if(threadId===t.id){ threadId=""; localStorage.removeItem('threadId'); chat.innerHTML=""; toc.innerHTML=""; renameInp.value=""; } refreshThreads(); }
+      if(r.ok){ if(threadId===t.id) newThread(); refreshThreads(); }
     };
     d.appendChild(del);
+    if(t.id===threadId && t.title!==t.id) renameInp.value = t.title;
     d.onclick = ()=>{ loadThread(t.id); };
     threadsDiv.appendChild(d);
   }
+  if(threadsCursor){
+    const more = el('div','th more'); more.textContent = 'Więcej…';
+    more.onclick = moreThreads;
+    threadsDiv.appendChild(more);
+  }
 }
-async function newThread(){
-  const r = await fetch('/api/new_thread', {method:'POST'}); const js = await r.json();
-  await loadThread(js.thread_id);
-  addTextMsg('assistant','Utworzono nowy wątek.');
-}
-async function loadThread(id){
+function setThread(id){
   threadId = id;
-  localStorage.setItem('threadId', threadId);
-  const r = await fetch('/api/thread/'+id); const data = await r.json();
-  chat.innerHTML = "";
-  let ti = 0;
-  for(const m of data){
+  if(id) localStorage.setItem('threadId', id); else localStorage.removeItem('threadId');
+  threadsDiv.querySelectorAll('.th').forEach(d => d.classList.toggle('active', !!id && d.dataset.id === id));
+}
+// Wątek powstaje na serwerze przy pierwszej wiadomości, nie przy otwarciu strony.
+function newThread(){
+  setThread(""); olderCursor = null; lastTurn = 0;
+  chat.innerHTML = ""; toc.innerHTML = ""; renameInp.value = "";
+  addTextMsg('assistant','Nowy wątek — napisz pierwszą wiadomość.');
+}
+function pageEls(data){
+  const frag = document.createDocumentFragment();
+  let ti = data.turn_offset;
+  for(const m of data.items){
     if(m.kind==='image' && typeof m.content === 'string'){ try{ m.content = JSON.parse(m.content);}catch(e){} }
-    if(m.role==='user' && m.kind==='text'){ ti += 1; addTextMsg('user', m.content, ti); }
-    else if(m.kind==='image' && m.content && m.content.url){ addImageMsg(m.content.url, m.content.prompt||'Obraz'); }
-    else{ addTextMsg(m.role, m.content); }
+    if(m.role==='user' && m.kind==='text'){ ti += 1; frag.appendChild(textMsgEl('user', m.content, ti).container); }
+    else if(m.kind==='image' && m.content && m.content.url){ frag.appendChild(imageMsgEl(m.content.url, m.content.prompt||'Obraz')); }
+    else{
+      const e = textMsgEl(m.role, m.content).container;
+      if(m.route){ const meta = e.querySelector('.meta'); meta.textContent = `Asystent · ${m.route.model}`; meta.title = m.route.reason; }
+      frag.appendChild(e);
+    }
   }
-  await refreshThreads(); await refreshToc();
+  return {frag, lastTurn: ti};
+}
+// Przycisk "starsze" na górze czatu; wczytuje sam, gdy zostanie przewinięty do widoku.
+const olderObserver = new IntersectionObserver(es => { if(es.some(e => e.isIntersecting)) loadOlder(); }, {root: chat});
+function placeOlderButton(){
+  chat.querySelector('.older')?.remove();
+  if(!olderCursor) return;
+  const b = el('button','older'); b.textContent = 'Wczytaj starsze wiadomości';
+  b.onclick = loadOlder;
+  chat.prepend(b);
+  olderObserver.observe(b);
+}
+let loadingOlder = null;
+function loadOlder(){
+  if(!olderCursor || loadingOlder) return loadingOlder;
+  const id = threadId;
+  loadingOlder = (async ()=>{
+    const data = await (await fetch(`/api/thread/${id}?before_id=${olderCursor}`)).json();
+    if(id !== threadId) return;
+    const h = chat.scrollHeight;
+    chat.querySelector('.older')?.remove();
+    chat.prepend(pageEls(data).frag);
+    chat.scrollTop += chat.scrollHeight - h;   // bez skoku widoku
+    olderCursor = data.next;
+    placeOlderButton();
+  })().finally(()=>{ loadingOlder = null; });
+  return loadingOlder;
+}
+async function loadThread(id){
+  const r = await fetch('/api/thread/'+id);
+  if(!r.ok){ newThread(); return; }
+  const data = await r.json();
+  setThread(id);
+  renameInp.value = data.thread.title === id ? '' : data.thread.title;
+  localStorage.setItem('use_mem', data.thread.use_memory ? '1' : '0');
+  chat.innerHTML = "";
+  const page = pageEls(data);
+  chat.appendChild(page.frag);
+  lastTurn = page.lastTurn;
+  olderCursor = data.next;
+  placeOlderButton();
+  chat.scrollTop = chat.scrollHeight;
+  await refreshToc();
 }
 newBtn.onclick = newThread;
 
@@ -141,8 +211,10 @@ async function refreshToc(){
   toc.innerHTML = "";
   if(!threadId) return;
   const anchors = await (await fetch('/api/anchors/'+threadId)).json();
-  const turns = [...chat.querySelectorAll('.msg.user')].map((_,i)=>i+1);
-  for(const i of turns){
+  // Tury z wczytanych stron + te z etykietą (mogą być jeszcze niewczytane).
+  const turns = new Set([...chat.querySelectorAll('.msg.user[id^="turn-"]')].map(x => +x.id.slice(5)));
+  anchors.forEach(a => turns.add(a.turn_index));
+  for(const i of [...turns].sort((a,b)=>a-b)){
     const row = el('div','th');
     const label = anchors.find(x => x.turn_index===i)?.label || ""
     const a = el('span'); a.textContent = label ? `#${i} — ${label}` : `#${i}`;
@@ -159,7 +231,10 @@ async function refreshToc(){
       refreshToc();
     };
     row.appendChild(a); row.appendChild(edit);
-    row.onclick = ()=>{ document.getElementById('turn-'+i)?.scrollIntoView({behavior:'smooth', block:'start'}); };
+    row.onclick = async ()=>{
+      while(!document.getElementById('turn-'+i) && olderCursor){ await loadOlder(); }
+      document.getElementById('turn-'+i)?.scrollIntoView({behavior:'smooth', block:'start'});
+    };
     toc.appendChild(row);
   }
 }
@@ -168,12 +243,55 @@ async function refreshToc(){
 function loadTheme(){ const t = localStorage.getItem('theme') || 'theme-dark'; document.body.className = t; }
 
 // Wyślij
+// Czyta strumień SSE z /api/send/stream i woła onEvent(event, data) dla każdego zdarzenia.
+async function readSSE(resp, onEvent){
+  const reader = resp.body.getReader(); const dec = new TextDecoder(); let buf = '';
+  for(;;){
+    const {value, done} = await reader.read();
+    if(done) break;
+    buf += dec.decode(value, {stream:true});
+    let i;
+    while((i = buf.indexOf('\n\n')) >= 0){
+      const frame = buf.slice(0, i); buf = buf.slice(i+2);
+      let ev = 'message', data = '';
+      for(const line of frame.split('\n')){
+        if(line.startsWith('event:')) ev = line.slice(6).trim();
+        else if(line.startsWith('data:')) data += line.slice(5).trim();
+      }
+      if(data) onEvent(ev, JSON.parse(data));
+    }
+  }
+}
+// Renderuje narastającą odpowiedź najwyżej raz na klatkę.
+function streamRenderer(bubble){
+  let md = '', pending = false, started = false;
+  const body = bubble.querySelector('div:not(.meta)');
+  const flush = ()=>{
+    pending = false;
+    const stick = chat.scrollHeight - chat.scrollTop - chat.clientHeight < 40;
+    body.innerHTML = renderMarkdown(md);
+    if(stick) chat.scrollTop = chat.scrollHeight;
+  };
+  return {
+    push(t){
+      if(!started){ started = true; bubble.classList.remove('typing-bubble'); }
+      md += t;
+      if(!pending){ pending = true; requestAnimationFrame(flush); }
+    },
+    text(){ return md; },
+  };
+}
+function newKey(){
+  return (crypto.randomUUID && crypto.randomUUID()) || (Date.now().toString(36) + Math.random().toString(36).slice(2));
+}
 async function sendText(text){
-  const turn = chat.querySelectorAll('.msg.user').length+1;
+  const turn = ++lastTurn;
   addTextMsg('user', text, turn);
   const bubble = addTypingBubble();
   setStatus('myślę…');
   sendBtn.disabled = true;
+  const t0 = performance.now(); let ttft = null;
+  const view = streamRenderer(bubble);
   try{
     const payload = {
       thread_id: threadId || null,
@@ -181,16 +299,30 @@ async function sendText(text){
       web: localStorage.getItem('web') === '1',
       use_memory: localStorage.getItem('use_mem') !== '0',
       model: localStorage.getItem('model') || undefined,
-      files: Array.from(selectedFiles)
+      files: Array.from(selectedFiles),
+      idempotency_key: newKey()
     };
-    const r = await fetch('/api/send', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(payload)});
-    const raw = await r.text(); let data; try { data = JSON.parse(raw); } catch(_){ throw new Error(`HTTP ${r.status} — nie-JSON:\n${raw}`); }
-    if(!r.ok) throw new Error(data?.detail || `HTTP ${r.status}`);
-    if(!threadId) threadId = data.thread_id;
-    replaceTypingBubble(bubble, data.reply);
-    window._lastReply = data.reply;
+    // Ponowienie po zerwanym połączeniu idzie z tym samym kluczem — serwer nie wyśle wiadomości drugi raz.
+    const post = () => fetch('/api/send/stream', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(payload)});
+    const r = await post().catch(post);
+    if(!r.ok){
+      const raw = await r.text(); let data; try { data = JSON.parse(raw); } catch(_){ throw new Error(`HTTP ${r.status} — nie-JSON:\n${raw}`); }
+      throw new Error(data?.detail || `HTTP ${r.status}`);
+    }
+    let done = null, err = null, info = null;
+    await readSSE(r, (ev, data)=>{
+      if(ev==='meta'){ info = data; if(!threadId) setThread(data.thread_id); }
+      else if(ev==='delta'){ if(ttft===null){ ttft = performance.now()-t0; setStatus('piszę…'); } view.push(data.t); }
+      else if(ev==='done'){ done = data; }
+      else if(ev==='error'){ err = data.detail; }
+    });
+    if(err && !view.text()) throw new Error(err);
+    replaceTypingBubble(bubble, view.text() + (err ? `\n\n**Błąd:** ${err}` : ''));
+    window._lastReply = view.text();
     refreshThreads(); refreshToc();
-    setStatus(`gotowy · ${data.tokens||0} tok`);
+    statusEl.title = info?.route || '';
+    const total = performance.now()-t0;
+    setStatus(`gotowy${info?.model ? ' · ' + info.model : ''} · ${done?.tokens||0} tok · TTFT ${Math.round(ttft ?? total)} ms · ${(total/1000).toFixed(1)} s`);
   }catch(e){
     bubble.remove();
     addTextMsg('assistant', `**Błąd:** ${e.message}`);
@@ -212,7 +344,7 @@ imgBtn.onclick = async ()=>{
     const r = await fetch('/api/image', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({thread_id: threadId || null, prompt})});
     const raw = await r.text(); let data; try { data = JSON.parse(raw); } catch(_){ throw new Error(`HTTP ${r.status} — nie-JSON:\n${raw}`); }
     if(!r.ok) throw new Error(data?.detail || `HTTP ${r.status}`);
-    if(!threadId) threadId = data.thread_id;
+    if(!threadId) setThread(data.thread_id);
     addImageMsg(data.url, data.prompt);
     window._lastReply = `Obraz: ${data.url}`; inp.value = "";
     refreshThreads(); refreshToc();
@@ -221,37 +353,120 @@ imgBtn.onclick = async ()=>{
   finally{ imgBtn.disabled = false; }
 };
 
-// Nagrywanie
-let mediaRecorder, chunks=[];
+// Nagrywanie: segmenty tnięte na ciszy (lub po SEG_MAX_MS) są wysyłane od razu,
+// serwer transkrybuje je równolegle, a po puszczeniu przycisku czekamy tylko na ostatni.
+const SEG_MIN_MS = 3000, SEG_MAX_MS = 20000, SILENCE_MS = 700, SILENCE_RMS = 0.015;
+let rec = null;
+
 async function startRec(){
+  if(rec) return;
   const stream = await navigator.mediaDevices.getUserMedia({ audio:true });
-  chunks=[]; mediaRecorder = new MediaRecorder(stream, {mimeType:'audio/webm'});
-  mediaRecorder.ondataavailable = e => chunks.push(e.data);
-  mediaRecorder.onstop = async ()=>{
-    setStatus('transkrybuję…');
-    const blob = new Blob(chunks, {type:'audio/webm'});
-    const fd = new FormData(); fd.append('file', blob, 'audio.webm');
-    const r = await fetch('/api/transcribe', {method:'POST', body:fd});
-    const js = await r.json();
-    const text = (js && js.text) ? js.text : '';
-    if(text){ inp.value = text; sendText(text); } else { setStatus('gotowy'); }
+  const js = await (await fetch('/api/transcribe/session', {method:'POST'})).json();
+  const ctx = new AudioContext(), an = ctx.createAnalyser();
+  ctx.createMediaStreamSource(stream).connect(an);
+  rec = {stream, ctx, an, sid: js.session_id, seq: 0, uploads: [], active: true, recorder: null};
+  micBtn.classList.add('rec');
+  nextSegment(rec);
+  watchSilence(rec);
+}
+
+function nextSegment(r){
+  const parts = [], mr = new MediaRecorder(r.stream, {mimeType:'audio/webm'});
+  const seq = r.seq++;
+  r.recorder = mr; r.segStart = performance.now(); r.silentSince = null;
+  mr.ondataavailable = e => { if(e.data.size) parts.push(e.data); };
+  mr.onstop = ()=>{
+    const blob = new Blob(parts, {type:'audio/webm'});
+    r.uploads.push(fetch(`/api/transcribe/session/${r.sid}/${seq}`, {method:'POST', body: blob})
+      .then(res => res.ok ? res.json() : null)
+      .then(js => { if(js && js.partial && r.active) setStatus(`nagrywam… ${js.partial.slice(-60)}`); })
+      .catch(()=>{}));
   };
-  mediaRecorder.start(); micBtn.classList.add('rec');
+  mr.start();
+}
+
+function watchSilence(r){
+  const buf = new Float32Array(r.an.fftSize);
+  const tick = ()=>{
+    if(!r.active) return;
+    r.an.getFloatTimeDomainData(buf);
+    let sum = 0; for(const v of buf) sum += v*v;
+    const now = performance.now(), len = now - r.segStart;
+    if(Math.sqrt(sum / buf.length) < SILENCE_RMS){ r.silentSince = r.silentSince ?? now; } else { r.silentSince = null; }
+    const cutOnSilence = len > SEG_MIN_MS && r.silentSince && now - r.silentSince > SILENCE_MS;
+    if(cutOnSilence || len > SEG_MAX_MS){ r.recorder.stop(); nextSegment(r); }
+    setTimeout(tick, 50);   // nie rAF: ma działać też w karcie w tle
+  };
+  tick();
+}
+
+async function stopRec(){
+  const r = rec; if(!r) return;
+  rec = null; r.active = false;
+  micBtn.classList.remove('rec');
+  setStatus('transkrybuję…');
+  await new Promise(res => { r.recorder.addEventListener('stop', res, {once:true}); r.recorder.stop(); });
+  r.stream.getTracks().forEach(t => t.stop()); r.ctx.close();
+  await Promise.all(r.uploads);
+  const js = await (await fetch(`/api/transcribe/session/${r.sid}/finish`, {method:'POST'})).json();
+  const text = (js && js.text) ? js.text : '';
+  if(text){ inp.value = text; sendText(text); } else { setStatus('gotowy'); }
 }
-function stopRec(){ if(mediaRecorder){ mediaRecorder.stop(); micBtn.classList.remove('rec'); } }
-micBtn.onmousedown = startRec; micBtn.onmouseup = stopRec; micBtn.onmouseleave= ()=>{ if(mediaRecorder && mediaRecorder.state==='recording') stopRec(); };
+micBtn.onmousedown = startRec; micBtn.onmouseup = stopRec; micBtn.onmouseleave= ()=>{ if(rec) stopRec(); };
 
 // TTS
+const ttsCache = new Map();   // "głos|tekst" -> blob URL (w obrębie karty)
+let ttsAudio = null;
+
+function playTTS(text, voice){
+  const key = `${voice}|${text}`;
+  if(ttsAudio){ ttsAudio.pause(); }
+  if(ttsCache.has(key)){ ttsAudio = new Audio(ttsCache.get(key)); return ttsAudio.play(); }
+  const body = JSON.stringify({text, voice});
+  const headers = {'Content-Type':'application/json'};
+  if(!(window.MediaSource && MediaSource.isTypeSupported('audio/mpeg'))){
+    return fetch('/api/tts', {method:'POST', headers, body}).then(r=>{
+      if(!r.ok) throw new Error(`TTS ${r.status}`);
+      return r.blob();
+    }).then(blob=>{
+      const url = URL.createObjectURL(blob); ttsCache.set(key, url);
+      ttsAudio = new Audio(url); return ttsAudio.play();
+    });
+  }
+  // Strumień: odtwarzanie rusza po pierwszym zdaniu, reszta dopisywana do bufora.
+  const ms = new MediaSource();
+  ttsAudio = new Audio(URL.createObjectURL(ms));
+  const parts = [];
+  ms.addEventListener('sourceopen', async ()=>{
+    const sb = ms.addSourceBuffer('audio/mpeg');
+    const append = buf => new Promise(res=>{ sb.addEventListener('updateend', res, {once:true}); sb.appendBuffer(buf); });
+    try{
+      const r = await fetch('/api/tts/stream', {method:'POST', headers, body});
+      if(!r.ok) throw new Error(`TTS ${r.status}`);
+      const reader = r.body.getReader();
+      for(;;){
+        const {done, value} = await reader.read();
+        if(done) break;
+        parts.push(value);
+        await append(value);
+      }
+      ms.endOfStream();
+      ttsCache.set(key, URL.createObjectURL(new Blob(parts, {type:'audio/mpeg'})));
+    }catch(e){
+      if(ms.readyState === 'open') ms.endOfStream('network');
+      setStatus('błąd syntezy');
+    }
+  }, {once:true});
+  return ttsAudio.play();
+}
+
 speakBtn.onclick = async ()=>{
   const text = window._lastReply || '';
   if(!text){ alert("Brak odpowiedzi do przeczytania."); return; }
   const voice = localStorage.getItem('voice') || 'alloy';
   setStatus('syntezuję…');
-  const r = await fetch('/api/tts', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({text, voice})});
-  const buf = await r.arrayBuffer();
-  const url = URL.createObjectURL(new Blob([buf], {type:'audio/mpeg'}));
-const audio = new Audio(url); audio.play();
-setStatus('gotowy');
+  try{ await playTTS(text, voice); setStatus('gotowy'); }
+  catch(e){ setStatus('błąd syntezy'); }
 };
 
 // Ustawienia
@@ -284,6 +499,35 @@ async function uploadFiles(files){
   setStatus('gotowy');
 }
 
+// OCR strona po stronie: strony pojawiają się w kolejności numerów, gdy tylko są gotowe.
+async function ocrStream(id, lang){
+  setStatus('OCR…');
+  const {body} = addTextMsg('assistant', `### OCR (${lang})`);
+  const pages = new Map(); let total = 0;
+  const render = ()=>{
+    const txt = [...pages.keys()].sort((a,b)=>a-b).map(p=>pages.get(p)).join('\n\n');
+    body.innerHTML = renderMarkdown(`### OCR (${lang}) — ${pages.size}/${total||'?'}\n\n\`\`\`\n${txt}\n\`\`\``);
+  };
+  try{
+    const r = await fetch(`/api/files/${id}/ocr/stream?lang=${encodeURIComponent(lang)}`);
+    if(!r.ok){ const js = await r.json().catch(()=>({})); throw new Error(js.detail || `HTTP ${r.status}`); }
+    const reader = r.body.getReader(); const dec = new TextDecoder(); let buf = '';
+    for(;;){
+      const {value, done} = await reader.read(); if(done) break;
+      buf += dec.decode(value, {stream:true});
+      let i;
+      while((i = buf.indexOf('\n')) >= 0){
+        const line = buf.slice(0, i); buf = buf.slice(i+1);
+        if(!line.trim()) continue;
+        const js = JSON.parse(line);
+        if(js.error) throw new Error(js.error);
+        if(js.page !== undefined){ pages.set(js.page, js.text); total = js.total; render(); setStatus(`OCR ${pages.size}/${total}`); }
+      }
+    }
+    setStatus('gotowy');
+  }catch(e){ body.innerHTML = renderMarkdown(`**Błąd OCR:** ${e.message}`); setStatus('błąd'); }
+}
+
 async function loadFilesList(){
   const r = await fetch('/api/files/list'); const list = await r.json();
   filesList.innerHTML = "";
@@ -299,7 +543,7 @@ async function loadFilesList(){
     const act = document.createElement('div'); act.className='actions';
     const openBtn = document.createElement('button'); openBtn.textContent='Otwórz'; openBtn.onclick=()=>window.open(f.url,'_blank');
     const textBtn = document.createElement('button'); textBtn.textContent='Tekst'; textBtn.onclick=async()=>{ setStatus('parsuję…'); const rr = await fetch(`/api/files/${f.id}/text`); const jj = await rr.json(); addTextMsg('assistant', "### Tekst z pliku\n\n```\n" + (jj.text||"") + "\n```"); setStatus('gotowy'); };
-    const ocrBtn = document.createElement('button'); ocrBtn.textContent='OCR'; ocrBtn.onclick=async()=>{ const lang = prompt('Języki OCR (np. pol+eng):','pol+eng') || 'pol+eng'; setStatus('OCR…'); const rr = await fetch(`/api/files/${f.id}/ocr?lang=${encodeURIComponent(lang)}`); const jj = await rr.json(); addTextMsg('assistant', "### OCR ("+lang+")\n\n```\n" + (jj.text||"") + "\n```"); setStatus('gotowy'); };
+    const ocrBtn = document.createElement('button'); ocrBtn.textContent='OCR'; ocrBtn.onclick=()=>{ const lang = prompt('Języki OCR (np. pol+eng):','pol+eng') || 'pol+eng'; ocrStream(f.id, lang); };
     const delBtn = document.createElement('button'); delBtn.textContent='Usuń'; delBtn.onclick=async()=>{ if(confirm('Usunąć?')){ await fetch(`/api/files/${f.id}`, {method:'DELETE'}); loadFilesList(); } };
     act.append(openBtn, textBtn, ocrBtn, delBtn);
     row.append(info, act);
@@ -313,6 +557,11 @@ window.addEventListener('drop', e=>{ const fs = e.dataTransfer?.files; if(fs &&
 window.addEventListener('paste', e=>{ const items = e.clipboardData?.items || []; const arr=[]; for(const it of items){ if(it.kind==='file'){ const f=it.getAsFile(); if(f) arr.push(f); } } if(arr.length) uploadFiles(arr); });
 
 // INIT
-function init(){ loadTheme(); refreshThreads().then(newThread); setStatus('gotowy'); }
+function init(){
+  loadTheme(); setStatus('gotowy');
+  const saved = localStorage.getItem('threadId');
+  if(saved) loadThread(saved); else newThread();
+  refreshThreads();
+}
 window.addEventListener('DOMContentLoaded', init);
 
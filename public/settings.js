@@ -29,6 +29,11 @@ async function loadModels(){
     const r = await fetch('/api/models');
     const data = await r.json();
     modelSel.innerHTML='';
+    if(data.auto){
+      const opt=document.createElement('option');
+      opt.value=data.auto; opt.textContent='auto (dobór do zapytania)';
+      modelSel.appendChild(opt);
+    }
     for(const m of data.models || []){
       const opt=document.createElement('option');
       opt.value=m; opt.textContent=m;
@@ -0,0 +1,6 @@
+import os, pathlib, sys, tempfile
+
+# app.py czyta katalog danych przy imporcie — testy nie dotykają ~/.config/cheapchat.
+os.environ.setdefault("CHEAPCHAT_DATA_DIR", tempfile.mkdtemp(prefix="cheapchat-test-"))
+os.environ.setdefault("OPENAI_API_KEY", "sk-test-000000000000000000")
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
@@ -0,0 +1,27 @@
+import time
+
+from fastapi.testclient import TestClient
+
+import app
+
+
+def test_two_lifespans_back_to_back():
+    # Drugi create_app() w tym samym procesie (np. kolejny TestClient) musi wstać od nowa.
+    for _ in range(2):
+        with TestClient(app.create_app()) as http:
+            assert http.get("/api/threads").status_code == 200
+            assert http.get("/-/health").json()["ok"]
+        assert app.client is None and app._DB_EXECUTOR is None
+
+
+def test_idle_background_loops_do_not_feed_stage_metrics():
+    def db_count():
+        s = app.STAGE_SECONDS.series.get(("db",))
+        return s[-2] if s else 0
+
+    with TestClient(app.create_app()) as http:
+        http.get("/api/threads")
+        before = db_count()
+        assert before > 0  # żądanie liczy się do etapu "db"
+        time.sleep(2.5)  # workery kolejki odpytują bazę co sekundę
+        assert db_count() == before
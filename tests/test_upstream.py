@@ -0,0 +1,60 @@
+import asyncio, time
+
+import httpx, openai, pytest
+from fastapi import HTTPException
+
+import app
+
+
+def _err(cls, status: int, headers=None):
+    request = httpx.Request("POST", "http://stub/v1/responses")
+    return cls("stub", response=httpx.Response(status, request=request, headers=headers or {}), body=None)
+
+
+def _half_open(model: str) -> app.CircuitBreaker:
+    breaker = app._UP_BREAKERS[model] = app.CircuitBreaker()
+    breaker.opened_at = time.monotonic() - app.BREAKER_COOLDOWN
+    assert breaker.state == "half-open"
+    return breaker
+
+
+async def _fail(e):
+    raise e
+
+
+async def _ok(m):
+    return "ok"
+
+
+@pytest.fixture(autouse=True)
+def _no_retries(monkeypatch):
+    monkeypatch.setattr(app, "UPSTREAM_RETRIES", 0)
+
+
+def test_half_open_probe_rate_limited_allows_next_call():
+    breaker = _half_open("test-429")
+    rate = _err(openai.RateLimitError, 429, {"retry-after": "0.01"})
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(app.upstream("responses", "test-429", lambda m: _fail(rate)))
+    assert exc.value.status_code == 503
+    assert not breaker.probing and breaker.state == "half-open"
+    assert asyncio.run(app.upstream("responses", "test-429", _ok)) == ("ok", "test-429")
+    assert breaker.state == "closed"
+
+
+def test_half_open_probe_long_retry_after_allows_next_call(monkeypatch):
+    monkeypatch.setattr(app, "UPSTREAM_RETRIES", 3)
+    breaker = _half_open("test-ra")
+    rate = _err(openai.RateLimitError, 429, {"retry-after-ms": str((app.UPSTREAM_RETRY_AFTER_MAX + 1) * 1000)})
+    app._UP_BUCKETS["test-ra"] = None  # bez pauzy kubełka na czas Retry-After
+    with pytest.raises(HTTPException):
+        asyncio.run(app.upstream("responses", "test-ra", lambda m: _fail(rate)))
+    assert not breaker.probing
+    assert asyncio.run(app.upstream("responses", "test-ra", _ok)) == ("ok", "test-ra")
+
+
+def test_half_open_probe_fault_reopens():
+    breaker = _half_open("test-5xx")
+    with pytest.raises(openai.InternalServerError):
+        asyncio.run(app.upstream("responses", "test-5xx", lambda m: _fail(_err(openai.InternalServerError, 500))))
+    assert breaker.state == "open" and not breaker.probing